@@ -66,7 +66,7 @@ class BatchAllReduceAlgorithm(object):
   """Represents an algorithm for performing a batch all-reduce operation."""
 
   def batch_all_reduce(self, all_device_tensors, num_splits, compact_tensors,
-                       defer_tensors):
+                       defer_tensors, compact_dtype=tf.float16):
     """Performs a batch all-reduce.
 
     The reduction done is a sum.
@@ -92,8 +92,9 @@ class BatchAllReduceAlgorithm(object):
         many pieces during the all-reduce, then split back into their original
         shapes afterwards. Has no impact on correctness and can improve
         performance.
-      compact_tensors: If True, tensors are casted to fp16 before being all-
-        reduced. Improves performance, but hurts numerical stability.
+      compact_tensors: If True, tensors are casted to `compact_dtype` before
+        being all-reduced. Improves performance, but hurts numerical
+        stability.
       defer_tensors: If True, every time the return value
         `reduced_all_device_tensors` is evaluated, the result will be the
         reduced tensors values of `all_device_tensors` from the previous session
@@ -101,6 +102,9 @@ class BatchAllReduceAlgorithm(object):
         run. This can improve performance. When training neural networks,
         deferring gradients often does not harm training, so this can be used to
         improve performance.
+      compact_dtype: The 16-bit type tensors are casted to if
+        `compact_tensors` is True. bfloat16 has the range of fp32, so unlike
+        fp16, it cannot overflow.
 
     Returns:
       reduced_all_device_tensors: A list in the same form as
@@ -120,7 +124,8 @@ class BatchAllReduceAlgorithm(object):
     # concatenated tensor than on multiple smaller tensors.
     if compact_tensors:
       all_device_tensors_before_compact = all_device_tensors
-      all_device_tensors = _compact_all_device_tensors(all_device_tensors)
+      all_device_tensors = _compact_all_device_tensors(all_device_tensors,
+                                                       compact_dtype)
     if defer_tensors:
       all_device_tensors, put_ops, warmup_ops = _defer_all_device_tensors(
           all_device_tensors)
@@ -443,11 +448,11 @@ def _add_put_op_control_deps(all_device_tensors, num_splits, put_ops):
   return _apply_to_all_device_tensors(all_device_tensors, apply_func)
 
 
-def _compact_all_device_tensors(all_device_tensors):
-  """Compacts each tensor by casting to fp16."""
+def _compact_all_device_tensors(all_device_tensors, compact_dtype):
+  """Compacts each tensor by casting to `compact_dtype`."""
   def apply_func(tensor, device_index, tensor_index):
     del device_index, tensor_index
-    return tf.cast(tensor, tf.float16)
+    return tf.cast(tensor, compact_dtype)
   return _apply_to_all_device_tensors(all_device_tensors, apply_func)
 
 
@@ -21,9 +21,18 @@ from __future__ import print_function
 
 import argparse
 from collections import namedtuple
+from collections import OrderedDict
+import contextlib
+import copy
+import hashlib
+import json
 import math
 import multiprocessing
 import os
+import platform
+import re
+import resource
+import sys
 import threading
 import time
 
@@ -38,6 +47,7 @@ from google.protobuf import text_format
 
 from tensorflow.core.protobuf import rewriter_config_pb2
 from tensorflow.python import debug as tf_debug
+from tensorflow.python.client import device_lib
 from tensorflow.python.client import timeline
 from tensorflow.python.ops import data_flow_ops
 from tensorflow.python.platform import gfile
@@ -45,9 +55,12 @@ from tensorflow.python.util import nest
 import benchmark_storage
 import cnn_util
 import constants
+import convnet_builder
 import data_utils
 import datasets
 import flags
+import gradient_checkpointing
+import preprocessing
 import variable_mgr
 import variable_mgr_util
 from cnn_util import log_fn
@@ -57,6 +70,19 @@ from platforms import util as platforms_util
 
 _DEFAULT_NUM_BATCHES = 100
 
+# Number of warmup and timed steps run with each layout by --data_format=auto.
+_NUM_DATA_FORMAT_AUTO_WARMUP_STEPS = 2
+_NUM_DATA_FORMAT_AUTO_STEPS = 5
+
+# Number of warmup and timed steps run with each setting by --input_autotune.
+_NUM_INPUT_AUTOTUNE_WARMUP_STEPS = 5
+_NUM_INPUT_AUTOTUNE_STEPS = 20
+
+# With --xla, a measured step is reported as a likely recompilation if it is
+# this many times slower than the median step, and slower than the median step
+# by more than half of the first-step overhead.
+_XLA_RECOMPILE_STEP_RATIO = 3
+
 # TODO(reedwm): add upper_bound and lower_bound to appropriate integer and
 # float flags, and change certain string flags to enum flags.
 
@@ -74,9 +100,54 @@ flags.DEFINE_string('model', 'trivial',
 #   forward-only cannot be enabled with eval at the same time.
 flags.DEFINE_boolean('eval', False, 'whether use eval or benchmarking')
 flags.DEFINE_integer('eval_interval_secs', 0,
-                     'How often to run eval on saved checkpoints. Usually the '
-                     'same as save_model_secs from the corresponding training '
-                     'run. Pass 0 to eval only once.')
+                     'How often to check --train_dir for new checkpoints to '
+                     'eval, if inotify is not available. Usually the same as '
+                     'save_model_secs from the corresponding training run. '
+                     'Each new checkpoint is evaluated once, in a session '
+                     'that is kept open between evals. Pass 0 to eval only '
+                     'the latest checkpoint once.')
+flags.DEFINE_boolean('eval_full_pass', False,
+                     'If True, each eval is exactly one pass over the '
+                     'validation set, and --num_batches is ignored. The last '
+                     'batch is padded and the padding is masked out, so every '
+                     'validation image is counted exactly once. Requires '
+                     '--use_datasets, and that the dataset reports the exact '
+                     'number of validation images, e.g. with an index written '
+                     'by reshard_tfrecords.py. Only supported on a single '
+                     'worker.')
+flags.DEFINE_enum('eval_crop_mode', 'central', ('central', 'ten_crop'),
+                  'The crops of each image to evaluate. central: the central '
+                  'crop. ten_crop: the four corner crops and the central crop, '
+                  'and their horizontal flips. The crops of an image are '
+                  'evaluated in the same batch, and their softmax outputs are '
+                  'averaged.')
+flags.DEFINE_list('eval_crop_scales', ['1.15'],
+                  'The scales at which the eval crops are taken. At scale s, '
+                  'the image is resized so that its shorter side is s times '
+                  'the image size of the model. Each scale must be at least '
+                  '1. Multiple scales multiply the number of crops.')
+flags.DEFINE_integer('eval_during_training_every_n_steps', 0,
+                     'If greater than 0, the model is evaluated every n '
+                     'training steps while training continues, in the same '
+                     'process. The eval model is built in its own graph and '
+                     'session, and gets the current variable values from the '
+                     'training session in memory, without a checkpoint. If an '
+                     'eval is still running when the next one is due, the '
+                     'next one is skipped. Only supported on a single host.',
+                     lower_bound=0)
+flags.DEFINE_integer('num_eval_gpus', 0,
+                     'The number of devices dedicated to '
+                     '--eval_during_training_every_n_steps. The eval devices '
+                     'come after the --num_gpus training devices. If 0, eval '
+                     'shares the training devices.', lower_bound=0)
+flags.DEFINE_integer('num_eval_batches', None,
+                     'The number of batches to run for each eval with '
+                     '--eval_during_training_every_n_steps. If None, an epoch '
+                     'of the validation set is run.', lower_bound=1)
+flags.DEFINE_integer('num_eval_intra_threads', None,
+                     'Number of threads to use for intra-op parallelism in '
+                     'the session of --eval_during_training_every_n_steps. If '
+                     'None, --num_intra_threads is used.', lower_bound=0)
 flags.DEFINE_boolean('forward_only', False,
                      'whether use forward-only or training for benchmarking')
 flags.DEFINE_boolean('print_training_accuracy', False,
@@ -86,6 +157,13 @@ flags.DEFINE_integer('batch_size', 0, 'batch size per compute device')
 flags.DEFINE_integer('batch_group_size', 1,
                      'number of groups of batches processed in the image '
                      'producer.')
+flags.DEFINE_integer('gradient_accumulation_steps', 1,
+                     'Number of micro-batches of batch_size images to run per '
+                     'step. The gradients of the micro-batches are '
+                     'accumulated into local buffers, and the optimizer and '
+                     'any gradient communication run once per step, on the '
+                     'average of the gradients. This allows large effective '
+                     'batch sizes that do not fit in memory.', lower_bound=1)
 flags.DEFINE_integer('num_batches', None, 'number of batches to run, excluding '
                      'warmup. Defaults to %d' % _DEFAULT_NUM_BATCHES)
 flags.DEFINE_float('num_epochs', None,
@@ -105,8 +183,10 @@ flags.DEFINE_string('data_dir', None,
                     'protobufs). If not specified, synthetic data will be '
                     'used.')
 flags.DEFINE_string('data_name', None,
-                    'Name of dataset: imagenet or cifar10. If not specified, '
-                    'it is automatically guessed based on data_dir.')
+                    'Name of dataset: imagenet, imagenet_raw or cifar10. '
+                    'imagenet_raw is imagenet converted to raw pixels by '
+                    'convert_to_raw_tfrecords.py. If not specified, it is '
+                    'automatically guessed based on data_dir.')
 flags.DEFINE_string('resize_method', 'bilinear',
                     'Method for resizing input images: crop, nearest, '
                     'bilinear, bicubic, area, or round_robin. The `crop` mode '
@@ -160,6 +240,17 @@ flags.DEFINE_enum('variable_consistency', 'strong', ('strong', 'relaxed'),
                   'previous step. With relaxed consistency, all the updates '
                   'will eventually show up in the variables. Likely one step '
                   'behind.')
+flags.DEFINE_boolean('shard_optimizer_state', False,
+                     'With --variable_update=replicated, update each variable '
+                     'on a single device instead of on every device. The '
+                     'gradients of a variable are summed on the device owning '
+                     'it, which applies the update, and then copies the '
+                     'updated variable to the other devices. The optimizer '
+                     'slots, such as momentums, only exist on the owning '
+                     'device, so the memory of the optimizer state and the '
+                     'compute of the update are split across the devices. '
+                     'Variables are assigned to devices so that each device '
+                     'owns about the same number of bytes.')
 flags.DEFINE_boolean('cache_data', False,
                      'Enable use of a special datasets pipeline that reads a '
                      'single TFRecord into memory and repeats it infinitely '
@@ -174,7 +265,14 @@ flags.DEFINE_string('device', 'gpu',
                     'Device to use for computation: cpu or gpu')
 flags.DEFINE_string('data_format', 'NCHW',
                     'Data layout to use: NHWC (TF native) or NCHW (cuDNN '
-                    'native, requires GPU).')
+                    'native, requires GPU). If "auto", a few steps of the '
+                    'model are timed with each layout supported by the device '
+                    'and the fastest one is used.')
+flags.DEFINE_string('data_format_cache_file', None,
+                    'If specified along with --data_format=auto, the layout '
+                    'chosen for each (model, device type and model name, '
+                    'TensorFlow build) is stored in this JSON file and reused '
+                    'by later runs instead of being timed again.')
 flags.DEFINE_integer('num_intra_threads', 1,
                      'Number of threads to use for intra-op parallelism. If '
                      'set to 0, the system will pick an appropriate number.')
@@ -208,6 +306,14 @@ flags.DEFINE_string('partitioned_graph_file_prefix', None,
                     'If specified, after the graph has been partitioned and '
                     'optimized, write out each partitioned graph to a file '
                     'with the given prefix.')
+flags.DEFINE_string('graph_cache_dir', None,
+                    'If specified, the training graph is exported to a '
+                    'MetaGraph in this directory, keyed by the params that '
+                    'affect the graph, the source files of tf_cnn_benchmarks '
+                    'and of the model, and the TensorFlow build. Later runs '
+                    'with the same key import the MetaGraph instead of '
+                    'building the model in Python, which shortens their '
+                    'startup. Only supported when training on a single host.')
 flags.DEFINE_string('optimizer', 'sgd',
                     'Optimizer to use: momentum or sgd or rmsprop')
 flags.DEFINE_float('init_learning_rate', None,
@@ -236,7 +342,27 @@ flags.DEFINE_float('minimum_learning_rate', 0,
                    'never decay past this value. Requires `learning_rate`, '
                    '`num_epochs_per_decay` and `learning_rate_decay_factor` to '
                    'be set.')
+flags.DEFINE_string('learning_rate_table_file', None,
+                    'If specified, write the learning rate schedule to this '
+                    'file before training. The schedule is a table with one '
+                    'row per breakpoint, of the form "first_step '
+                    'learning_rate increment_per_step decay_factor '
+                    'decay_steps". The learning rate at a step is '
+                    'learning_rate * decay_factor ** floor((step - '
+                    'first_step) / decay_steps) + increment_per_step * (step - '
+                    'first_step), for the last row whose first_step is at most '
+                    'the step. Not written if the schedule is defined by the '
+                    'model, i.e. if neither --init_learning_rate nor '
+                    '--piecewise_learning_rate_schedule is specified.')
 flags.DEFINE_float('momentum', 0.9, 'Momentum for training.')
+flags.DEFINE_boolean('fused_optimizer', False,
+                     'If True, the momentum and sgd optimizers compute the '
+                     'updates of all variables of the same device and dtype '
+                     'with a few ops on flat buffers, instead of with one op '
+                     'per variable. This reduces the per-step op overhead for '
+                     'models with many variables. Momentum accumulators are '
+                     'stored in flat variables, so checkpoints are not '
+                     'interchangeable with runs without this flag.')
 flags.DEFINE_float('rmsprop_decay', 0.9, 'Decay term for RMSProp.')
 flags.DEFINE_float('rmsprop_momentum', 0.9, 'Momentum in RMSProp.')
 flags.DEFINE_float('rmsprop_epsilon', 1.0, 'Epsilon term for RMSProp.')
@@ -276,6 +402,38 @@ flags.DEFINE_integer('datasets_num_private_threads', None,
                      'all datasets computation. By default, we pick an '
                      'appropriate number. If set to 0, we use the default '
                      'tf-Compute threads for dataset operations.')
+flags.DEFINE_integer('datasets_interleave_cycle_length', 10,
+                     'Number of input files read in parallel by the tf.data '
+                     'input pipeline.', lower_bound=1)
+flags.DEFINE_integer('datasets_record_prefetch_buffer_size', None,
+                     'Number of records prefetched by the tf.data input '
+                     'pipeline before they are shuffled. Defaults to the '
+                     'batch size.', lower_bound=1)
+flags.DEFINE_integer('datasets_shuffle_buffer_size', None,
+                     'Size of the shuffle buffer of the tf.data input '
+                     'pipeline. Defaults to 10000, or to 1000 if --data_dir '
+                     'was written by reshard_tfrecords.py.', lower_bound=1)
+flags.DEFINE_integer('datasets_num_parallel_batches', None,
+                     'Number of batches preprocessed in parallel by the '
+                     'tf.data input pipeline. Defaults to the number of '
+                     'devices.', lower_bound=1)
+flags.DEFINE_integer('record_input_parallelism', 64,
+                     'Number of input files read in parallel when '
+                     '--use_datasets=False.', lower_bound=1)
+flags.DEFINE_integer('record_input_buffer_size', 10000,
+                     'Number of records buffered and shuffled when '
+                     '--use_datasets=False.', lower_bound=1)
+flags.DEFINE_boolean('input_autotune', False,
+                     'If True, the input pipeline is briefly run with several '
+                     'settings of --datasets_interleave_cycle_length, '
+                     '--datasets_num_parallel_batches and '
+                     '--datasets_record_prefetch_buffer_size (or of '
+                     '--record_input_parallelism if --use_datasets=False), '
+                     'and the fastest setting whose estimated memory use fits '
+                     'in --input_autotune_memory_budget_mb is used.')
+flags.DEFINE_integer('input_autotune_memory_budget_mb', 8192,
+                     'Host memory budget of the input pipeline, used by '
+                     '--input_autotune.', lower_bound=1)
 
 # Performance tuning parameters.
 flags.DEFINE_boolean('winograd_nonfused', True,
@@ -295,10 +453,25 @@ flags.DEFINE_boolean('force_gpu_compatible', False,
 flags.DEFINE_boolean('allow_growth', None,
                      'whether to enable allow_growth in GPU_Options')
 flags.DEFINE_boolean('xla', False, 'whether to enable XLA')
+flags.DEFINE_enum('xla_compile_scope', 'global', ('global', 'tower', 'model'),
+                  'With --xla, which ops are compiled. "global" lets XLA '
+                  'cluster any op of the graph. "tower" compiles the forward '
+                  'and backward pass of each tower, but not the input '
+                  'pipeline and the variable updates. "model" only compiles '
+                  'the layers of the model, with the forward and backward '
+                  'pass as separate clusters, so the loss and the gradient '
+                  'processing stay unfused.')
 flags.DEFINE_boolean('fuse_decode_and_crop', True,
                      'Fuse decode_and_crop for image preprocessing.')
 flags.DEFINE_boolean('distort_color_in_yiq', True,
                      'Distort color of input images in YIQ space.')
+flags.DEFINE_boolean('vectorized_distortions', False,
+                     'If True, images are only decoded, cropped and resized '
+                     'one at a time. The random flip, color distortions and '
+                     'normalization are then applied to the whole batch with '
+                     'a few vectorized ops, with random parameters drawn per '
+                     'image. Only supported by the default ImageNet input '
+                     'preprocessor.')
 flags.DEFINE_boolean('enable_layout_optimizer', False,
                      'whether to enable layout optimizer')
 flags.DEFINE_string('rewriter_config', None,
@@ -316,6 +489,19 @@ flags.DEFINE_boolean('single_l2_loss_op', False,
                      'If True, instead of using an L2 loss op per variable, '
                      'concatenate the variables into a single tensor and do a '
                      'single L2 loss on the concatenated tensor.')
+flags.DEFINE_enum('recompute_activations', 'none', ('none', 'blocks', 'sqrt'),
+                  'If not "none", only some activations are kept alive for '
+                  'backprop, and the activations between them are recomputed '
+                  'when needed. This trades compute for memory, allowing '
+                  'larger batch sizes. "blocks" keeps the outputs of blocks of '
+                  'layers, such as residual blocks and inception modules, '
+                  'falling back to "sqrt" for models without blocks. "sqrt" '
+                  'keeps every sqrt(N)-th of the N layer outputs.')
+flags.DEFINE_boolean('shard_l2_loss', False,
+                     'If True, each device computes the L2 loss for a disjoint '
+                     'shard of the variables, balanced by size, instead of the '
+                     'last device computing the L2 loss for all of them. Not '
+                     'supported with --variable_update=independent.')
 flags.DEFINE_boolean('use_resource_vars', False,
                      'Use resource variables instead of normal variables. '
                      'Resource variables are slower, but this option is useful '
@@ -337,6 +523,13 @@ flags.DEFINE_integer('kmp_settings', 1,
 flags.DEFINE_boolean('use_fp16', False,
                      'Use 16-bit floats for certain tensors instead of 32-bit '
                      'floats. This is currently experimental.')
+flags.DEFINE_enum('compute_dtype', 'float32', ('float32', 'bfloat16'),
+                  'The type of the activations. With bfloat16, which CPUs '
+                  'with native bfloat16 support run faster than float16, the '
+                  'variables, batch normalization and the loss stay in '
+                  'float32, and no loss scaling is needed. Use --use_fp16 for '
+                  'float16. Requires a TensorFlow build with bfloat16 CPU '
+                  'kernels, such as an MKL build.')
 # TODO(reedwm): The default loss scale of 128 causes most models to diverge
 # on the second step with synthetic data. Changing the tf.set_random_seed
 # call to tf.set_random_seed(1235) or most other seed values causes the
@@ -357,6 +550,16 @@ flags.DEFINE_boolean('fp16_enable_auto_loss_scale', False,
 flags.DEFINE_integer('fp16_inc_loss_scale_every_n', 1000,
                      'If fp16 is enabled and fp16_enable_auto_loss_scale is '
                      'True, increase the loss scale every n steps.')
+flags.DEFINE_float('fp16_inc_loss_scale_factor', 2.,
+                   'If fp16 is enabled and fp16_enable_auto_loss_scale is '
+                   'True, the factor by which the loss scale is increased '
+                   'every fp16_inc_loss_scale_every_n steps without infs or '
+                   'nans in the gradients.', lower_bound=1.)
+flags.DEFINE_float('fp16_dec_loss_scale_factor', 2.,
+                   'If fp16 is enabled and fp16_enable_auto_loss_scale is '
+                   'True, the factor by which the loss scale is decreased '
+                   'when the gradients of a step have infs or nans. The '
+                   'gradients of such a step are skipped.', lower_bound=1.)
 
 # The method for managing variables:
 #   parameter_server: variables are stored on a parameter server that holds
@@ -450,14 +653,51 @@ flags.DEFINE_integer('summary_verbosity', 0, 'Verbosity level for summary ops. '
 flags.DEFINE_integer('save_summaries_steps', 0,
                      'How often to save summaries for trained models. Pass 0 '
                      'to disable summaries.')
+flags.DEFINE_boolean('async_summaries', False,
+                     'If True, the training step only fetches the tensors '
+                     'summarized by the summary ops into host memory, and a '
+                     'background thread computes the summaries from them and '
+                     'writes them. A summary is skipped if the previous one '
+                     'is still being written.')
+flags.DEFINE_integer('summary_histogram_max_values', 0,
+                     'If positive, histogram summaries only summarize this '
+                     'many evenly strided values of each tensor, which makes '
+                     'them cheaper to fetch and compute. If 0, histograms '
+                     'summarize all the values.', lower_bound=0)
 flags.DEFINE_integer('save_model_secs', 0,
                      'How often to save trained models. Pass 0 to disable '
                      'checkpoints.')
+flags.DEFINE_boolean('sharded_checkpoint', False,
+                     'If True, checkpoints are saved and restored in shards, '
+                     'one per device holding variables, so each parameter '
+                     'server (or worker, in modes without parameter servers) '
+                     'writes and reads its own variables in parallel. The '
+                     'checkpoint index ties the shards together. In '
+                     'distributed mode, --train_dir must be on a file system '
+                     'shared by all tasks. Not supported with '
+                     '--async_checkpoint.')
+flags.DEFINE_boolean('async_checkpoint', False,
+                     'If True, checkpoints are saved by fetching the variables '
+                     'into host memory in a single session run, and writing '
+                     'them on a background thread while training continues. '
+                     'At most one checkpoint is written at a time: if a '
+                     'checkpoint is due while another one is being written, '
+                     'it is saved once the other one is written. The time '
+                     'each checkpoint takes from training is logged.')
 flags.DEFINE_string('train_dir', None,
                     'Path to session checkpoints. Pass None to disable saving '
                     'checkpoint at the end.')
 flags.DEFINE_string('eval_dir', '/tmp/tf_cnn_benchmarks/eval',
                     'Directory where to write eval event logs.')
+flags.DEFINE_string('eval_cache_dir', None,
+                    'If specified, the preprocessed validation batches of the '
+                    'first evaluation pass are written to a file in this '
+                    'directory, and later passes read them from it instead of '
+                    'decoding and resizing the images again. Only supported '
+                    'with --use_datasets.')
+flags.DEFINE_boolean('eval_cache_fp16', True,
+                     'If True, images in the --eval_cache_dir cache are stored '
+                     'as float16, halving its size.')
 flags.DEFINE_string('result_storage', None,
                     'Specifies storage option for benchmark results. None '
                     'means results won\'t be stored. '
@@ -517,18 +757,191 @@ class GlobalStepWatcher(threading.Thread):
     return self.finish_time - self.start_time
 
 
+def _canonical_variable_name(var):
+  """Returns the name of a variable without its tower scope, e.g. 'v0/'."""
+  name = var.op.name
+  parts = name.split('/', 1)
+  if len(parts) == 2 and re.match(r'^v\d*$', parts[0]):
+    return parts[1]
+  return name
+
+
+class ConcurrentEvaluator(object):
+  """Evaluates a model in a background thread while it is being trained.
+
+  The eval model is built by `eval_bench` in its own graph, and is run in its
+  own session, on the devices and threads of `eval_bench`. Each eval uses a
+  snapshot of the training variables, which is fetched from the training
+  session and fed to the eval session, so no checkpoint is written or read.
+
+  Example usage:
+  ```
+  evaluator = ConcurrentEvaluator(eval_bench, train_variables)
+  evaluator.start()
+  for step in ...:
+    sess.run(...)
+    evaluator.evaluate(sess)
+  evaluator.done()
+  ```
+  """
+
+  def __init__(self, eval_bench, train_variables):
+    self.eval_bench = eval_bench
+    self.results = []
+    self.num_skipped = 0
+    self.graph = tf.Graph()
+    if isinstance(train_variables, dict):
+      # The savable variables of some variable managers are a dict.
+      train_variables = list(train_variables.values())
+    train_variables_by_name = {}
+    for v in train_variables:
+      # With --variable_update=independent, every tower has its own copy of
+      # the variables. The first one is used.
+      train_variables_by_name.setdefault(_canonical_variable_name(v), v)
+    with self.graph.as_default():
+      if eval_bench.datasets_use_prefetch:
+        (self.image_producer_ops, self.enqueue_ops, self.fetches) = (
+            eval_bench._build_model_with_dataset_prefetching())  # pylint: disable=protected-access
+      else:
+        (self.image_producer_ops, self.enqueue_ops, self.fetches) = (
+            eval_bench._build_model())  # pylint: disable=protected-access
+      self.train_variables = []
+      self.placeholders = []
+      assign_ops = []
+      for v in eval_bench.variable_mgr.savable_variables():
+        name = _canonical_variable_name(v)
+        if name not in train_variables_by_name:
+          raise ValueError('Variable %s of the eval model is not in the '
+                           'training model' % v.op.name)
+        self.train_variables.append(train_variables_by_name[name])
+        placeholder = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+        self.placeholders.append(placeholder)
+        assign_ops.append(v.assign(placeholder))
+      with tf.control_dependencies(assign_ops):
+        # Copy the assigned variables to the other eval devices.
+        self.assign_op_group = tf.group(
+            *(assign_ops + eval_bench.variable_mgr.get_post_init_ops()))
+      self.global_step = tf.train.get_global_step()
+      self.init_op_group = tf.group(tf.global_variables_initializer(),
+                                    tf.local_variables_initializer(),
+                                    tf.tables_initializer())
+      self.summary_op = tf.summary.merge_all()
+    self.sess = None
+    self.summary_writer = None
+    self.coord = None
+    self.image_producer = None
+    self.thread = None
+    self.snapshots = six.moves.queue.Queue(maxsize=1)
+    self.eval_running = threading.Event()
+    self.exc_info = None
+
+  def get_session_config(self):
+    """Returns the ConfigProto of the eval session.
+
+    By default, the thread pools are shared by all the sessions of the process,
+    and their sizes are set by the first session, which is the training
+    session. The eval session has its own thread pools, so that
+    --num_eval_intra_threads is used and evals do not compete with training for
+    the same threads.
+    """
+    config = create_config_proto(self.eval_bench.params)
+    config.use_per_session_threads = True
+    return config
+
+  def start(self):
+    """Creates the eval session and starts the eval thread."""
+    self.sess = tf.Session(graph=self.graph, config=self.get_session_config())
+    self.sess.run(self.init_op_group)
+    self.summary_writer = tf.summary.FileWriter(self.eval_bench.params.eval_dir,
+                                                self.graph)
+    if self.eval_bench.dataset.queue_runner_required():
+      self.coord = tf.train.Coordinator()
+      with self.graph.as_default():
+        tf.train.start_queue_runners(sess=self.sess, coord=self.coord)
+    self.thread = threading.Thread(target=self._run)
+    # Do not keep the process alive if training fails.
+    self.thread.daemon = True
+    self.thread.start()
+
+  def evaluate(self, train_sess):
+    """Starts an eval of the current training variables in `train_sess`.
+
+    Args:
+      train_sess: The training session.
+    Returns:
+      True if the eval was started, or False if it was skipped because the
+      previous eval is still running.
+    """
+    if self.eval_running.is_set():
+      self.num_skipped += 1
+      return False
+    values = train_sess.run(self.train_variables)
+    self.eval_running.set()
+    self.snapshots.put(values)
+    return True
+
+  def done(self):
+    """Waits for the running eval to finish and stops the eval thread."""
+    self.snapshots.put(None)
+    self.thread.join()
+    if self.image_producer is not None:
+      self.image_producer.done()
+    if self.coord is not None:
+      self.coord.request_stop()
+    self.sess.close()
+    if self.coord is not None:
+      self.coord.join()
+    self.summary_writer.close()
+    if self.exc_info is not None:
+      six.reraise(*self.exc_info)
+
+  def _run(self):
+    try:
+      while True:
+        values = self.snapshots.get()
+        if values is None:
+          return
+        self.sess.run(self.assign_op_group,
+                      dict(zip(self.placeholders, values)))
+        if (self.image_producer is None and
+            self.image_producer_ops is not None):
+          self.image_producer = cnn_util.ImageProducer(
+              self.sess, self.image_producer_ops,
+              self.eval_bench.batch_group_size,
+              self.eval_bench.params.use_python32_barrier)
+          self.image_producer.start()
+          for i in xrange(len(self.enqueue_ops)):
+            self.sess.run(self.enqueue_ops[:(i + 1)])
+            self.image_producer.notify_image_consumption()
+        global_step = self.sess.run(self.global_step)
+        # print (which is log_fn) is not thread safe, so tf.logging.info is
+        # used to log from the eval thread.
+        tf.logging.info('Evaluating the model at step %d' % global_step)
+        results = self.eval_bench._eval_once(  # pylint: disable=protected-access
+            self.sess, self.summary_writer, self.fetches, self.summary_op,
+            self.image_producer, global_step, log=tf.logging.info)
+        results['global_step'] = global_step
+        self.results.append(results)
+        self.eval_running.clear()
+    except Exception:  # pylint: disable=broad-except
+      self.exc_info = sys.exc_info()
+      self.eval_running.set()
+
+
 class CheckpointNotFoundException(Exception):
   pass
 
 
 def get_data_type(params):
-  """Returns BenchmarkCNN's data type as determined by use_fp16.
+  """Returns BenchmarkCNN's data type, determined by use_fp16 and compute_dtype.
 
   Args:
     params: Params tuple, typically created by make_params or
             make_params_from_flags.
   """
-  return tf.float16 if params.use_fp16 else tf.float32
+  if params.use_fp16:
+    return tf.float16
+  return tf.as_dtype(params.compute_dtype)
 
 
 # Note that we monkey patch this function in the unit tests. So if this is
@@ -565,7 +978,7 @@ def create_config_proto(params):
   if params.gpu_memory_frac_for_testing > 0:
     config.gpu_options.per_process_gpu_memory_fraction = (
         params.gpu_memory_frac_for_testing)
-  if params.xla:
+  if params.xla and params.xla_compile_scope == 'global':
     config.graph_options.optimizer_options.global_jit_level = (
         tf.OptimizerOptions.ON_1)
   if params.enable_layout_optimizer:
@@ -601,10 +1014,139 @@ def get_mode_from_params(params):
   return 'training'
 
 
+# With --eval_full_pass, each tower adds the number of non-padding examples in
+# its batch to this collection.
+EVAL_NUM_EXAMPLES_COLLECTION = 'eval_num_examples'
+
+# With --graph_cache_dir, the exported MetaGraph stores the names of the graph
+# elements used by BenchmarkCNN._benchmark_cnn, as JSON, in this collection.
+GRAPH_HANDLES_COLLECTION = 'tf_cnn_benchmarks_graph_handles'
+
+# Params that do not change the training graph, so they are not part of the
+# --graph_cache_dir key.
+_GRAPH_CACHE_IGNORED_PARAMS = frozenset([
+    'num_batches', 'num_epochs', 'num_warmup_batches', 'display_every',
+    'train_dir', 'save_model_secs', 'save_summaries_steps', 'trace_file',
+    'use_chrome_trace_format', 'tfprof_file', 'graph_file',
+    'partitioned_graph_file_prefix', 'graph_cache_dir', 'debugger',
+    'result_storage', 'async_checkpoint', 'sharded_checkpoint',
+    'data_format_cache_file', 'learning_rate_table_file', 'async_summaries',
+])
+
+
+def _get_source_digest(model):
+  """Returns a digest of the source files the graph of `model` depends on.
+
+  These are the Python files of tf_cnn_benchmarks, except tests, and the file
+  of the module of `model`, which is outside of tf_cnn_benchmarks for models
+  registered with model_config.register_model.
+
+  Args:
+    model: The Model whose graph is built.
+  Returns:
+    A hex digest string.
+  """
+  source_dir = os.path.dirname(os.path.abspath(__file__))
+  paths = set()
+  for dirpath, _, filenames in os.walk(source_dir):
+    paths.update(os.path.join(dirpath, filename) for filename in filenames
+                 if filename.endswith('.py') and
+                 not filename.endswith('_test.py'))
+  model_file = getattr(sys.modules.get(type(model).__module__), '__file__',
+                       None)
+  if model_file:
+    if model_file.endswith('.pyc'):
+      model_file = model_file[:-1]
+    paths.add(os.path.abspath(model_file))
+  md5 = hashlib.md5()
+  for path in sorted(paths):
+    if os.path.isfile(path):
+      with open(path, 'rb') as f:
+        md5.update(f.read())
+  return md5.hexdigest()
+
+
+def _graph_element_names(structure):
+  """Returns `structure` with its graph elements replaced by their names.
+
+  Args:
+    structure: A nested structure of dicts, lists and tuples, whose leaves are
+      Tensors, Operations, Variables or None.
+  Returns:
+    A JSON-serializable copy of `structure`, where each leaf is a string of the
+    form '<kind>:<name>', or None.
+  """
+  if isinstance(structure, dict):
+    return {key: _graph_element_names(value)
+            for key, value in six.iteritems(structure)}
+  if isinstance(structure, (list, tuple)):
+    return [_graph_element_names(value) for value in structure]
+  if isinstance(structure, tf.Variable):
+    return 'variable:' + structure.name
+  if isinstance(structure, tf.Tensor):
+    return 'tensor:' + structure.name
+  if isinstance(structure, tf.Operation):
+    return 'op:' + structure.name
+  assert structure is None, structure
+  return None
+
+
+def _graph_elements_from_names(graph, structure):
+  """Inverse of _graph_element_names, looking up the elements in `graph`."""
+  variables = {v.name: v for v in
+               graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES) +
+               graph.get_collection(tf.GraphKeys.LOCAL_VARIABLES)}
+
+  def from_names(structure):
+    if isinstance(structure, dict):
+      return {key: from_names(value) for key, value in six.iteritems(structure)}
+    if isinstance(structure, list):
+      return [from_names(value) for value in structure]
+    if structure is None:
+      return None
+    kind, name = structure.split(':', 1)
+    if kind == 'variable':
+      return variables[name]
+    if kind == 'tensor':
+      return graph.get_tensor_by_name(name)
+    return graph.get_operation_by_name(name)
+
+  return from_names(structure)
+
+
 # How many digits to show for the loss and accuracies during training.
 LOSS_AND_ACCURACY_DIGITS_TO_SHOW = 3
 
 
+def get_summary_stats(step_train_times, summary_steps):
+  """Returns the cost of collecting summaries during the measured steps.
+
+  The cost of a step collecting summaries is estimated as its time minus the
+  median time of the steps not collecting summaries.
+
+  Args:
+    step_train_times: The times of the measured steps, in seconds.
+    summary_steps: The indices in `step_train_times` of the steps collecting
+      summaries.
+  Returns:
+    A dict with the number of steps collecting summaries, 'num_summaries', the
+    total cost of collecting them, 'summary_secs', and the fraction of the
+    training time spent collecting them, 'summary_overhead'.
+  """
+  summary_steps = set(summary_steps)
+  other_step_times = [t for i, t in enumerate(step_train_times)
+                      if i not in summary_steps]
+  median_step_time = np.median(other_step_times) if other_step_times else 0.
+  summary_secs = sum(max(step_train_times[i] - median_step_time, 0.)
+                     for i in summary_steps)
+  total_secs = sum(step_train_times)
+  return {
+      'num_summaries': len(summary_steps),
+      'summary_secs': summary_secs,
+      'summary_overhead': summary_secs / total_secs if total_secs else 0.,
+  }
+
+
 def benchmark_one_step(sess,
                        fetches,
                        step,
@@ -616,8 +1158,19 @@ def benchmark_one_step(sess,
                        image_producer,
                        params,
                        summary_op=None,
-                       show_images_per_sec=True):
-  """Advance one step of benchmarking."""
+                       show_images_per_sec=True,
+                       accumulation_fetches=None):
+  """Advance one step of benchmarking.
+
+  If `accumulation_fetches` is not None, it is run once for each of the first
+  params.gradient_accumulation_steps - 1 micro-batches of the step, and
+  `fetches` is run for the last one. `batch_size` is the number of images per
+  micro-batch.
+
+  If `summary_op` is not None, it is fetched with `fetches`, and its value is
+  returned. It can be any fetch, such as the snapshot_fetches of a
+  cnn_util.AsyncSummaryWriter.
+  """
   should_profile = profiler and 0 <= step < _NUM_STEPS_TO_PROFILE
   need_options_and_metadata = (
       should_profile or
@@ -635,6 +1188,12 @@ def benchmark_one_step(sess,
     run_metadata = None
   summary_str = None
   start_time = time.time()
+  if accumulation_fetches is not None:
+    for _ in xrange(params.gradient_accumulation_steps - 1):
+      sess.run(accumulation_fetches)
+      if image_producer is not None:
+        image_producer.notify_image_consumption()
+    batch_size *= params.gradient_accumulation_steps
   if summary_op is None:
     results = sess.run(fetches, options=run_options, run_metadata=run_metadata)
   else:
@@ -705,6 +1264,97 @@ def get_perf_timing_str(batch_size, step_train_times, scale=1):
     return 'images/sec: %.1f' % speed_mean
 
 
+def get_xla_step_stats(first_step_secs, step_train_times,
+                       first_step_measured=False):
+  """Returns the XLA first-step overhead and the steps that likely recompiled.
+
+  TensorFlow does not report compilations to Python, so they are derived from
+  the step times. The first-step overhead is the time of the first step minus
+  the median measured step. With XLA, it is mostly the time to compile every
+  cluster, but it also includes other one-time costs, such as the allocation
+  of memory and the autotuning of kernels. Later compilations, e.g. because a
+  shape changed, show up as measured steps that take about as long.
+
+  Args:
+    first_step_secs: The time of the first (warm up) step, in seconds.
+    step_train_times: The times of the measured steps, in seconds.
+    first_step_measured: Whether the first step is also the first measured
+      step, when there are no warm up steps. It is then not reported as a
+      recompilation.
+  Returns:
+    A dictionary with the first-step overhead, 'xla_first_step_overhead_secs',
+    and the 0-based indices of the measured steps that likely recompiled,
+    'xla_recompile_steps'.
+  """
+  median_step_secs = np.median(step_train_times)
+  overhead_secs = max(first_step_secs - median_step_secs, 0.)
+  threshold = max(_XLA_RECOMPILE_STEP_RATIO * median_step_secs,
+                  median_step_secs + overhead_secs / 2)
+  first_step = 1 if first_step_measured else 0
+  recompile_steps = [step for step, secs in enumerate(step_train_times)
+                     if step >= first_step and secs > threshold]
+  return {
+      'xla_first_step_overhead_secs': overhead_secs,
+      'xla_recompile_steps': recompile_steps,
+  }
+
+
+def get_loss_scale_stats(init_values, values, num_steps):
+  """Returns the automatic loss scaling stats of a run.
+
+  Args:
+    init_values: The values of BenchmarkCNN._get_loss_scale_ops() at the start
+      of the run.
+    values: Their values at the end of the run.
+    num_steps: The number of steps run, including warm up steps.
+  Returns:
+    A dictionary with the final loss scale, the number of steps whose
+    gradients were skipped because they had infs or nans, and the fraction of
+    steps that were skipped.
+  """
+  skipped_steps = (values['loss_scale_skipped_steps'] -
+                   init_values['loss_scale_skipped_steps'])
+  return {
+      'loss_scale': values['loss_scale'],
+      'loss_scale_skipped_steps': skipped_steps,
+      'loss_scale_overflow_rate': (float(skipped_steps) / num_steps
+                                   if num_steps else 0.),
+  }
+
+
+def get_eval_during_training_stats(evaluator):
+  """Returns the stats of the evals run by a ConcurrentEvaluator.
+
+  Args:
+    evaluator: A ConcurrentEvaluator that is done.
+  Returns:
+    A dictionary with the number of evals, the mean eval images/sec, and the
+    accuracies of the last eval.
+  """
+  stats = {'num_evals': len(evaluator.results)}
+  if evaluator.results:
+    stats['eval_images_per_sec'] = np.mean(
+        [results['images_per_sec'] for results in evaluator.results])
+    stats['eval_top_1_accuracy'] = evaluator.results[-1]['top_1_accuracy']
+    stats['eval_top_5_accuracy'] = evaluator.results[-1]['top_5_accuracy']
+  return stats
+
+
+def restore_checkpoint(saver, sess, model_checkpoint_path):
+  """Restores a checkpoint and returns the global step it was saved at."""
+  # Assuming model_checkpoint_path looks something like:
+  #   /my-favorite-path/imagenet_train/model.ckpt-0,
+  # extract global_step from it.
+  global_step = model_checkpoint_path.split('/')[-1].split('-')[-1]
+  if not global_step.isdigit():
+    global_step = 0
+  else:
+    global_step = int(global_step)
+  saver.restore(sess, model_checkpoint_path)
+  log_fn('Successfully loaded model from %s.' % model_checkpoint_path)
+  return global_step
+
+
 def load_checkpoint(saver, sess, ckpt_dir):
   ckpt = tf.train.get_checkpoint_state(ckpt_dir)
   if ckpt and ckpt.model_checkpoint_path:
@@ -714,17 +1364,7 @@ def load_checkpoint(saver, sess, ckpt_dir):
     else:
       # Restores from checkpoint with relative path.
       model_checkpoint_path = os.path.join(ckpt_dir, ckpt.model_checkpoint_path)
-    # Assuming model_checkpoint_path looks something like:
-    #   /my-favorite-path/imagenet_train/model.ckpt-0,
-    # extract global_step from it.
-    global_step = ckpt.model_checkpoint_path.split('/')[-1].split('-')[-1]
-    if not global_step.isdigit():
-      global_step = 0
-    else:
-      global_step = int(global_step)
-    saver.restore(sess, model_checkpoint_path)
-    log_fn('Successfully loaded model from %s.' % ckpt.model_checkpoint_path)
-    return global_step
+    return restore_checkpoint(saver, sess, model_checkpoint_path)
   else:
     raise CheckpointNotFoundException('No checkpoint file found.')
 
@@ -753,6 +1393,9 @@ def validate_params(params):
   for name, value in params._asdict().items():
     param_spec = flags.param_specs[name]
     if param_spec.flag_type in ('integer', 'float'):
+      if value is None:
+        # Unset optional params have no bounds to check.
+        continue
       if (param_spec.kwargs['lower_bound'] is not None and
           value < param_spec.kwargs['lower_bound']):
         raise ValueError('Param %s value of %s is lower than the lower bound '
@@ -832,18 +1475,17 @@ def get_num_batches_and_epochs(params, batch_size, num_examples_per_epoch):
   return (num_batches, num_epochs)
 
 
-def get_piecewise_learning_rate(piecewise_learning_rate_schedule,
-                                global_step, num_batches_per_epoch):
-  """Returns a piecewise learning rate tensor.
+def get_piecewise_learning_rate_table(piecewise_learning_rate_schedule,
+                                      num_batches_per_epoch):
+  """Returns the learning rate table of a piecewise learning rate schedule.
 
   Args:
     piecewise_learning_rate_schedule: The --piecewise_learning_rate_schedule
       parameter
-    global_step: Scalar tensor representing the global step.
     num_batches_per_epoch: float indicating the number of batches per epoch.
 
   Returns:
-    A scalar float tensor, representing the learning rate.
+    A learning rate table, as returned by get_learning_rate_table.
 
   Raises:
     ValueError: piecewise_learning_rate_schedule is not formatted correctly.
@@ -853,7 +1495,7 @@ def get_piecewise_learning_rate(piecewise_learning_rate_schedule,
     raise ValueError('--piecewise_learning_rate_schedule must have an odd '
                      'number of components')
   values = []
-  boundaries = []
+  first_steps = [0]
   for i, piece in enumerate(pieces):
     if i % 2 == 0:
       try:
@@ -862,29 +1504,67 @@ def get_piecewise_learning_rate(piecewise_learning_rate_schedule,
         raise ValueError('Invalid learning rate: ' + piece)
     else:
       try:
-        boundaries.append(int(int(piece) * num_batches_per_epoch) - 1)
+        first_steps.append(int(int(piece) * num_batches_per_epoch))
       except ValueError:
         raise ValueError('Invalid epoch: ' + piece)
-  return tf.train.piecewise_constant(global_step, boundaries, values,
-                                     name='piecewise_learning_rate')
+      if first_steps[-1] < first_steps[-2]:
+        raise ValueError('The epochs of --piecewise_learning_rate_schedule '
+                         'must be increasing, but got: %s' %
+                         piecewise_learning_rate_schedule)
+  return [(first_step, value, 0., 1., 1)
+          for first_step, value in zip(first_steps, values)]
 
 
-def get_learning_rate(params, global_step, num_examples_per_epoch, model,
-                      batch_size):
-  """Returns a learning rate tensor based on global_step.
+def _get_exponential_decay_table(init_learning_rate, decay_steps, decay_factor,
+                                 minimum_learning_rate):
+  """Returns the learning rate table of a staircase exponential decay.
+
+  The decay is a single row, followed by a constant row from the first decay
+  that reaches minimum_learning_rate, if any.
+  """
+  if decay_steps < 1:
+    raise ValueError('--num_epochs_per_decay must be at least one step')
+  if init_learning_rate <= minimum_learning_rate:
+    return [(0, minimum_learning_rate, 0., 1., 1)]
+  if decay_factor == 1:
+    return [(0, init_learning_rate, 0., 1., 1)]
+  table = [(0, init_learning_rate, 0., decay_factor, decay_steps)]
+  if decay_factor < 1 and minimum_learning_rate > 0:
+    # The number of decays after which the learning rate is at most the
+    # minimum. The logarithm may be off by one due to rounding.
+    num_decays = max(1, int(math.ceil(
+        math.log(minimum_learning_rate / init_learning_rate) /
+        math.log(decay_factor))))
+    while (num_decays > 1 and init_learning_rate * decay_factor **
+           (num_decays - 1) <= minimum_learning_rate):
+      num_decays -= 1
+    while (init_learning_rate * decay_factor ** num_decays >
+           minimum_learning_rate):
+      num_decays += 1
+    table.append((num_decays * decay_steps, minimum_learning_rate, 0., 1., 1))
+  return table
+
+
+def get_learning_rate_table(params, num_examples_per_epoch, batch_size):
+  """Returns the learning rate schedule as a table of breakpoints.
+
+  The schedule is computed once, when the graph is built, instead of by ops
+  run every step. Each row of the table is a tuple (first_step, learning_rate,
+  increment_per_step, decay_factor, decay_steps). The learning rate at a step is
+  learning_rate * decay_factor ** floor((step - first_step) / decay_steps) +
+  increment_per_step * (step - first_step), for the last row whose first_step
+  is at most the step. A row either decays exponentially or changes linearly,
+  so the table has a few rows however long the schedule is.
 
   Args:
     params: Params tuple, typically created by make_params or
       make_params_from_flags.
-    global_step: Scalar tensor representing the global step.
     num_examples_per_epoch: The number of examples per epoch.
-    model: The model.Model object to obtain the default learning rate from if no
-      learning rate is specified.
     batch_size: Number of examples per step
 
   Returns:
-    A scalar float tensor, representing the learning rate. When evaluated, the
-    learning rate depends on the current value of global_step.
+    A list of rows, sorted by first_step. The first_step of the first row is 0.
+    None if the learning rate schedule is defined by the model.
 
   Raises:
     ValueError: Invalid or unsupported params.
@@ -896,45 +1576,133 @@ def get_learning_rate(params, global_step, num_examples_per_epoch, model,
         params.minimum_learning_rate or params.num_epochs_per_decay):
       raise ValueError('No other learning rate-related flags can be specified '
                        'if --piecewise_learning_rate_schedule is specified')
-    learning_rate = get_piecewise_learning_rate(
-        params.piecewise_learning_rate_schedule,
-        global_step, num_batches_per_epoch)
+    table = get_piecewise_learning_rate_table(
+        params.piecewise_learning_rate_schedule, num_batches_per_epoch)
   elif params.init_learning_rate:
-    learning_rate = params.init_learning_rate
     if (params.num_epochs_per_decay > 0 and
         params.learning_rate_decay_factor > 0):
       decay_steps = int(num_batches_per_epoch * params.num_epochs_per_decay)
-
-      # Decay the learning rate exponentially based on the number of steps.
-      learning_rate = tf.train.exponential_decay(
-          params.init_learning_rate,
-          global_step,
-          decay_steps,
-          params.learning_rate_decay_factor,
-          staircase=True)
-
-      if params.minimum_learning_rate != 0.:
-        learning_rate = tf.maximum(learning_rate,
-                                   params.minimum_learning_rate)
+      table = _get_exponential_decay_table(
+          params.init_learning_rate, decay_steps,
+          params.learning_rate_decay_factor, params.minimum_learning_rate)
+    else:
+      table = [(0, params.init_learning_rate, 0., 1., 1)]
   else:
-    learning_rate = model.get_learning_rate(global_step, batch_size)
-  if params.num_learning_rate_warmup_epochs > 0 and (
-      params.init_learning_rate or params.piecewise_learning_rate_schedule):
-    warmup_steps = int(num_batches_per_epoch *
-                       params.num_learning_rate_warmup_epochs)
-    init_lr = (params.init_learning_rate or
-               float(params.piecewise_learning_rate_schedule.split(';')[0]))
-    warmup_lr = init_lr * tf.cast(global_step, tf.float32) / tf.cast(
-        warmup_steps, tf.float32)
-    learning_rate = tf.cond(global_step < warmup_steps,
-                            lambda: warmup_lr, lambda: learning_rate)
+    return None
+  warmup_steps = int(num_batches_per_epoch *
+                     params.num_learning_rate_warmup_epochs)
+  if warmup_steps > 0:
+    # The learning rate increases linearly to the initial learning rate, and
+    # then follows the schedule from the row containing warmup_steps.
+    init_lr = table[0][1]
+    first_step, learning_rate, increment, decay_factor, decay_steps = [
+        row for row in table if row[0] <= warmup_steps][-1]
+    later_rows = [row for row in table if row[0] > warmup_steps]
+    warmup_rows = [(0, 0., init_lr / warmup_steps, 1., 1)]
+    if decay_factor == 1:
+      warmup_rows.append(
+          (warmup_steps,
+           learning_rate + increment * (warmup_steps - first_step),
+           increment, 1., 1))
+    else:
+      # Exponential rows have no increment. The decays stay aligned with the
+      # first step of the row, so the learning rate is constant from
+      # warmup_steps to the next decay.
+      num_decays = (warmup_steps - first_step) // decay_steps
+      decay_step = first_step + num_decays * decay_steps
+      if decay_step < warmup_steps:
+        warmup_rows.append(
+            (warmup_steps, learning_rate * decay_factor ** num_decays, 0., 1.,
+             1))
+        num_decays += 1
+        decay_step += decay_steps
+      if not later_rows or decay_step < later_rows[0][0]:
+        warmup_rows.append(
+            (decay_step, learning_rate * decay_factor ** num_decays, 0.,
+             decay_factor, decay_steps))
+    table = warmup_rows + later_rows
+  return table
+
+
+def get_learning_rate_from_table(table, global_step):
+  """Returns a learning rate tensor, looking up global_step in `table`.
+
+  Args:
+    table: A learning rate table, as returned by get_learning_rate_table.
+    global_step: Scalar tensor representing the global step.
+
+  Returns:
+    A scalar float32 tensor. It is computed by comparing global_step with the
+    first step of each row and gathering a single row.
+  """
+  with tf.name_scope('learning_rate_table'):
+    table = np.array(table, dtype=np.float64)
+    step = tf.cast(global_step, tf.float64)
+    row_index = tf.reduce_sum(
+        tf.cast(tf.greater_equal(step, table[1:, 0]), tf.int32))
+    row = tf.gather(tf.constant(table), row_index)
+    steps_in_row = step - row[0]
+    learning_rate = (row[1] * tf.pow(row[3], tf.floor(steps_in_row / row[4])) +
+                     row[2] * steps_in_row)
+    return tf.cast(learning_rate, tf.float32)
+
+
+def get_learning_rate(params, global_step, num_examples_per_epoch, model,
+                      batch_size):
+  """Returns a learning rate tensor based on global_step.
+
+  Args:
+    params: Params tuple, typically created by make_params or
+      make_params_from_flags.
+    global_step: Scalar tensor representing the global step.
+    num_examples_per_epoch: The number of examples per epoch.
+    model: The model.Model object to obtain the default learning rate from if no
+      learning rate is specified.
+    batch_size: Number of examples per step
 
-  return learning_rate
+  Returns:
+    A scalar float tensor, representing the learning rate. When evaluated, the
+    learning rate depends on the current value of global_step.
+
+  Raises:
+    ValueError: Invalid or unsupported params.
+  """
+  table = get_learning_rate_table(params, num_examples_per_epoch, batch_size)
+  if table is None:
+    return model.get_learning_rate(global_step, batch_size)
+  return get_learning_rate_from_table(table, global_step)
+
+
+def get_l2_loss_shards(params, num_shards):
+  """Splits `params` into `num_shards` shards of roughly equal size.
+
+  Params are assigned greedily, largest first, to the shard with the fewest
+  elements so far. The result only depends on the shapes of `params`, so it is
+  the same for every device's copy of the variables.
+
+  Args:
+    params: A list of variables or tensors with fully defined shapes.
+    num_shards: The number of shards.
+  Returns:
+    A list of `num_shards` lists of indices into `params`. Each list is sorted.
+  """
+  shards = [[] for _ in xrange(num_shards)]
+  shard_sizes = [0] * num_shards
+  sizes = [p.get_shape().num_elements() for p in params]
+  for i in sorted(xrange(len(params)), key=lambda i: (-sizes[i], i)):
+    shard = shard_sizes.index(min(shard_sizes))
+    shards[shard].append(i)
+    shard_sizes[shard] += sizes[i]
+  return [sorted(shard) for shard in shards]
 
 
 def get_optimizer(params, learning_rate):
   """Returns the optimizer that should be used based on params."""
-  if params.optimizer == 'momentum':
+  if params.fused_optimizer and params.optimizer in ('momentum', 'sgd'):
+    momentum = params.momentum if params.optimizer == 'momentum' else 0.
+    opt = variable_mgr_util.FusedMomentumOptimizer(
+        learning_rate, momentum, use_nesterov=True)
+  elif params.optimizer == 'momentum':
     opt = tf.train.MomentumOptimizer(
         learning_rate, params.momentum, use_nesterov=True)
   elif params.optimizer == 'sgd':
@@ -974,6 +1742,162 @@ def generate_tfprof_profile(profiler, tfprof_file):
   profiler.profile_operations(options)
 
 
+def get_peak_process_memory_bytes():
+  """Returns the peak resident set size of this process, in bytes."""
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in kilobytes on other platforms.
+  return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# Layouts chosen by --data_format=auto in this process, keyed by
+# _data_format_cache_key.
+_data_format_cache = {}
+
+
+def _get_device_description(params):
+  """Returns the model name of the devices of type params.device.
+
+  GPUs are described by the names in their physical device descriptions, e.g.
+  "Tesla V100-SXM2-16GB", and CPUs by the model name in /proc/cpuinfo, so that
+  layouts timed on one machine are not reused on a different one.
+
+  Args:
+    params: Params tuple, typically created by make_params or
+      make_params_from_flags.
+
+  Returns:
+    A string describing the devices the model runs on.
+  """
+  if params.device == 'cpu':
+    try:
+      with open('/proc/cpuinfo') as f:
+        match = re.search(r'^model name\s*:\s*(.*)$', f.read(), re.MULTILINE)
+    except IOError:
+      match = None
+    return match.group(1).strip() if match else platform.processor()
+  names = set()
+  for device in device_lib.list_local_devices(create_config_proto(params)):
+    if device.device_type == params.device.upper():
+      match = re.search(r'name: ([^,]+)', device.physical_device_desc)
+      names.add(match.group(1) if match else device.physical_device_desc)
+  return ','.join(sorted(names))
+
+
+def _data_format_cache_key(params, model):
+  """Returns the key under which the layout chosen for `model` is cached."""
+  device = params.device + ('_mkl' if params.mkl else '')
+  tf_build = '%s-%s' % (tf.__version__, getattr(tf, 'GIT_VERSION', ''))
+  return '%s|%s|%s|%s' % (model.get_model(), device,
+                          _get_device_description(params), tf_build)
+
+
+def _read_data_format_cache_file(filename):
+  if not filename or not gfile.Exists(filename):
+    return {}
+  with gfile.Open(filename, 'r') as f:
+    return json.load(f)
+
+
+def _write_data_format_cache_file(filename, cache):
+  with gfile.Open(filename, 'w') as f:
+    json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def time_data_format(params, model, dataset, data_format, batch_size):
+  """Returns the average time of a step of `model` in `data_format`.
+
+  A single-device graph is built on synthetic images that are already in
+  `data_format`, so that only the cost of the network itself is measured.
+
+  Args:
+    params: Params tuple, typically created by make_params or
+            make_params_from_flags.
+    model: The model to time.
+    dataset: The dataset the model is run on.
+    data_format: 'NCHW' or 'NHWC'.
+    batch_size: The per-device batch size.
+  """
+  data_type = get_data_type(params)
+  image_size = model.get_image_size()
+  nclass = dataset.num_classes
+  if data_format == 'NCHW':
+    image_shape = [batch_size, dataset.depth, image_size, image_size]
+  else:
+    image_shape = [batch_size, image_size, image_size, dataset.depth]
+  phase_train = not (params.eval or params.forward_only)
+  with tf.Graph().as_default():
+    with tf.device('/%s:0' % params.device):
+      images = tf.truncated_normal(image_shape, dtype=data_type, mean=127,
+                                   stddev=60)
+      labels = tf.random_uniform([batch_size], minval=0, maxval=nclass - 1,
+                                 dtype=tf.int32)
+      with tf.variable_scope('v0'):
+        logits, aux_logits = model.build_network(
+            images, phase_train, nclass, dataset.depth, data_type,
+            data_format, params.use_tf_layers, params.fp16_vars,
+            input_data_format=data_format)
+      if phase_train:
+        loss_func = model.loss_function or loss_function
+        loss = loss_func(logits, labels, aux_logits=aux_logits)
+        grads = tf.gradients(loss, tf.trainable_variables())
+        fetch = tf.group(*[g for g in grads if g is not None])
+      else:
+        fetch = logits.op
+    with tf.Session(config=create_config_proto(params)) as sess:
+      sess.run([tf.global_variables_initializer(),
+                tf.local_variables_initializer()])
+      for _ in xrange(_NUM_DATA_FORMAT_AUTO_WARMUP_STEPS):
+        sess.run(fetch)
+      start_time = time.time()
+      for _ in xrange(_NUM_DATA_FORMAT_AUTO_STEPS):
+        sess.run(fetch)
+      return (time.time() - start_time) / _NUM_DATA_FORMAT_AUTO_STEPS
+
+
+def choose_data_format(params, model, dataset, batch_size):
+  """Returns the fastest data format for `model` on `params.device`.
+
+  The choice is cached per (model, device type and model name, TensorFlow
+  build), in this process and, if --data_format_cache_file is set, on disk.
+
+  Args:
+    params: Params tuple, typically created by make_params or
+            make_params_from_flags.
+    model: The model to choose the data format for.
+    dataset: The dataset the model is run on.
+    batch_size: The per-device batch size.
+  """
+  key = _data_format_cache_key(params, model)
+  if key not in _data_format_cache:
+    _data_format_cache.update(
+        _read_data_format_cache_file(params.data_format_cache_file))
+  if key in _data_format_cache:
+    data_format = _data_format_cache[key]
+    log_fn('Using cached data format %s for %s' % (data_format, key))
+    return data_format
+
+  if params.device == 'cpu' and not params.mkl:
+    # NCHW is not supported on CPU without MKL.
+    candidates = ['NHWC']
+  else:
+    candidates = ['NCHW', 'NHWC']
+  step_times = {}
+  for candidate in candidates:
+    step_times[candidate] = time_data_format(params, model, dataset,
+                                             candidate, batch_size)
+    log_fn('data_format %s: %.1f ms/step' %
+           (candidate, step_times[candidate] * 1000))
+  data_format = min(candidates, key=lambda c: step_times[c])
+  log_fn('Chose data format %s for %s' % (data_format, key))
+
+  _data_format_cache[key] = data_format
+  if params.data_format_cache_file:
+    cache = _read_data_format_cache_file(params.data_format_cache_file)
+    cache[key] = data_format
+    _write_data_format_cache_file(params.data_format_cache_file, cache)
+  return data_format
+
+
 class BenchmarkCNN(object):
   """Class for benchmarking a cnn network."""
 
@@ -996,6 +1920,10 @@ class BenchmarkCNN(object):
     self.model = model or model_config.get_model_config(self.params.model,
                                                         self.dataset)
     self.trace_filename = self.params.trace_file
+    if self.params.data_format == 'auto':
+      self.params = self.params._replace(data_format=choose_data_format(
+          self.params, self.model, self.dataset,
+          self.params.batch_size or self.model.get_batch_size()))
     self.data_format = self.params.data_format
     self.enable_layout_optimizer = self.params.enable_layout_optimizer
     self.rewriter_config = self.params.rewriter_config
@@ -1071,10 +1999,15 @@ class BenchmarkCNN(object):
       self.model.set_batch_size(self.params.batch_size)
     self.batch_size = self.model.get_batch_size() * self.num_gpus
     self.batch_group_size = self.params.batch_group_size
+    self.gradient_accumulation_steps = self.params.gradient_accumulation_steps
+    # The fetches to run for all but the last micro-batch of each step when
+    # accumulating gradients. Set by _build_fetches.
+    self.accumulation_fetches = None
     self.enable_auto_loss_scale = (
         self.params.use_fp16 and self.params.fp16_enable_auto_loss_scale)
     self.loss_scale = None
     self.loss_scale_normal_steps = None
+    self.loss_scale_skipped_steps = None
 
     self.job_name = self.params.job_name  # "" for local training
 
@@ -1141,8 +2074,98 @@ class BenchmarkCNN(object):
 
     subset = 'validation' if params.eval else 'train'
     self.num_batches, self.num_epochs = get_num_batches_and_epochs(
-        params, self.batch_size * self.num_workers,
+        params,
+        self.batch_size * self.num_workers * self.gradient_accumulation_steps,
         self.dataset.num_examples_per_epoch(subset))
+    if self.params.eval and self.params.eval_full_pass:
+      num_examples = self.dataset.num_examples_per_epoch(subset)
+      self.num_batches = int(math.ceil(float(num_examples) / self.batch_size))
+      self.num_epochs = 1.
+
+    if self.params.fused_optimizer:
+      if self.params.optimizer not in ('momentum', 'sgd'):
+        raise ValueError('--fused_optimizer is only supported with '
+                         '--optimizer=momentum or --optimizer=sgd')
+      if self.params.staged_vars:
+        raise ValueError('--fused_optimizer is not supported with '
+                         '--staged_vars')
+      if self.params.shard_optimizer_state:
+        # The flat momentum of a device is not an optimizer slot, so it would
+        # not be saved with the variables owned by that device.
+        raise ValueError('--fused_optimizer is not supported with '
+                         '--shard_optimizer_state')
+
+    if (self.params.shard_l2_loss and
+        self.params.variable_update == 'independent'):
+      raise ValueError('--shard_l2_loss is not supported with '
+                       '--variable_update=independent, since each device '
+                       'applies its own gradients')
+
+    if self.gradient_accumulation_steps > 1:
+      if self.params.staged_vars:
+        raise ValueError('--gradient_accumulation_steps is not supported with '
+                         '--staged_vars')
+      if self.params.variable_update == 'horovod':
+        raise ValueError('--gradient_accumulation_steps is not supported with '
+                         '--variable_update=horovod')
+
+    if self.params.async_checkpoint and self.params.sharded_checkpoint:
+      # The background thread writes a copy of the variables on the CPU, so
+      # the checkpoint would have a single shard.
+      raise ValueError('--async_checkpoint is not supported with '
+                       '--sharded_checkpoint')
+
+    if (self.params.eval and self.params.eval_cache_dir and
+        not self.params.use_datasets):
+      raise ValueError('--eval_cache_dir requires --use_datasets')
+
+    if self.params.eval_full_pass and not self.params.use_datasets:
+      raise ValueError('--eval_full_pass requires --use_datasets')
+    if self.params.eval_full_pass and self.num_workers > 1:
+      # Each worker would need its own number of batches and padding, since
+      # the validation set is not split evenly across workers.
+      raise ValueError('--eval_full_pass is only supported on a single worker')
+    if any(float(scale) < 1 for scale in self.params.eval_crop_scales):
+      raise ValueError('--eval_crop_scales must be at least 1, but got %s' %
+                       ','.join(self.params.eval_crop_scales))
+
+    if self.params.use_fp16 and self.params.compute_dtype != 'float32':
+      raise ValueError('--use_fp16 cannot be used with --compute_dtype=%s' %
+                       self.params.compute_dtype)
+
+    if self.params.shard_optimizer_state:
+      if self.params.variable_update != 'replicated':
+        raise ValueError('--shard_optimizer_state requires '
+                         '--variable_update=replicated')
+      if self.params.all_reduce_spec or self.params.hierarchical_copy:
+        raise ValueError('--shard_optimizer_state sums the gradients on the '
+                         'devices owning the variables, so it cannot be used '
+                         'with --all_reduce_spec or --hierarchical_copy')
+      if self.params.variable_consistency == 'relaxed':
+        raise ValueError('--shard_optimizer_state cannot be used with '
+                         '--variable_consistency=relaxed')
+
+    if self.params.xla_compile_scope != 'global' and not self.params.xla:
+      raise ValueError('--xla_compile_scope requires --xla')
+
+    if self.params.graph_cache_dir:
+      if self.params.eval:
+        raise ValueError('--graph_cache_dir cannot be used with --eval')
+      if (self.job_name or
+          self.params.variable_update in ('horovod',
+                                          'distributed_all_reduce')):
+        raise ValueError('--graph_cache_dir is only supported on a single '
+                         'host')
+
+    if self.params.eval_during_training_every_n_steps:
+      if self.params.eval or self.params.forward_only:
+        raise ValueError('--eval_during_training_every_n_steps cannot be used '
+                         'with --eval or --forward_only')
+      if self.job_name or self.params.variable_update == 'horovod':
+        raise ValueError('--eval_during_training_every_n_steps is only '
+                         'supported on a single host')
+      if self.params.num_eval_gpus and self.params.device == 'cpu':
+        raise ValueError('--num_eval_gpus is not supported with --device=cpu')
 
     if (self.params.staged_vars and
         self.params.variable_update != 'parameter_server'):
@@ -1170,7 +2193,8 @@ class BenchmarkCNN(object):
       self.variable_mgr = variable_mgr.VariableMgrLocalReplicated(
           self, self.params.all_reduce_spec,
           self.params.agg_small_grads_max_bytes,
-          self.params.agg_small_grads_max_group)
+          self.params.agg_small_grads_max_group,
+          shard_optimizer_state=self.params.shard_optimizer_state)
     elif self.params.variable_update == 'distributed_all_reduce':
       assert self.params.cross_replica_sync
       self.variable_mgr = variable_mgr.VariableMgrDistributedAllReduce(
@@ -1204,7 +2228,25 @@ class BenchmarkCNN(object):
     else:
       self.global_step_device = self.cpu_device
 
+    if self.params.input_autotune:
+      self.params = self._autotune_input_pipeline()
     self.image_preprocessor = self.get_image_preprocessor()
+    if (self.params.vectorized_distortions and
+        not self.image_preprocessor.supports_vectorized_distortions()):
+      raise ValueError('--vectorized_distortions is not supported by the %s '
+                       'input preprocessor for dataset %s' %
+                       (self.params.input_preprocessor, self.dataset.name))
+    if (self.params.eval_full_pass and
+        not self.image_preprocessor.supports_datasets()):
+      raise ValueError('--eval_full_pass is not supported by the %s input '
+                       'preprocessor for dataset %s' %
+                       (self.params.input_preprocessor, self.dataset.name))
+    if ((self.params.eval_crop_mode != 'central' or
+         self.params.eval_crop_scales != ['1.15']) and
+        not self.image_preprocessor.supports_eval_crops()):
+      raise ValueError('--eval_crop_mode and --eval_crop_scales are not '
+                       'supported by the %s input preprocessor for dataset %s' %
+                       (self.params.input_preprocessor, self.dataset.name))
     self.datasets_use_prefetch = (
         self.params.datasets_use_prefetch and
         self.image_preprocessor.supports_datasets())
@@ -1256,6 +2298,9 @@ class BenchmarkCNN(object):
     if self.batch_group_size > 1:
       log_fn('             %d batches per prepocessing group' %
              self.batch_group_size)
+    if self.gradient_accumulation_steps > 1:
+      log_fn('             %d micro-batches per step' %
+             self.gradient_accumulation_steps)
     log_fn('Num batches: %d' % self.num_batches)
     log_fn('Num epochs:  %.2f' % self.num_epochs)
     log_fn('Devices:     %s' % device_list)
@@ -1306,102 +2351,177 @@ class BenchmarkCNN(object):
         return self._benchmark_cnn()
 
   def _eval_cnn(self):
-    """Evaluate a model every self.params.eval_interval_secs.
+    """Evaluate a model every time a new checkpoint is saved.
+
+    A single session and input pipeline are used for all evaluations. If
+    --eval_interval_secs is 0, only the latest checkpoint is evaluated.
+    Otherwise, --train_dir is watched for new checkpoints, and each one is
+    restored and evaluated. If several checkpoints are saved during an
+    evaluation, only the latest one is evaluated next.
 
     Returns:
       Dictionary containing eval statistics. Currently returns an empty
       dictionary.
     """
+    if self.params.train_dir is None:
+      raise ValueError('Trained model directory not specified')
     if self.datasets_use_prefetch:
       (image_producer_ops, enqueue_ops, fetches) = (
           self._build_model_with_dataset_prefetching())
     else:
       (image_producer_ops, enqueue_ops, fetches) = self._build_model()
-    saver = tf.train.Saver(self.variable_mgr.savable_variables())
+    if self.params.eval_cache_dir:
+      gfile.MakeDirs(self.params.eval_cache_dir)
+    saver = tf.train.Saver(self.variable_mgr.savable_variables(),
+                           sharded=self.params.sharded_checkpoint)
     summary_writer = tf.summary.FileWriter(self.params.eval_dir,
                                            tf.get_default_graph())
     target = ''
     local_var_init_op = tf.local_variables_initializer()
     table_init_ops = tf.tables_initializer()
-    variable_mgr_init_ops = [local_var_init_op]
+    local_var_init_ops = [local_var_init_op]
     if table_init_ops:
-      variable_mgr_init_ops.extend([table_init_ops])
-    with tf.control_dependencies([local_var_init_op]):
-      variable_mgr_init_ops.extend(self.variable_mgr.get_post_init_ops())
-    local_var_init_op_group = tf.group(*variable_mgr_init_ops)
+      local_var_init_ops.extend([table_init_ops])
+    local_var_init_op_group = tf.group(*local_var_init_ops)
+    # The post init ops copy the restored variables to the other devices, so
+    # they are run after every restore.
+    post_init_op_group = tf.group(*self.variable_mgr.get_post_init_ops())
     summary_op = tf.summary.merge_all()
     # TODO(huangyp): Check if checkpoints haven't updated for hours and abort.
-    while True:
-      self._eval_once(saver, summary_writer, target, local_var_init_op_group,
-                      image_producer_ops, enqueue_ops, fetches, summary_op)
-      if self.params.eval_interval_secs <= 0:
-        break
-      time.sleep(self.params.eval_interval_secs)
+    try:
+      with tf.Session(
+          target=target, config=create_config_proto(self.params)) as sess:
+        sess.run(local_var_init_op_group)
+        if self.dataset.queue_runner_required():
+          tf.train.start_queue_runners(sess=sess)
+        image_producer = None
+        try:
+          for global_step in self._restore_new_checkpoints(saver, sess):
+            sess.run(post_init_op_group)
+            if image_producer is None and image_producer_ops is not None:
+              image_producer = cnn_util.ImageProducer(
+                  sess, image_producer_ops, self.batch_group_size,
+                  self.params.use_python32_barrier)
+              image_producer.start()
+              for i in xrange(len(enqueue_ops)):
+                sess.run(enqueue_ops[:(i + 1)])
+                image_producer.notify_image_consumption()
+            self._eval_once(sess, summary_writer, fetches, summary_op,
+                            image_producer, global_step)
+        finally:
+          if image_producer is not None:
+            image_producer.done()
+    finally:
+      if self.params.eval_cache_dir:
+        # The session is closed, so the cache is no longer being written.
+        data_utils.finalize_eval_cache(self._get_eval_cache_file())
     return {}
 
-  def _eval_once(self, saver, summary_writer, target, local_var_init_op_group,
-                 image_producer_ops, enqueue_ops, fetches, summary_op):
-    """Evaluate the model from a checkpoint using validation dataset."""
-    with tf.Session(
-        target=target, config=create_config_proto(self.params)) as sess:
-      if self.params.train_dir is None:
-        raise ValueError('Trained model directory not specified')
+  def _restore_new_checkpoints(self, saver, sess):
+    """Restores checkpoints from --train_dir as they are saved.
+
+    Args:
+      saver: The tf.train.Saver to restore the checkpoints with.
+      sess: The session to restore the checkpoints into.
+    Yields:
+      The global step of each restored checkpoint, after it is restored.
+    """
+    if self.params.eval_interval_secs <= 0:
       try:
-        global_step = load_checkpoint(saver, sess, self.params.train_dir)
+        yield load_checkpoint(saver, sess, self.params.train_dir)
       except CheckpointNotFoundException:
         log_fn('Checkpoint not found in %s' % self.params.train_dir)
-        return
-      sess.run(local_var_init_op_group)
-      if self.dataset.queue_runner_required():
-        tf.train.start_queue_runners(sess=sess)
-      image_producer = None
-      if image_producer_ops is not None:
-        image_producer = cnn_util.ImageProducer(
-            sess, image_producer_ops, self.batch_group_size,
-            self.params.use_python32_barrier)
-        image_producer.start()
-        for i in xrange(len(enqueue_ops)):
-          sess.run(enqueue_ops[:(i + 1)])
-          image_producer.notify_image_consumption()
-      loop_start_time = start_time = time.time()
-      top_1_accuracy_sum = 0.0
-      top_5_accuracy_sum = 0.0
-      total_eval_count = self.num_batches * self.batch_size
-      for step in xrange(self.num_batches):
-        if (self.params.save_summaries_steps > 0 and
-            (step + 1) % self.params.save_summaries_steps == 0):
-          results, summary_str = sess.run([fetches, summary_op])
-          summary_writer.add_summary(summary_str)
-        else:
-          results = sess.run(fetches)
-        top_1_accuracy_sum += results['top_1_accuracy']
-        top_5_accuracy_sum += results['top_5_accuracy']
-        if (step + 1) % self.params.display_every == 0:
-          duration = time.time() - start_time
-          examples_per_sec = (
-              self.batch_size * self.params.display_every / duration)
-          log_fn('%i\t%.1f examples/sec' % (step + 1, examples_per_sec))
-          start_time = time.time()
-        if image_producer is not None:
-          image_producer.notify_image_consumption()
-      loop_end_time = time.time()
+      return
+    watcher = cnn_util.CheckpointWatcher(self.params.train_dir,
+                                         self.params.eval_interval_secs)
+    while True:
+      checkpoint_path = watcher.wait_for_new_checkpoint()
+      yield restore_checkpoint(saver, sess, checkpoint_path)
+
+  def _eval_once(self, sess, summary_writer, fetches, summary_op,
+                 image_producer, global_step, log=None):
+    """Evaluate the restored model on self.num_batches validation batches.
+
+    Args:
+      sess: The session to run the eval in.
+      summary_writer: The tf.summary.FileWriter to write the results to.
+      fetches: The fetches of the eval model.
+      summary_op: The summary op to run every --save_summaries_steps steps.
+      image_producer: The cnn_util.ImageProducer of the eval model, or None.
+      global_step: The global step of the model being evaluated.
+      log: The function to log with. Defaults to log_fn.
+    Returns:
+      A dictionary with the top_1_accuracy, top_5_accuracy, images_per_sec and
+      num_examples of the eval.
+    """
+    log = log or log_fn
+    loop_start_time = start_time = time.time()
+    top_1_accuracy_sum = 0.0
+    top_5_accuracy_sum = 0.0
+    total_eval_count = 0
+    for step in xrange(self.num_batches):
+      if (self.params.save_summaries_steps > 0 and
+          (step + 1) % self.params.save_summaries_steps == 0):
+        results, summary_str = sess.run([fetches, summary_op])
+        summary_writer.add_summary(summary_str)
+      else:
+        results = sess.run(fetches)
+      top_1_accuracy_sum += results['top_1_accuracy']
+      top_5_accuracy_sum += results['top_5_accuracy']
+      # With --eval_full_pass, the last batch is partly padding, which is not
+      # counted.
+      total_eval_count += results.get('num_examples', self.batch_size)
+      if (step + 1) % self.params.display_every == 0:
+        duration = time.time() - start_time
+        examples_per_sec = (
+            self.batch_size * self.params.display_every / duration)
+        log('%i\t%.1f examples/sec' % (step + 1, examples_per_sec))
+        start_time = time.time()
       if image_producer is not None:
-        image_producer.done()
-      accuracy_at_1 = top_1_accuracy_sum / self.num_batches
-      accuracy_at_5 = top_5_accuracy_sum / self.num_batches
-      summary = tf.Summary()
-      summary.value.add(tag='eval/Accuracy@1', simple_value=accuracy_at_1)
-      summary.value.add(tag='eval/Accuracy@5', simple_value=accuracy_at_5)
-      summary_writer.add_summary(summary, global_step)
-      log_fn('Accuracy @ 1 = %.4f Accuracy @ 5 = %.4f [%d examples]' %
-             (accuracy_at_1, accuracy_at_5, total_eval_count))
-      elapsed_time = loop_end_time - loop_start_time
-      images_per_sec = (self.num_batches * self.batch_size / elapsed_time)
-      # Note that we compute the top 1 accuracy and top 5 accuracy for each
-      # batch, which will have a slight performance impact.
-      log_fn('-' * 64)
-      log_fn('total images/sec: %.2f' % images_per_sec)
-      log_fn('-' * 64)
+        image_producer.notify_image_consumption()
+    loop_end_time = time.time()
+    # The accuracies of each batch are the fraction of all batch_size images
+    # that are correct, including padding, so they are summed and divided by
+    # the number of real images.
+    accuracy_at_1 = top_1_accuracy_sum * self.batch_size / total_eval_count
+    accuracy_at_5 = top_5_accuracy_sum * self.batch_size / total_eval_count
+    summary = tf.Summary()
+    summary.value.add(tag='eval/Accuracy@1', simple_value=accuracy_at_1)
+    summary.value.add(tag='eval/Accuracy@5', simple_value=accuracy_at_5)
+    summary_writer.add_summary(summary, global_step)
+    log('Accuracy @ 1 = %.4f Accuracy @ 5 = %.4f [%d examples]' %
+        (accuracy_at_1, accuracy_at_5, total_eval_count))
+    elapsed_time = loop_end_time - loop_start_time
+    images_per_sec = total_eval_count / elapsed_time
+    # Note that we compute the top 1 accuracy and top 5 accuracy for each
+    # batch, which will have a slight performance impact.
+    log('-' * 64)
+    log('eval mode: %s' % self._get_eval_mode_str())
+    log('total images/sec: %.2f' % images_per_sec)
+    num_crops = self.image_preprocessor.num_crops_per_image()
+    if num_crops > 1:
+      log('total crops/sec: %.2f' % (images_per_sec * num_crops))
+    log('-' * 64)
+    return {
+        'top_1_accuracy': accuracy_at_1,
+        'top_5_accuracy': accuracy_at_5,
+        'images_per_sec': images_per_sec,
+        'num_examples': total_eval_count
+    }
+
+  def _get_eval_mode_str(self):
+    """Returns a description of the eval settings, for the eval results."""
+    if self.params.eval_full_pass:
+      mode = 'full pass'
+    else:
+      mode = '%d batches' % self.num_batches
+    if self.params.eval_crop_mode == 'ten_crop':
+      mode += ', ten crops'
+    else:
+      mode += ', central crop'
+    if self.params.eval_crop_scales != ['1.15']:
+      mode += ' at scales %s' % ','.join(self.params.eval_crop_scales)
+    return mode
 
   def _benchmark_cnn(self):
     """Run cnn in benchmark mode. Skip the backward pass if forward_only is on.
@@ -1410,55 +2530,33 @@ class BenchmarkCNN(object):
       Dictionary containing training statistics (num_workers, num_steps,
       average_wall_time, images_per_sec).
     """
-    if self.params.variable_update == 'distributed_all_reduce':
-      self.single_session = True
-      if self.datasets_use_prefetch:
-        (image_producer_ops, enqueue_ops, fetches) = (
-            self._build_model_single_session_with_dataset_prefetching())
-      else:
-        (image_producer_ops, enqueue_ops, fetches) = (
-            self._build_model_single_session())
-    else:
-      self.single_session = False
-      if self.datasets_use_prefetch:
-        (image_producer_ops, enqueue_ops, fetches) = (
-            self._build_model_with_dataset_prefetching())
-      else:
-        (image_producer_ops, enqueue_ops, fetches) = self._build_model()
-    fetches_list = nest.flatten(list(fetches.values()))
-    main_fetch_group = tf.group(*fetches_list)
-    execution_barrier = None
-    if (not self.single_session and self.job_name and
-        not self.params.cross_replica_sync):
-      execution_barrier = self.add_sync_queues_and_barrier(
-          'execution_barrier_', [])
-
-    global_step = tf.train.get_global_step()
-    with tf.device(self.global_step_device):
-      with tf.control_dependencies([main_fetch_group]):
-        fetches['inc_global_step'] = global_step.assign_add(1)
-
-    if ((not self.single_session) and self.job_name and
-        self.params.cross_replica_sync):
-      # Block all replicas until all replicas are ready for next step.
-      fetches['sync_queues'] = self.add_sync_queues_and_barrier(
-          'sync_queues_step_end_', [main_fetch_group])
-
-    local_var_init_op = tf.local_variables_initializer()
-    table_init_ops = tf.tables_initializer()
-    variable_mgr_init_ops = [local_var_init_op]
-    if table_init_ops:
-      variable_mgr_init_ops.extend([table_init_ops])
-    with tf.control_dependencies([local_var_init_op]):
-      variable_mgr_init_ops.extend(self.variable_mgr.get_post_init_ops())
-    if (not self.single_session and self.job_name and
-        self.params.cross_replica_sync):
-      # Ensure all workers execute variable_mgr_init_ops before they start
-      # executing the model.
-      variable_mgr_init_ops.append(
-          self.add_sync_queues_and_barrier('init_ops_end_',
-                                           variable_mgr_init_ops))
-    local_var_init_op_group = tf.group(*variable_mgr_init_ops)
+    if self.params.learning_rate_table_file and self.task_index == 0:
+      self._write_learning_rate_table(self.params.learning_rate_table_file)
+    startup_secs = OrderedDict()
+    start_time = time.time()
+    self.single_session = (
+        self.params.variable_update == 'distributed_all_reduce')
+    graph_handles = None
+    graph_cache_path = None
+    if self.params.graph_cache_dir:
+      graph_cache_path = self._get_graph_cache_path()
+      if gfile.Exists(graph_cache_path):
+        graph_handles = self._import_graph(graph_cache_path)
+        startup_secs['import_graph'] = time.time() - start_time
+    if graph_handles is None:
+      graph_handles = self._build_graph()
+      startup_secs['build_graph'] = time.time() - start_time
+      if graph_cache_path:
+        self._export_graph(graph_cache_path, graph_handles)
+    image_producer_ops = graph_handles['image_producer_ops']
+    enqueue_ops = graph_handles['enqueue_ops']
+    fetches = graph_handles['fetches']
+    execution_barrier = graph_handles['execution_barrier']
+    global_step = graph_handles['global_step']
+    summary_op = graph_handles['summary_op']
+    peak_memory_ops = graph_handles['peak_memory_ops']
+    savable_variables = graph_handles['savable_variables']
+    self.accumulation_fetches = graph_handles['accumulation_fetches']
 
     if self.params.variable_update == 'horovod':
       import horovod.tensorflow as hvd  # pylint: disable=g-import-not-at-top
@@ -1468,12 +2566,16 @@ class BenchmarkCNN(object):
     else:
       is_chief = (not self.job_name or self.task_index == 0)
 
-    summary_op = tf.summary.merge_all()
     summary_writer = None
     if (is_chief and self.params.summary_verbosity and self.params.train_dir and
         self.params.save_summaries_steps > 0):
       summary_writer = tf.summary.FileWriter(self.params.train_dir,
                                              tf.get_default_graph())
+    async_summary_writer = None
+    if (summary_writer and summary_op is not None and
+        self.params.async_summaries):
+      async_summary_writer = cnn_util.AsyncSummaryWriter(
+          summary_op, global_step, summary_writer)
 
     # We want to start the benchmark timer right after a image_producer barrier
     # and avoids undesired waiting times on barriers.
@@ -1490,24 +2592,21 @@ class BenchmarkCNN(object):
     # We run the summaries in the same thread as the training operations by
     # passing in None for summary_op to avoid a summary_thread being started.
     # Running summaries and training operations in parallel could run out of
-    # GPU memory.
+    # GPU memory. With --async_summaries, the summary ops run in a background
+    # thread, but with the summarized tensors fed, so the model is not run
+    # again.
     saver = tf.train.Saver(
-        self.variable_mgr.savable_variables(), save_relative_paths=True)
-    ready_for_local_init_op = None
-    if self.job_name and not self.single_session:
-      # In distributed mode, we don't want to run local_var_init_op_group until
-      # the global variables are initialized, because local_var_init_op_group
-      # may use global variables (such as in distributed replicated mode). We
-      # don't set this in non-distributed mode, because in non-distributed mode,
-      # local_var_init_op_group may itself initialize global variables (such as
-      # in replicated mode).
-      ready_for_local_init_op = tf.report_uninitialized_variables(
-          tf.global_variables())
-    if self.params.variable_update == 'horovod':
-      import horovod.tensorflow as hvd  # pylint: disable=g-import-not-at-top
-      bcast_global_variables_op = hvd.broadcast_global_variables(0)
-    else:
-      bcast_global_variables_op = None
+        savable_variables, save_relative_paths=True,
+        sharded=self.params.sharded_checkpoint)
+    evaluator = None
+    if self.params.eval_during_training_every_n_steps:
+      evaluator = ConcurrentEvaluator(self._get_eval_during_training_bench(),
+                                      savable_variables)
+    async_saver = None
+    if self.params.async_checkpoint and self.params.train_dir and is_chief:
+      async_saver = cnn_util.AsyncCheckpointSaver(
+          savable_variables, save_relative_paths=True)
+    start_time = time.time()
     sv = tf.train.Supervisor(
         # For the purpose of Supervisor, all Horovod workers are 'chiefs',
         # since we want session to be initialized symmetrically on all the
@@ -1516,12 +2615,14 @@ class BenchmarkCNN(object):
         # Log dir should be unset on non-chief workers to prevent Horovod
         # workers from corrupting each other's checkpoints.
         logdir=self.params.train_dir if is_chief else None,
-        ready_for_local_init_op=ready_for_local_init_op,
-        local_init_op=local_var_init_op_group,
+        ready_for_local_init_op=graph_handles['ready_for_local_init_op'],
+        local_init_op=graph_handles['local_init_op'],
         saver=saver,
         global_step=global_step,
         summary_op=None,
-        save_model_secs=self.params.save_model_secs,
+        # With --async_checkpoint, checkpoints are saved by the training loop.
+        save_model_secs=(0 if self.params.async_checkpoint
+                         else self.params.save_model_secs),
         summary_writer=summary_writer)
 
     step_train_times = []
@@ -1533,8 +2634,8 @@ class BenchmarkCNN(object):
         master=target,
         config=create_config_proto(self.params),
         start_standard_services=start_standard_services) as sess:
-      if bcast_global_variables_op:
-        sess.run(bcast_global_variables_op)
+      if graph_handles['bcast_global_variables_op']:
+        sess.run(graph_handles['bcast_global_variables_op'])
 
       image_producer = None
       if image_producer_ops is not None:
@@ -1546,6 +2647,10 @@ class BenchmarkCNN(object):
           sess.run(enqueue_ops[:(i + 1)])
           image_producer.notify_image_consumption()
       self.init_global_step, = sess.run([global_step])
+      loss_scale_ops = graph_handles['loss_scale_ops']
+      if loss_scale_ops:
+        init_loss_scale_values = sess.run(loss_scale_ops)
+      startup_secs['session_init'] = time.time() - start_time
       if self.job_name and not self.params.cross_replica_sync:
         # TODO(zhengxq): Do we need to use a global step watcher at all?
         global_step_watcher = GlobalStepWatcher(
@@ -1583,6 +2688,18 @@ class BenchmarkCNN(object):
           sess = tf_debug.TensorBoardDebugWrapperSession(sess,
                                                          self.params.debugger)
       profiler = tf.profiler.Profiler() if self.params.tfprof_file else None
+      if evaluator:
+        evaluator.start()
+      checkpoint_path = None
+      if self.params.train_dir is not None and is_chief:
+        checkpoint_path = os.path.join(self.params.train_dir, 'model.ckpt')
+        if not gfile.Exists(self.params.train_dir):
+          gfile.MakeDirs(self.params.train_dir)
+      checkpoint_stolen_times = []
+      last_checkpoint_time = time.time()
+      # Indices in step_train_times of the measured steps collecting summaries.
+      summary_steps = []
+      num_skipped_summaries = 0
       loop_start_time = time.time()
       while not done_fn():
         if local_step == 0:
@@ -1597,24 +2714,68 @@ class BenchmarkCNN(object):
             header_str += '\ttop_1_accuracy\ttop_5_accuracy'
           log_fn(header_str)
           assert len(step_train_times) == self.num_warmup_batches
+          if self.num_warmup_batches > 1:
+            startup_secs['warmup'] = sum(step_train_times[1:])
           # reset times to ignore warm up batch
           step_train_times = []
           loop_start_time = time.time()
+        fetch_summary = None
         if (summary_writer and
             (local_step + 1) % self.params.save_summaries_steps == 0):
-          fetch_summary = summary_op
-        else:
-          fetch_summary = None
-        summary_str = benchmark_one_step(
+          if not async_summary_writer:
+            fetch_summary = summary_op
+          elif async_summary_writer.busy():
+            # Like summary_steps, only counts the measured steps.
+            if local_step >= 0:
+              num_skipped_summaries += 1
+          else:
+            fetch_summary = async_summary_writer.snapshot_fetches
+        summary_result = benchmark_one_step(
             sess, fetches, local_step,
             self.batch_size * (self.num_workers
                                if self.single_session else 1), step_train_times,
             self.trace_filename, self.params.partitioned_graph_file_prefix,
-            profiler, image_producer, self.params, fetch_summary)
-        if summary_str is not None and is_chief:
-          sv.summary_computed(sess, summary_str)
+            profiler, image_producer, self.params, fetch_summary,
+            accumulation_fetches=self.accumulation_fetches)
+        if 'first_step' not in startup_secs:
+          # Includes the graph optimizations and kernel compilations, which
+          # happen when a step is run for the first time.
+          startup_secs['first_step'] = step_train_times[-1]
+        if fetch_summary is not None and local_step >= 0:
+          summary_steps.append(len(step_train_times) - 1)
+        if summary_result is not None and is_chief:
+          if async_summary_writer:
+            async_summary_writer.write(sess, summary_result)
+          else:
+            sv.summary_computed(sess, summary_result)
         local_step += 1
+        if (evaluator and local_step > 0 and
+            local_step % self.params.eval_during_training_every_n_steps == 0):
+          evaluator.evaluate(sess)
+        if (async_saver and self.params.save_model_secs > 0 and
+            time.time() - last_checkpoint_time >= self.params.save_model_secs
+            and not async_saver.busy()):
+          last_checkpoint_time = time.time()
+          checkpoint_stolen_times.append(self._save_checkpoint(
+              sess, async_saver, checkpoint_path, global_step))
       loop_end_time = time.time()
+      eval_stats = {}
+      if evaluator:
+        # The last eval may still be running, so wait for it to finish. This
+        # is not included in the training time.
+        evaluator.done()
+        eval_stats = get_eval_during_training_stats(evaluator)
+      summary_stats = {}
+      if summary_writer:
+        if async_summary_writer:
+          # The last summary may still be being written. This is not included
+          # in the training time.
+          async_summary_writer.close()
+        summary_stats = get_summary_stats(step_train_times, summary_steps)
+        summary_stats['num_skipped_summaries'] = num_skipped_summaries
+        if async_summary_writer:
+          summary_stats['summary_write_secs'] = sum(
+              async_summary_writer.write_times)
       # Waits for the global step to be done, regardless of done_fn.
       if global_step_watcher:
         while not global_step_watcher.done():
@@ -1622,8 +2783,8 @@ class BenchmarkCNN(object):
       if not global_step_watcher:
         elapsed_time = loop_end_time - loop_start_time
         average_wall_time = elapsed_time / local_step if local_step > 0 else 0
-        images_per_sec = (self.num_workers * local_step * self.batch_size /
-                          elapsed_time)
+        images_per_sec = (self.num_workers * local_step * self.batch_size *
+                          self.gradient_accumulation_steps / elapsed_time)
         num_steps = local_step * self.num_workers
       else:
         # NOTE: Each worker independently increases the global step. So,
@@ -1632,21 +2793,81 @@ class BenchmarkCNN(object):
         elapsed_time = global_step_watcher.elapsed_time()
         average_wall_time = (elapsed_time * self.num_workers / num_steps
                              if num_steps > 0 else 0)
-        images_per_sec = num_steps * self.batch_size / elapsed_time
-
+        images_per_sec = (num_steps * self.batch_size *
+                          self.gradient_accumulation_steps / elapsed_time)
+
+      peak_memory_bytes = None
+      if peak_memory_ops:
+        peak_memory_bytes = max(sess.run(peak_memory_ops))
+      elif self.params.device == 'cpu':
+        peak_memory_bytes = get_peak_process_memory_bytes()
+      loss_scale_stats = {}
+      if loss_scale_ops and is_chief:
+        loss_scale_stats = get_loss_scale_stats(
+            init_loss_scale_values, sess.run(loss_scale_ops),
+            self.num_warmup_batches + local_step)
       log_fn('-' * 64)
       log_fn('total images/sec: %.2f' % images_per_sec)
+      if peak_memory_bytes is not None:
+        log_fn('peak memory %s: %.1f MB' % (
+            'per device' if peak_memory_ops else 'of the process',
+            peak_memory_bytes / 1e6))
+      log_fn('startup time: %s' % ', '.join(
+          '%s %.2f sec' % (phase.replace('_', ' '), secs)
+          for phase, secs in six.iteritems(startup_secs)))
+      xla_stats = {}
+      if self.params.xla and step_train_times:
+        xla_stats = get_xla_step_stats(
+            startup_secs['first_step'], step_train_times,
+            first_step_measured=(self.num_warmup_batches == 0))
+        overhead_secs = xla_stats['xla_first_step_overhead_secs']
+        log_fn('XLA first-step overhead (first step minus median step, mostly '
+               'compilation): %.2f sec, %.1f%% of the run' %
+               (overhead_secs, 100 * overhead_secs / (overhead_secs +
+                                                      elapsed_time)))
+        if xla_stats['xla_recompile_steps']:
+          log_fn('XLA: %d measured steps were as slow as the first step, '
+                 'likely recompilations caused by changing shapes. Steps: %s' %
+                 (len(xla_stats['xla_recompile_steps']),
+                  ', '.join(str(step + 1)
+                            for step in xla_stats['xla_recompile_steps'])))
+        else:
+          log_fn('XLA: no measured step was slow enough to have recompiled')
+      if evaluator:
+        log_fn('evals during training: %d (%d skipped)' %
+               (eval_stats['num_evals'], evaluator.num_skipped))
+        if eval_stats['num_evals']:
+          log_fn('eval images/sec: %.2f' % eval_stats['eval_images_per_sec'])
+      if loss_scale_stats:
+        log_fn('loss scale: %g, steps skipped for inf/nan gradients: %d '
+               '(%.2f%%)' %
+               (loss_scale_stats['loss_scale'],
+                loss_scale_stats['loss_scale_skipped_steps'],
+                100 * loss_scale_stats['loss_scale_overflow_rate']))
+      if summary_stats:
+        log_str = ('summaries: %d collected (%d skipped), costing %.2f sec of '
+                   'step time (%.2f%%)' %
+                   (summary_stats['num_summaries'], num_skipped_summaries,
+                    summary_stats['summary_secs'],
+                    100 * summary_stats['summary_overhead']))
+        if async_summary_writer:
+          log_str += ', written in the background in %.2f sec' % (
+              summary_stats['summary_write_secs'])
+        log_fn(log_str)
       log_fn('-' * 64)
       if image_producer is not None:
         image_producer.done()
       if is_chief:
         store_benchmarks({'total_images_per_sec': images_per_sec}, self.params)
       # Save the model checkpoint.
-      if self.params.train_dir is not None and is_chief:
-        checkpoint_path = os.path.join(self.params.train_dir, 'model.ckpt')
-        if not gfile.Exists(self.params.train_dir):
-          gfile.MakeDirs(self.params.train_dir)
-        sv.saver.save(sess, checkpoint_path, global_step)
+      if checkpoint_path is not None:
+        if async_saver:
+          checkpoint_stolen_times.append(self._save_checkpoint(
+              sess, async_saver, checkpoint_path, global_step))
+          async_saver.close()
+        else:
+          checkpoint_stolen_times.append(self._save_checkpoint(
+              sess, sv.saver, checkpoint_path, global_step))
 
       if execution_barrier:
         # Wait for other workers to reach the end, so this worker doesn't
@@ -1655,14 +2876,267 @@ class BenchmarkCNN(object):
     sv.stop()
     if profiler:
       generate_tfprof_profile(profiler, self.params.tfprof_file)
-    return {
+    stats = {
         'num_workers': self.num_workers,
         'num_steps': num_steps,
         'average_wall_time': average_wall_time,
-        'images_per_sec': images_per_sec
+        'images_per_sec': images_per_sec,
+        'peak_memory_bytes': peak_memory_bytes,
+        'startup_secs': startup_secs
+    }
+    stats.update(eval_stats)
+    stats.update(xla_stats)
+    stats.update(loss_scale_stats)
+    stats.update(summary_stats)
+    if checkpoint_stolen_times:
+      stats['checkpoint_secs'] = checkpoint_stolen_times
+    return stats
+
+  def _build_graph(self):
+    """Builds the training graph.
+
+    Returns:
+      A dict from the names of the graph elements used by _benchmark_cnn to
+      the elements. It can be exported and imported with _export_graph and
+      _import_graph.
+    """
+    if self.single_session:
+      if self.datasets_use_prefetch:
+        (image_producer_ops, enqueue_ops, fetches) = (
+            self._build_model_single_session_with_dataset_prefetching())
+      else:
+        (image_producer_ops, enqueue_ops, fetches) = (
+            self._build_model_single_session())
+    else:
+      if self.datasets_use_prefetch:
+        (image_producer_ops, enqueue_ops, fetches) = (
+            self._build_model_with_dataset_prefetching())
+      else:
+        (image_producer_ops, enqueue_ops, fetches) = self._build_model()
+    fetches_list = nest.flatten(list(fetches.values()))
+    main_fetch_group = tf.group(*fetches_list)
+    execution_barrier = None
+    if (not self.single_session and self.job_name and
+        not self.params.cross_replica_sync):
+      execution_barrier = self.add_sync_queues_and_barrier(
+          'execution_barrier_', [])
+
+    global_step = tf.train.get_global_step()
+    with tf.device(self.global_step_device):
+      with tf.control_dependencies([main_fetch_group]):
+        fetches['inc_global_step'] = global_step.assign_add(1)
+
+    if ((not self.single_session) and self.job_name and
+        self.params.cross_replica_sync):
+      # Block all replicas until all replicas are ready for next step.
+      fetches['sync_queues'] = self.add_sync_queues_and_barrier(
+          'sync_queues_step_end_', [main_fetch_group])
+
+    local_var_init_op = tf.local_variables_initializer()
+    table_init_ops = tf.tables_initializer()
+    variable_mgr_init_ops = [local_var_init_op]
+    if table_init_ops:
+      variable_mgr_init_ops.extend([table_init_ops])
+    with tf.control_dependencies([local_var_init_op]):
+      variable_mgr_init_ops.extend(self.variable_mgr.get_post_init_ops())
+    if (not self.single_session and self.job_name and
+        self.params.cross_replica_sync):
+      # Ensure all workers execute variable_mgr_init_ops before they start
+      # executing the model.
+      variable_mgr_init_ops.append(
+          self.add_sync_queues_and_barrier('init_ops_end_',
+                                           variable_mgr_init_ops))
+    local_var_init_op_group = tf.group(*variable_mgr_init_ops)
+
+    peak_memory_ops = []
+    if self.params.device == 'gpu':
+      for device in self.raw_devices:
+        with tf.device(device):
+          peak_memory_ops.append(tf.contrib.memory_stats.MaxBytesInUse())
+    ready_for_local_init_op = None
+    if self.job_name and not self.single_session:
+      # In distributed mode, we don't want to run local_var_init_op_group until
+      # the global variables are initialized, because local_var_init_op_group
+      # may use global variables (such as in distributed replicated mode). We
+      # don't set this in non-distributed mode, because in non-distributed mode,
+      # local_var_init_op_group may itself initialize global variables (such as
+      # in replicated mode).
+      ready_for_local_init_op = tf.report_uninitialized_variables(
+          tf.global_variables())
+    if self.params.variable_update == 'horovod':
+      import horovod.tensorflow as hvd  # pylint: disable=g-import-not-at-top
+      bcast_global_variables_op = hvd.broadcast_global_variables(0)
+    else:
+      bcast_global_variables_op = None
+    return {
+        'image_producer_ops': image_producer_ops,
+        'enqueue_ops': enqueue_ops,
+        'fetches': fetches,
+        'accumulation_fetches': self.accumulation_fetches,
+        'execution_barrier': execution_barrier,
+        'global_step': global_step,
+        'local_init_op': local_var_init_op_group,
+        'ready_for_local_init_op': ready_for_local_init_op,
+        'bcast_global_variables_op': bcast_global_variables_op,
+        'summary_op': tf.summary.merge_all(),
+        'peak_memory_ops': peak_memory_ops,
+        'savable_variables': self.variable_mgr.savable_variables(),
+        'loss_scale_ops': self._get_loss_scale_ops(),
     }
 
-  def _build_image_processing(self, shift_ratio=0):
+  def _get_loss_scale_ops(self):
+    """Returns the loss scale and skipped step count, or None.
+
+    They are only returned with automatic loss scaling, in which case the
+    count is incremented every time the gradients of a step have infs or nans.
+    """
+    if self.loss_scale_skipped_steps is None:
+      return None
+    return {
+        'loss_scale': self.loss_scale,
+        'loss_scale_skipped_steps': self.loss_scale_skipped_steps,
+    }
+
+  def _write_learning_rate_table(self, path):
+    """Writes the learning rate table of the training schedule to `path`."""
+    table = get_learning_rate_table(
+        self.params, self.dataset.num_examples_per_epoch(),
+        self.batch_size * self.gradient_accumulation_steps)
+    if table is None:
+      log_fn('Not writing the learning rate table, since the learning rate '
+             'schedule is defined by the model')
+      return
+    with gfile.GFile(path, 'w') as f:
+      f.write('# first_step learning_rate increment_per_step decay_factor '
+              'decay_steps\n')
+      for first_step, learning_rate, increment, decay_factor, decay_steps in (
+          table):
+        f.write('%d %.9g %.9g %.9g %d\n' % (first_step, learning_rate,
+                                              increment, decay_factor,
+                                              decay_steps))
+    log_fn('Wrote the %d rows of the learning rate table to %s' %
+           (len(table), path))
+
+  def _get_graph_cache_path(self):
+    """Returns the --graph_cache_dir MetaGraph for the current params."""
+    key = {name: value for name, value in six.iteritems(self.params._asdict())
+           if name not in _GRAPH_CACHE_IGNORED_PARAMS}
+    key.update({
+        'model': '%s.%s' % (type(self.model).__module__,
+                            type(self.model).__name__),
+        'model_name': self.model.get_model(),
+        'dataset': self.dataset.name,
+        'tf_build': '%s-%s' % (tf.__version__, getattr(tf, 'GIT_VERSION', '')),
+        'source': _get_source_digest(self.model),
+    })
+    digest = hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode(
+        'utf-8')).hexdigest()
+    return os.path.join(self.params.graph_cache_dir,
+                        'graph_%s.meta' % digest)
+
+  def _export_graph(self, path, graph_handles):
+    """Exports the default graph and `graph_handles` to a MetaGraph file."""
+    graph = tf.get_default_graph()
+    graph.add_to_collection(GRAPH_HANDLES_COLLECTION, json.dumps(
+        _graph_element_names(graph_handles)))
+    meta_graph_def = tf.train.export_meta_graph(clear_devices=False)
+    graph.clear_collection(GRAPH_HANDLES_COLLECTION)
+    gfile.MakeDirs(os.path.dirname(path))
+    # Write to a temporary file first, so that concurrent runs never import a
+    # partially written MetaGraph.
+    temp_path = '%s.tmp%d' % (path, os.getpid())
+    with gfile.GFile(temp_path, 'wb') as f:
+      f.write(meta_graph_def.SerializeToString())
+    gfile.Rename(temp_path, path, overwrite=True)
+    log_fn('Exported graph to %s' % path)
+
+  def _import_graph(self, path):
+    """Imports a MetaGraph written by _export_graph into the default graph.
+
+    Args:
+      path: The path of the MetaGraph file.
+    Returns:
+      The graph handles passed to _export_graph, with the names of the graph
+      elements replaced by the imported elements.
+    """
+    # Ops from tf.contrib are registered when their module is first used.
+    tf.contrib.memory_stats  # pylint: disable=pointless-statement
+    tf.train.import_meta_graph(path, clear_devices=False)
+    graph = tf.get_default_graph()
+    serialized_handles, = graph.get_collection(GRAPH_HANDLES_COLLECTION)
+    graph.clear_collection(GRAPH_HANDLES_COLLECTION)
+    if isinstance(serialized_handles, bytes):
+      serialized_handles = serialized_handles.decode('utf-8')
+    log_fn('Imported graph from %s' % path)
+    return _graph_elements_from_names(graph, json.loads(serialized_handles))
+
+  def _save_checkpoint(self, sess, saver, checkpoint_path, global_step):
+    """Saves a checkpoint, and returns the time it took the training thread.
+
+    Args:
+      sess: The training session.
+      saver: A tf.train.Saver, or a cnn_util.AsyncCheckpointSaver which only
+        snapshots the variables in the training thread.
+      checkpoint_path: The prefix of the checkpoint files.
+      global_step: The global step Tensor.
+    Returns:
+      The number of seconds the training thread spent saving the checkpoint.
+    """
+    start_time = time.time()
+    if isinstance(saver, cnn_util.AsyncCheckpointSaver):
+      global_step_value = saver.save(sess, checkpoint_path, global_step)
+      mode = 'snapshot for background write'
+    else:
+      global_step_value = sess.run(global_step)
+      saver.save(sess, checkpoint_path, global_step_value)
+      mode = 'synchronous save'
+    stolen_time = time.time() - start_time
+    log_fn('Checkpoint at step %d: %.3f sec taken from training (%s)' %
+           (global_step_value, stolen_time, mode))
+    return stolen_time
+
+  def _get_eval_during_training_bench(self):
+    """Returns the BenchmarkCNN of the model evaluated during training.
+
+    The eval model has the same params as the training model, except that it
+    runs on --num_eval_gpus devices, if set, and with --num_eval_intra_threads.
+    """
+    num_eval_intra_threads = self.params.num_eval_intra_threads
+    if num_eval_intra_threads is None:
+      num_eval_intra_threads = self.params.num_intra_threads
+    eval_params = self.params._replace(
+        eval=True,
+        eval_during_training_every_n_steps=0,
+        num_gpus=self.params.num_eval_gpus or self.params.num_gpus,
+        gpu_indices='',
+        num_batches=self.params.num_eval_batches,
+        num_epochs=None if self.params.num_eval_batches else 1,
+        num_intra_threads=num_eval_intra_threads,
+        input_autotune=False,
+        shard_optimizer_state=False,
+        graph_file=None,
+        trace_file=None,
+        tfprof_file=None)
+    eval_bench = BenchmarkCNN(
+        eval_params, dataset=self.dataset,
+        model=copy.copy(self.model))
+    if self.params.num_eval_gpus:
+      # Run the eval model on the devices after the training devices.
+      eval_bench.raw_devices = [
+          '/%s:%i' % (self.params.device, self.num_gpus + i)
+          for i in xrange(self.params.num_eval_gpus)
+      ]
+      eval_bench.devices = eval_bench.variable_mgr.get_devices()
+    return eval_bench
+
+  def _get_input_worker_index(self):
+    """Returns the index of this worker, used to shard the input data."""
+    if self.params.variable_update == 'horovod':
+      import horovod.tensorflow as hvd  # pylint: disable=g-import-not-at-top
+      return hvd.rank()
+    return self.task_index
+
+  def _build_image_processing(self, shift_ratio=0, worker_index=0):
     """"Build the image (pre)processing portion of the model graph."""
     with tf.device(self.cpu_device):
       if self.params.eval:
@@ -1676,7 +3150,9 @@ class BenchmarkCNN(object):
           subset=subset,
           use_datasets=self.params.use_datasets,
           cache_data=self.params.cache_data,
-          shift_ratio=shift_ratio)
+          shift_ratio=shift_ratio,
+          worker_index=worker_index,
+          num_workers=self.num_workers)
       images_shape = images_splits[0].get_shape()
       labels_shape = labels_splits[0].get_shape()
       for device_num in range(len(self.devices)):
@@ -1727,13 +3203,18 @@ class BenchmarkCNN(object):
               trainable=False)
           self.loss_scale_normal_steps = tf.get_variable(
               name='loss_scale_normal_steps', initializer=0, trainable=False)
+          if self.enable_auto_loss_scale:
+            self.loss_scale_skipped_steps = tf.get_variable(
+                name='loss_scale_skipped_steps', initializer=0,
+                trainable=False)
         else:
           self.loss_scale = None
           self.loss_scale_normal_steps = None
 
     # Build the processing and model for the worker.
     (image_producer_ops,
-     image_producer_stages) = self._build_image_processing(shift_ratio=0)
+     image_producer_stages) = self._build_image_processing(
+         shift_ratio=0, worker_index=self._get_input_worker_index())
     image_producer_ops = tf.group(*image_producer_ops)
     update_ops = None
     staging_delta_ops = []
@@ -1813,6 +3294,10 @@ class BenchmarkCNN(object):
               trainable=False)
           self.loss_scale_normal_steps = tf.get_variable(
               name='loss_scale_normal_steps', initializer=0, trainable=False)
+          if self.enable_auto_loss_scale:
+            self.loss_scale_skipped_steps = tf.get_variable(
+                name='loss_scale_skipped_steps', initializer=0,
+                trainable=False)
         else:
           self.loss_scale = None
           self.loss_scale_normal_steps = None
@@ -1822,7 +3307,11 @@ class BenchmarkCNN(object):
         self.model.get_image_size(), self.model.get_image_size(),
         self.batch_size, len(
             self.devices), self.image_preprocessor.parse_and_preprocess,
-        self.cpu_device, self.params, self.devices, self.dataset)
+        self.cpu_device, self.params, self.devices, self.dataset,
+        self.image_preprocessor.get_batch_preprocess_fn(),
+        worker_index=self._get_input_worker_index(),
+        num_workers=self.num_workers,
+        options=self._get_input_pipeline_options())
 
     update_ops = None
 
@@ -1876,11 +3365,23 @@ class BenchmarkCNN(object):
       fetches['top_5_accuracy'] = tf.reduce_sum(all_top_5_ops) / self.batch_size
       if self.task_index == 0 and self.params.summary_verbosity >= 1:
         tf.summary.scalar('top_5_accuracy', fetches['top_5_accuracy'])
+    num_examples_ops = tf.get_collection(EVAL_NUM_EXAMPLES_COLLECTION)
+    if num_examples_ops:
+      fetches['num_examples'] = tf.add_n(num_examples_ops)
 
     if not phase_train:
       if self.params.forward_only:
         fetches['all_logits'] = tf.concat(all_logits, 0)
       return fetches
+    accumulators = []
+    if self.gradient_accumulation_steps > 1:
+      accumulate_ops, device_grads, accumulators = (
+          self._add_gradient_accumulation(device_grads))
+      self.accumulation_fetches = {
+          'accumulate_op': tf.group(*(accumulate_ops + update_ops))
+      }
+      if enqueue_ops:
+        self.accumulation_fetches['enqueue_ops'] = enqueue_ops
     apply_gradient_devices, gradient_state = (
         self.variable_mgr.preprocess_device_grads(device_grads))
 
@@ -1891,9 +3392,9 @@ class BenchmarkCNN(object):
         avg_grads = self.variable_mgr.get_gradients_to_apply(d, gradient_state)
 
         gradient_clip = self.params.gradient_clip
-        learning_rate = get_learning_rate(self.params, global_step,
-                                          self.dataset.num_examples_per_epoch(),
-                                          self.model, self.batch_size)
+        learning_rate = get_learning_rate(
+            self.params, global_step, self.dataset.num_examples_per_epoch(),
+            self.model, self.batch_size * self.gradient_accumulation_steps)
 
         if gradient_clip is not None:
           clipped_grads = [(tf.clip_by_value(grad, -gradient_clip,
@@ -1909,11 +3410,24 @@ class BenchmarkCNN(object):
             loss_scale=self.loss_scale,
             loss_scale_normal_steps=self.loss_scale_normal_steps,
             inc_loss_scale_every_n=self.params.fp16_inc_loss_scale_every_n,
-            is_chief=not self.job_name or self.task_index == 0)
+            is_chief=not self.job_name or self.task_index == 0,
+            loss_scale_skipped_steps=self.loss_scale_skipped_steps,
+            inc_loss_scale_factor=self.params.fp16_inc_loss_scale_factor,
+            dec_loss_scale_factor=self.params.fp16_dec_loss_scale_factor,
+            # All devices see the same infs and nans, so only the first one
+            # updates the loss scale and the step counters.
+            update_loss_scale=d == 0)
 
         self.variable_mgr.append_apply_gradients_ops(
             gradient_state, opt, clipped_grads, training_ops, loss_scale_params)
     train_op = tf.group(*(training_ops + update_ops))
+    if accumulators:
+      # Zero the accumulators for the next step once the gradients have been
+      # applied.
+      with tf.control_dependencies([train_op]):
+        train_op = tf.group(
+            *[accumulator.assign(tf.zeros_like(accumulator))
+              for accumulator in accumulators])
 
     with tf.device(self.cpu_device):
       if self.task_index == 0 and self.params.summary_verbosity >= 1:
@@ -1923,6 +3437,9 @@ class BenchmarkCNN(object):
           tf.summary.scalar('loss_scale', self.loss_scale)
           tf.summary.scalar('loss_scale_normal_steps',
                             self.loss_scale_normal_steps)
+        if self.loss_scale_skipped_steps is not None:
+          tf.summary.scalar('loss_scale_skipped_steps',
+                            self.loss_scale_skipped_steps)
 
         if self.params.summary_verbosity >= 2:
           # Histogram of log values of all non-zero gradients.
@@ -1934,19 +3451,63 @@ class BenchmarkCNN(object):
           indices_for_non_zero_grads = tf.where(tf.not_equal(grads, 0))
           log_grads = tf.reshape(
               tf.log(tf.gather(grads, indices_for_non_zero_grads)), [-1])
-          tf.summary.histogram('log_gradients', log_grads)
+          self._histogram_summary('log_gradients', log_grads)
 
         if self.params.summary_verbosity >= 3:
           for grad, var in avg_grads:
             if grad is not None:
-              tf.summary.histogram(var.op.name + '/gradients', grad)
+              self._histogram_summary(var.op.name + '/gradients', grad)
           for var in tf.trainable_variables():
-            tf.summary.histogram(var.op.name, var)
+            self._histogram_summary(var.op.name, var)
 
     fetches['train_op'] = train_op
     fetches['average_loss'] = average_loss
     return fetches
 
+  def _histogram_summary(self, name, values):
+    """Adds a histogram summary, subsampled by summary_histogram_max_values."""
+    max_values = self.params.summary_histogram_max_values
+    if max_values:
+      values = tf.reshape(values, [-1])
+      size = tf.size(values)
+      stride = tf.maximum((size + max_values - 1) // max_values, 1)
+      values = values[::stride]
+    tf.summary.histogram(name, values)
+
+  def _add_gradient_accumulation(self, device_grads):
+    """Adds local buffers accumulating the gradients of each micro-batch.
+
+    Args:
+      device_grads: A list with one list of (gradient, variable) tuples per
+        device, as returned by add_forward_pass_and_gradients.
+    Returns:
+      A tuple (accumulate_ops, new_device_grads, accumulators).
+      accumulate_ops add the gradients of the current micro-batch to the
+      accumulators. new_device_grads has the same structure as `device_grads`,
+      with each gradient replaced by its average over the micro-batches of the
+      step, where the current micro-batch is the last one. The accumulators
+      must be zeroed once new_device_grads has been applied.
+    """
+    accumulate_ops = []
+    new_device_grads = []
+    accumulators = []
+    for device_num, grads_and_vars in enumerate(device_grads):
+      new_grads_and_vars = []
+      with tf.name_scope('gradient_accumulation_%i' % device_num):
+        for grad, var in grads_and_vars:
+          with tf.device(grad.device):
+            accumulator = tf.Variable(
+                tf.zeros(grad.shape, grad.dtype), trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name='accumulator')
+            accumulate_ops.append(accumulator.assign_add(grad))
+            new_grad = (accumulator + grad) * tf.cast(
+                1. / self.gradient_accumulation_steps, grad.dtype)
+          accumulators.append(accumulator)
+          new_grads_and_vars.append((new_grad, var))
+      new_device_grads.append(new_grads_and_vars)
+    return accumulate_ops, new_device_grads, accumulators
+
   def _build_model_single_session(self):
     """Build the TensorFlow graph for multiple replicas in a single_session.
 
@@ -1997,7 +3558,8 @@ class BenchmarkCNN(object):
       # Build the per-worker image processing
       (image_producer_ops, image_producer_stages) = (
           self._build_image_processing(
-              shift_ratio=(float(task_num) / self.num_workers)))
+              shift_ratio=(float(task_num) / self.num_workers),
+              worker_index=task_num))
       global_image_producer_ops.extend(image_producer_ops)
       # Build the per-worker model replica.
       for rel_device_num in range(len(self.devices)):
@@ -2151,6 +3713,10 @@ class BenchmarkCNN(object):
     nclass = self.dataset.num_classes
     data_type = get_data_type(self.params)
     image_size = self.model.get_image_size()
+    # The layout the images are in. Input pipelines produce NHWC images.
+    input_data_format = 'NHWC'
+    # With multi-crop eval, the crops of each image are in the batch dimension.
+    num_crops = self.image_preprocessor.num_crops_per_image()
     if self.datasets_use_prefetch and function_buffering_resource is not None:
       with tf.device(self.raw_devices[rel_device_num]):
         images, labels = data_utils.get_images_and_labels(
@@ -2158,8 +3724,8 @@ class BenchmarkCNN(object):
         images = tf.reshape(
             images,
             shape=[
-                self.batch_size // self.num_gpus, image_size, image_size,
-                self.dataset.depth
+                self.batch_size // self.num_gpus * num_crops, image_size,
+                image_size, self.dataset.depth
             ])
     else:
       if not self.use_synthetic_gpu_images:
@@ -2179,19 +3745,30 @@ class BenchmarkCNN(object):
           images = tf.reshape(images, shape=images_shape)
           gpu_compute_stage_ops.append(gpu_compute_stage_op)
         else:
-          # Minor hack to avoid H2D copy when using synthetic data
-          image_shape = [
-              self.batch_size // self.num_gpus, image_size, image_size,
-              self.dataset.depth
-          ]
+          # Minor hack to avoid H2D copy when using synthetic data. The
+          # images are generated directly in the layout used by the model, so
+          # no transpose is needed.
+          if self.data_format == 'NCHW':
+            image_shape = [
+                self.batch_size // self.num_gpus, self.dataset.depth,
+                image_size, image_size
+            ]
+          else:
+            image_shape = [
+                self.batch_size // self.num_gpus, image_size, image_size,
+                self.dataset.depth
+            ]
+          input_data_format = self.data_format
           labels_shape = [self.batch_size // self.num_gpus]
-          # Synthetic image should be within [0, 255].
+          # Synthetic image should be within [0, 255]. Random ops may not
+          # support bfloat16, so bfloat16 images are generated in fp32.
           images = tf.truncated_normal(
               image_shape,
-              dtype=data_type,
+              dtype=tf.float32 if data_type == tf.bfloat16 else data_type,
               mean=127,
               stddev=60,
               name='synthetic_images')
+          images = tf.cast(images, data_type)
           images = tf.contrib.framework.local_variable(
               images, name='gpu_cached_images')
           labels = tf.random_uniform(
@@ -2201,16 +3778,44 @@ class BenchmarkCNN(object):
               dtype=tf.int32,
               name='synthetic_labels')
 
-    with tf.device(self.devices[rel_device_num]):
-      logits, aux_logits = self.model.build_network(
-          images, phase_train, nclass, self.dataset.depth, data_type,
-          self.data_format, self.params.use_tf_layers, self.params.fp16_vars)
+    with tf.device(self.devices[rel_device_num]), self._xla_compile_scope(
+        'tower'):
+      first_layer_output = len(
+          tf.get_collection(convnet_builder.LAYER_OUTPUTS_COLLECTION))
+      first_block_output = len(
+          tf.get_collection(convnet_builder.BLOCK_OUTPUTS_COLLECTION))
+      with self._xla_compile_scope('model'):
+        logits, aux_logits = self.model.build_network(
+            images, phase_train, nclass, self.dataset.depth, data_type,
+            self.data_format, self.params.use_tf_layers, self.params.fp16_vars,
+            input_data_format=input_data_format)
       results = {}  # The return value
+      if not phase_train and num_crops > 1:
+        # Average the predictions of the crops of each image.
+        logits = tf.reduce_mean(
+            tf.reshape(tf.nn.softmax(tf.cast(logits, tf.float32)),
+                       [-1, num_crops, nclass]), 1)
       if not phase_train or self.params.print_training_accuracy:
-        top_1_op = tf.reduce_sum(
-            tf.cast(tf.nn.in_top_k(logits, labels, 1), data_type))
-        top_5_op = tf.reduce_sum(
-            tf.cast(tf.nn.in_top_k(logits, labels, 5), data_type))
+        # bfloat16 only counts exactly up to 256, so its counts are in fp32.
+        count_type = tf.float32 if data_type == tf.bfloat16 else data_type
+        if not phase_train and self.params.eval_full_pass:
+          # Padding examples have a negative label, and are not counted.
+          is_example = tf.greater_equal(labels, 0)
+          labels = tf.maximum(labels, 0)
+          tf.add_to_collection(
+              EVAL_NUM_EXAMPLES_COLLECTION,
+              tf.reduce_sum(tf.cast(is_example, tf.int32)))
+          top_1_op = tf.reduce_sum(tf.cast(
+              tf.logical_and(tf.nn.in_top_k(logits, labels, 1), is_example),
+              count_type))
+          top_5_op = tf.reduce_sum(tf.cast(
+              tf.logical_and(tf.nn.in_top_k(logits, labels, 5), is_example),
+              count_type))
+        else:
+          top_1_op = tf.reduce_sum(
+              tf.cast(tf.nn.in_top_k(logits, labels, 1), count_type))
+          top_5_op = tf.reduce_sum(
+              tf.cast(tf.nn.in_top_k(logits, labels, 5), count_type))
         results['top_1_op'] = top_1_op
         results['top_5_op'] = top_5_op
 
@@ -2229,20 +3834,29 @@ class BenchmarkCNN(object):
         # this reduction in fp16.
         fp32_params = (tf.cast(p, tf.float32) for p in params)
       total_loss = base_loss
-      if rel_device_num == len(self.devices) - 1:
+      l2_loss_params = None
+      if self.params.shard_l2_loss:
+        # Each device computes the L2 loss for a disjoint shard of the
+        # parameters. Since the gradients are averaged across devices, the L2
+        # loss of each shard is multiplied by the number of devices, like below.
+        shards = get_l2_loss_shards(params, len(self.devices))
+        fp32_params = list(fp32_params)
+        l2_loss_params = [fp32_params[i] for i in shards[rel_device_num]]
+      elif rel_device_num == len(self.devices) - 1:
         # We compute the L2 loss for only one device instead of all of them,
         # because the L2 loss for each device is the same. To adjust for this,
         # we multiply the L2 loss by the number of devices. We choose the last
         # device because for some reason, on a Volta DGX1, the first four
         # GPUs take slightly longer to complete a step than the last four.
-        # TODO(reedwm): Shard the L2 loss computations across GPUs.
+        l2_loss_params = fp32_params
+      if l2_loss_params:
         if self.params.single_l2_loss_op:
           # TODO(reedwm): If faster, create a fused op that does the L2 loss on
           # multiple tensors, and use that instead of concatenating tensors.
-          reshaped_params = [tf.reshape(p, (-1,)) for p in fp32_params]
+          reshaped_params = [tf.reshape(p, (-1,)) for p in l2_loss_params]
           l2_loss = tf.nn.l2_loss(tf.concat(reshaped_params, axis=0))
         else:
-          l2_loss = tf.add_n([tf.nn.l2_loss(v) for v in fp32_params])
+          l2_loss = tf.add_n([tf.nn.l2_loss(v) for v in l2_loss_params])
         weight_decay = self.params.weight_decay
         if weight_decay is not None and weight_decay != 0.:
           total_loss += len(self.devices) * weight_decay * l2_loss
@@ -2250,7 +3864,14 @@ class BenchmarkCNN(object):
       aggmeth = tf.AggregationMethod.DEFAULT
       scaled_loss = (total_loss if self.loss_scale is None
                      else total_loss * self.loss_scale)
-      grads = tf.gradients(scaled_loss, params, aggregation_method=aggmeth)
+      if self.params.recompute_activations != 'none':
+        grads = gradient_checkpointing.gradients(
+            scaled_loss, params,
+            self._get_activation_checkpoints(first_layer_output,
+                                             first_block_output),
+            aggregation_method=aggmeth)
+      else:
+        grads = tf.gradients(scaled_loss, params, aggregation_method=aggmeth)
       if self.loss_scale is not None:
         # TODO(reedwm): If automatic loss scaling is not used, we could avoid
         # these multiplications by directly modifying the learning rate instead.
@@ -2295,6 +3916,50 @@ class BenchmarkCNN(object):
       results['gradvars'] = gradvars
       return results
 
+  @contextlib.contextmanager
+  def _xla_compile_scope(self, scope):
+    """Compiles the ops created in the context if --xla_compile_scope=scope.
+
+    Args:
+      scope: 'tower' or 'model'.
+    Yields:
+      Nothing.
+    """
+    if self.params.xla and self.params.xla_compile_scope == scope:
+      # The gradients of the ops in the scope are compiled too. With 'model',
+      # they are compiled separately from the forward pass.
+      with tf.contrib.compiler.jit.experimental_jit_scope(
+          separate_compiled_gradients=(scope == 'model')):
+        yield
+    else:
+      yield
+
+  def _get_activation_checkpoints(self, first_layer_output,
+                                  first_block_output):
+    """Returns the activations to keep alive when recomputing activations.
+
+    Args:
+      first_layer_output: The index of the first element of the ConvNetBuilder
+        layer outputs collection added by the current device.
+      first_block_output: The index of the first element of the ConvNetBuilder
+        block outputs collection added by the current device.
+    Returns:
+      A list of tensors to pass to gradient_checkpointing.gradients.
+    """
+    if self.params.recompute_activations == 'blocks':
+      block_outputs = tf.get_collection(
+          convnet_builder.BLOCK_OUTPUTS_COLLECTION)[first_block_output:]
+      if block_outputs:
+        return block_outputs
+    layer_outputs = []
+    for t in tf.get_collection(
+        convnet_builder.LAYER_OUTPUTS_COLLECTION)[first_layer_output:]:
+      # The top layer can be set to the same tensor more than once, e.g. when
+      # switching to the auxiliary top layer.
+      if t not in layer_outputs:
+        layer_outputs.append(t)
+    return gradient_checkpointing.select_sqrt_checkpoints(layer_outputs)
+
   def get_image_preprocessor(self):
     """Returns the image preprocessor to used, based on the model.
 
@@ -2325,7 +3990,141 @@ class BenchmarkCNN(object):
         shift_ratio=shift_ratio,
         summary_verbosity=self.params.summary_verbosity,
         distort_color_in_yiq=self.params.distort_color_in_yiq,
-        fuse_decode_and_crop=self.params.fuse_decode_and_crop)
+        fuse_decode_and_crop=self.params.fuse_decode_and_crop,
+        vectorized_distortions=self.params.vectorized_distortions,
+        input_pipeline_options=self._get_input_pipeline_options())
+
+  def _get_eval_cache_file(self):
+    """Returns the --eval_cache_dir file for the current eval settings."""
+    key = {
+        'data_dir': self.params.data_dir,
+        'dataset': self.dataset.name,
+        'input_preprocessor': self.params.input_preprocessor,
+        'image_size': self.model.get_image_size(),
+        'batch_size': self.batch_size,
+        'num_devices': len(self.devices),
+        'num_batches': self.num_batches,
+        'resize_method': self.resize_method,
+        'data_type': get_data_type(self.params).name,
+        'eval_cache_fp16': self.params.eval_cache_fp16,
+        'eval_full_pass': self.params.eval_full_pass,
+        'eval_crop_mode': self.params.eval_crop_mode,
+        'eval_crop_scales': self.params.eval_crop_scales,
+        'worker_index': self._get_input_worker_index(),
+        'num_workers': self.num_workers,
+    }
+    digest = hashlib.md5(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(self.params.eval_cache_dir, 'eval_cache_%s' % digest)
+
+  def _get_input_pipeline_options(self):
+    """Returns the data_utils.InputPipelineOptions to use."""
+    options = data_utils.InputPipelineOptions.from_params(self.params)
+    if self.params.eval and self.params.eval_full_pass:
+      options.eval_num_examples = self.dataset.num_examples_per_epoch(
+          'validation')
+      options.eval_num_padding_examples = (
+          self.num_batches * self.batch_size - options.eval_num_examples)
+    if self.params.eval and self.params.eval_cache_dir:
+      options.eval_cache_file = self._get_eval_cache_file()
+      options.eval_cache_num_batches = self.num_batches * len(self.devices)
+      options.eval_cache_fp16 = self.params.eval_cache_fp16
+    return options
+
+  def _get_input_autotune_candidates(self):
+    """Returns the input pipeline settings tried by --input_autotune."""
+    num_splits = len(self.devices) * self.batch_group_size
+    batch_size = self.batch_size * self.batch_group_size
+    if not self.params.use_datasets:
+      return [{'record_input_parallelism': parallelism}
+              for parallelism in (16, 64, 128)]
+    candidates = []
+    for cycle_length in (4, 10, 32):
+      for num_parallel_batches in (num_splits, 2 * num_splits):
+        for prefetch_buffer_size in (batch_size, 4 * batch_size):
+          candidates.append({
+              'datasets_interleave_cycle_length': cycle_length,
+              'datasets_num_parallel_batches': num_parallel_batches,
+              'datasets_record_prefetch_buffer_size': prefetch_buffer_size,
+          })
+    return candidates
+
+  def _time_input_pipeline(self):
+    """Returns the average time to produce a batch with self.params."""
+    subset = 'validation' if self.params.eval else 'train'
+    with tf.Graph().as_default():
+      tf.set_random_seed(self.params.tf_random_seed)
+      image_preprocessor = self.get_image_preprocessor()
+      with tf.device(self.cpu_device):
+        images_splits, labels_splits = image_preprocessor.minibatch(
+            self.dataset,
+            subset=subset,
+            use_datasets=self.params.use_datasets,
+            cache_data=self.params.cache_data,
+            worker_index=self._get_input_worker_index(),
+            num_workers=self.num_workers)
+        fetch = tf.group(*(images_splits + labels_splits))
+      with tf.Session(config=create_config_proto(self.params)) as sess:
+        sess.run(tf.tables_initializer())
+        for _ in xrange(_NUM_INPUT_AUTOTUNE_WARMUP_STEPS):
+          sess.run(fetch)
+        start_time = time.time()
+        for _ in xrange(_NUM_INPUT_AUTOTUNE_STEPS):
+          sess.run(fetch)
+        return (time.time() - start_time) / _NUM_INPUT_AUTOTUNE_STEPS
+
+  def _autotune_input_pipeline(self):
+    """Returns self.params with the fastest input pipeline settings.
+
+    Each candidate from _get_input_autotune_candidates whose estimated memory
+    use fits in --input_autotune_memory_budget_mb is timed. If none fits, the
+    candidate using the least memory is chosen.
+    """
+    processor_class = self.dataset.get_image_preprocessor(
+        self.params.input_preprocessor)
+    if not issubclass(processor_class,
+                      preprocessing.RecordInputImagePreprocessor):
+      raise ValueError('--input_autotune requires --data_dir to contain '
+                       'TFRecord files of the imagenet dataset')
+    subset = 'validation' if self.params.eval else 'train'
+    record_size = data_utils.get_mean_record_size(self.dataset, subset)
+    image_size = self.model.get_image_size()
+    image_bytes = (image_size * image_size * self.dataset.depth *
+                   get_data_type(self.params).size)
+    budget_bytes = self.params.input_autotune_memory_budget_mb * 1024 * 1024
+    original_params = self.params
+    best_params = None
+    best_time = None
+    lowest_memory_params = None
+    lowest_memory_bytes = None
+    try:
+      for candidate in self._get_input_autotune_candidates():
+        self.params = original_params._replace(**candidate)
+        memory_bytes = data_utils.estimate_input_memory_bytes(
+            data_utils.InputPipelineOptions.from_params(self.params),
+            self.params.use_datasets, self.batch_size * self.batch_group_size,
+            len(self.devices) * self.batch_group_size, record_size,
+            image_bytes, indexed=bool(self.dataset.get_index(subset)))
+        if lowest_memory_bytes is None or memory_bytes < lowest_memory_bytes:
+          lowest_memory_params = self.params
+          lowest_memory_bytes = memory_bytes
+        if memory_bytes > budget_bytes:
+          log_fn('Input pipeline %s: skipped, needs about %.1f MB' %
+                 (candidate, memory_bytes / 1024. / 1024.))
+          continue
+        step_time = self._time_input_pipeline()
+        log_fn('Input pipeline %s: %.1f ms/batch, about %.1f MB' %
+               (candidate, step_time * 1000, memory_bytes / 1024. / 1024.))
+        if best_time is None or step_time < best_time:
+          best_params = self.params
+          best_time = step_time
+    finally:
+      self.params = original_params
+    if best_params is None:
+      log_fn('No input pipeline setting fits in '
+             '--input_autotune_memory_budget_mb, using the smallest one')
+      best_params = lowest_memory_params
+    return best_params
 
   def add_sync_queues_and_barrier(self, name_prefix, enqueue_after_list):
     """Adds ops to enqueue on all worker queues.
@@ -18,8 +18,11 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import json
 import os
 import re
+import sys
+import types
 
 import numpy as np
 import tensorflow as tf
@@ -28,10 +31,18 @@ from tensorflow.core.framework import step_stats_pb2
 from tensorflow.core.profiler import tfprof_log_pb2
 from tensorflow.python.platform import test
 import benchmark_cnn
+import convert_to_raw_tfrecords
+import convnet_builder
+import data_utils
+import datasets
 import flags
+import gradient_checkpointing
 import preprocessing
 import test_util
+import tfrecord_index
 import variable_mgr_util
+from models import model as model_lib
+from models import model_config
 from platforms import util as platforms_util
 
 
@@ -44,6 +55,21 @@ def _check_has_gpu():
         support, add --config=cuda to the build flags.\n """)
 
 
+def _has_bfloat16_cpu_kernels():
+  """Returns whether the bfloat16 ops of an affine layer have CPU kernels."""
+  with tf.Graph().as_default():
+    x = tf.ones([2, 2], tf.bfloat16)
+    w = tf.ones([2, 2], tf.bfloat16)
+    y = tf.nn.relu(tf.nn.bias_add(tf.matmul(x, w), tf.ones([2], tf.bfloat16)))
+    grads = tf.gradients(y, [w])
+    with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+      try:
+        sess.run(grads)
+      except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError):
+        return False
+  return True
+
+
 class TfCnnBenchmarksModelTest(tf.test.TestCase):
   """Tests which are run with multiple models."""
 
@@ -265,7 +291,8 @@ class TfCnnBenchmarksModelTest(tf.test.TestCase):
             self.assertEquals(v.device, '/device:GPU:1')
           elif v.name in ('images:0', 'labels:0', 'init_learning_rate:0',
                           'global_step:0', 'loss_scale:0',
-                          'loss_scale_normal_steps:0'):
+                          'loss_scale_normal_steps:0',
+                          'loss_scale_skipped_steps:0'):
             self.assertEquals(v.device, '/device:CPU:0')
           else:
             raise ValueError('Unexpected variable %s' % v.name)
@@ -289,7 +316,8 @@ class TfCnnBenchmarksModelTest(tf.test.TestCase):
             self._assert_correct_var_type(v, params)
           elif v.name in ('images:0', 'labels:0', 'init_learning_rate:0',
                           'global_step:0', 'loss_scale:0',
-                          'loss_scale_normal_steps:0'):
+                          'loss_scale_normal_steps:0',
+                          'loss_scale_skipped_steps:0'):
             self.assertEquals(v.device, '/device:CPU:0')
           else:
             raise ValueError('Unexpected variable %s' % v.name)
@@ -570,6 +598,189 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
         device='cpu', data_format='NHWC')  # NHWC required when --device=cpu
     self._train_and_eval_local(params)
 
+  def testAutoDataFormat(self):
+    params = test_util.get_params('testAutoDataFormat')._replace(
+        data_format='auto')
+    self._train_and_eval_local(params)
+
+  def testGetDataType(self):
+    params = benchmark_cnn.make_params()
+    self.assertEqual(benchmark_cnn.get_data_type(params), tf.float32)
+    self.assertEqual(
+        benchmark_cnn.get_data_type(params._replace(use_fp16=True)),
+        tf.float16)
+    self.assertEqual(
+        benchmark_cnn.get_data_type(params._replace(compute_dtype='bfloat16')),
+        tf.bfloat16)
+
+  def testBfloat16(self):
+    if not _has_bfloat16_cpu_kernels():
+      self.skipTest('This TensorFlow build has no bfloat16 CPU kernels')
+    params = test_util.get_params('testBfloat16')._replace(
+        device='cpu', num_gpus=1, data_format='NHWC', compute_dtype='bfloat16')
+    self._train_and_eval_local(params)
+
+  def testGetLossScaleStats(self):
+    stats = benchmark_cnn.get_loss_scale_stats(
+        {'loss_scale': 128., 'loss_scale_skipped_steps': 3},
+        {'loss_scale': 32., 'loss_scale_skipped_steps': 5}, 40)
+    self.assertEqual(stats['loss_scale'], 32.)
+    self.assertEqual(stats['loss_scale_skipped_steps'], 2)
+    self.assertAlmostEqual(stats['loss_scale_overflow_rate'], 0.05)
+
+  def testLossScaleSkippedStepsMultiDevice(self):
+    # The loss scale is so large that the fp16 gradients of every step
+    # overflow.
+    params = test_util.get_params(
+        'testLossScaleSkippedStepsMultiDevice')._replace(
+            variable_update='replicated', use_fp16=True,
+            fp16_enable_auto_loss_scale=True, fp16_loss_scale=2. ** 100,
+            fp16_inc_loss_scale_every_n=1000)
+    stats = benchmark_cnn.BenchmarkCNN(params).run()
+    # The gradients are applied on both GPUs, but each skipped step must be
+    # counted, and must decrease the loss scale, only once.
+    self.assertGreater(stats['loss_scale_skipped_steps'], 0)
+    self.assertEqual(stats['loss_scale_overflow_rate'], 1.)
+    self.assertEqual(stats['loss_scale'],
+                     2. ** (100 - stats['loss_scale_skipped_steps']))
+
+  def testGetXlaStepStats(self):
+    stats = benchmark_cnn.get_xla_step_stats(5.2, [0.2, 0.2, 3., 0.2, 0.5])
+    self.assertAlmostEqual(stats['xla_first_step_overhead_secs'], 5.)
+    # Only the third step is slower than both 3 times the median and the
+    # median plus half the first-step overhead.
+    self.assertEqual(stats['xla_recompile_steps'], [2])
+
+    # Without warm up, the first measured step is the one that compiled.
+    stats = benchmark_cnn.get_xla_step_stats(
+        5.2, [5.2, 0.2, 0.2, 0.2], first_step_measured=True)
+    self.assertAlmostEqual(stats['xla_first_step_overhead_secs'], 5.)
+    self.assertEqual(stats['xla_recompile_steps'], [])
+
+  def _get_xla_compiled_ops(self, xla_compile_scope):
+    """Returns the compiled and the uncompiled ops of the graph."""
+    params = test_util.get_params('testXlaCompileScope')._replace(
+        xla=True, xla_compile_scope=xla_compile_scope)
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    compiled = []
+    not_compiled = []
+    with tf.Graph().as_default() as graph:
+      bench._build_model()
+    for op in graph.get_operations():
+      try:
+        is_compiled = op.get_attr('_XlaCompile')
+      except ValueError:
+        is_compiled = False
+      (compiled if is_compiled else not_compiled).append(op)
+    return compiled, not_compiled
+
+  def _assert_input_and_updates_not_compiled(self, compiled, not_compiled):
+    for op in compiled:
+      self.assertNotIn('synthetic_', op.name)
+      self.assertNotEqual(op.type, 'ApplyGradientDescent')
+    self.assertTrue(any('synthetic_images' in op.name for op in not_compiled))
+    self.assertTrue(any(op.type == 'ApplyGradientDescent'
+                        for op in not_compiled))
+
+  def testXlaCompileScopeTower(self):
+    compiled, not_compiled = self._get_xla_compiled_ops('tower')
+    # The forward and backward pass of the model, and the loss.
+    compiled_types = set(op.type for op in compiled)
+    self.assertIn('MatMul', compiled_types)
+    self.assertIn('SparseSoftmaxCrossEntropyWithLogits', compiled_types)
+    self._assert_input_and_updates_not_compiled(compiled, not_compiled)
+
+  def testXlaCompileScopeModel(self):
+    compiled, not_compiled = self._get_xla_compiled_ops('model')
+    compiled_types = set(op.type for op in compiled)
+    self.assertIn('MatMul', compiled_types)
+    # The loss is not part of the layers of the model.
+    self.assertNotIn('SparseSoftmaxCrossEntropyWithLogits', compiled_types)
+    self._assert_input_and_updates_not_compiled(compiled, not_compiled)
+
+  def testGetSummaryStats(self):
+    stats = benchmark_cnn.get_summary_stats([0.2, 0.3, 0.2, 0.2, 0.1], [1, 4])
+    self.assertEqual(stats['num_summaries'], 2)
+    # Only the second step is slower than the median of the other steps.
+    self.assertAlmostEqual(stats['summary_secs'], 0.1)
+    self.assertAlmostEqual(stats['summary_overhead'], 0.1)
+
+  def testGetModelConfig(self):
+    for dataset_name in ('imagenet', 'cifar10'):
+      dataset = datasets.create_dataset(None, dataset_name)
+      model_names = model_config._get_model_map(dataset_name).keys()
+      for model_name in model_names:
+        # The model modules are imported on first use.
+        self.assertIsInstance(model_config.get_model_config(model_name,
+                                                            dataset),
+                              model_lib.Model)
+    with self.assertRaises(ValueError):
+      model_config.get_model_config('no_such_model', dataset)
+
+    model_config.register_model(
+        'testGetModelConfig', 'cifar10',
+        lambda: model_config.get_model_config('trivial', dataset))
+    self.addCleanup(model_config._get_model_map('cifar10').pop,
+                    'testGetModelConfig')
+    self.assertEqual(
+        model_config.get_model_config('testGetModelConfig', dataset)
+        .get_model(), 'trivial')
+    with self.assertRaises(ValueError):
+      model_config.register_model('trivial', 'cifar10', lambda: None)
+
+  def testAutoDataFormatCpu(self):
+    cache_file = os.path.join(self.get_temp_dir(), 'data_format_cache.json')
+    params = benchmark_cnn.make_params(
+        model='trivial', batch_size=2, device='cpu', data_format='auto',
+        data_format_cache_file=cache_file)
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    # NCHW is not supported on CPU without MKL, so NHWC is the only candidate.
+    self.assertEqual(bench.data_format, 'NHWC')
+    self.assertEqual(bench.params.data_format, 'NHWC')
+    with open(cache_file) as f:
+      self.assertEqual(list(json.load(f).values()), ['NHWC'])
+
+  def testDataFormatCacheKeyIncludesDeviceName(self):
+    params = benchmark_cnn.make_params(model='trivial', device='cpu')
+    model = model_config.get_model_config(
+        'trivial', datasets.create_dataset(None, 'imagenet'))
+    key = benchmark_cnn._data_format_cache_key(params, model)
+    self.assertIn('|%s|' % benchmark_cnn._get_device_description(params), key)
+    self.assertTrue(benchmark_cnn._get_device_description(params))
+
+  def testGraphCache(self):
+    graph_cache_dir = os.path.join(self.get_temp_dir(), 'graph_cache')
+    params = test_util.get_params('testGraphCache')._replace(
+        variable_update='replicated', graph_cache_dir=graph_cache_dir)
+    stats = benchmark_cnn.BenchmarkCNN(params).run()
+    self.assertIn('build_graph', stats['startup_secs'])
+    self.assertIn('first_step', stats['startup_secs'])
+    self.assertEqual(len(os.listdir(graph_cache_dir)), 1)
+
+    # Params that do not affect the graph do not change the cache key.
+    stats = benchmark_cnn.BenchmarkCNN(params._replace(num_batches=5)).run()
+    self.assertIn('import_graph', stats['startup_secs'])
+    self.assertNotIn('build_graph', stats['startup_secs'])
+    self.assertEqual(stats['num_steps'], 5)
+
+    stats = benchmark_cnn.BenchmarkCNN(params._replace(batch_size=4)).run()
+    self.assertIn('build_graph', stats['startup_secs'])
+    self.assertEqual(len(os.listdir(graph_cache_dir)), 2)
+
+  def testGraphCacheKeyIncludesModelSource(self):
+    module_name = 'testGraphCacheKeyIncludesModelSource_model'
+    module = types.ModuleType(module_name)
+    module.__file__ = os.path.join(self.get_temp_dir(), module_name + '.py')
+    sys.modules[module_name] = module
+    self.addCleanup(sys.modules.pop, module_name)
+    model = type('Model', (object,), {'__module__': module_name})()
+    digests = []
+    for source in ('x = 1\n', 'x = 2\n'):
+      with open(module.__file__, 'w') as f:
+        f.write(source)
+      digests.append(benchmark_cnn._get_source_digest(model))
+    self.assertNotEqual(digests[0], digests[1])
+
   def testMomentumParameterServer(self):
     params = test_util.get_params('testMomentumParameterServer')._replace(
         optimizer='momentum', momentum=0.8)
@@ -600,6 +811,49 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
         weight_decay=0.0001)
     self._train_and_eval_local(params)
 
+  def testGradientAccumulation(self):
+    params = test_util.get_params('testGradientAccumulation')._replace(
+        gradient_accumulation_steps=3)
+    self._train_and_eval_local(params)
+
+  def testGradientAccumulationReplicated(self):
+    params = test_util.get_params(
+        'testGradientAccumulationReplicated')._replace(
+            gradient_accumulation_steps=2, variable_update='replicated')
+    self._train_and_eval_local(params)
+
+  def testRecomputeActivationsBlocks(self):
+    params = benchmark_cnn.make_params(
+        model='resnet20', data_name='cifar10', batch_size=2, num_batches=2,
+        num_warmup_batches=0, device='cpu', data_format='NHWC',
+        recompute_activations='blocks')
+    checkpoints = []
+
+    def gradients(ys, xs, block_checkpoints, **kwargs):
+      checkpoints.extend(block_checkpoints)
+      return gradient_checkpointing.gradients(ys, xs, block_checkpoints,
+                                              **kwargs)
+
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    with test.mock.patch.object(benchmark_cnn.gradient_checkpointing,
+                                'gradients', gradients):
+      with tf.Graph().as_default():
+        bench._build_model()
+        # ResNet-20 has three stages of three residual blocks.
+        self.assertEqual(len(checkpoints), 9)
+        self.assertEqual(
+            checkpoints,
+            tf.get_collection(convnet_builder.BLOCK_OUTPUTS_COLLECTION))
+    stats = bench.run()
+    # MaxBytesInUse is only available on GPU, so the peak resident set size of
+    # the process is reported on CPU.
+    self.assertGreater(stats['peak_memory_bytes'], 0)
+
+  def testRecomputeActivationsSqrt(self):
+    params = test_util.get_params('testRecomputeActivationsSqrt')._replace(
+        recompute_activations='sqrt', variable_update='replicated')
+    self._train_and_eval_local(params)
+
   def testNoLayers(self):
     params = test_util.get_params('testNoLayers')._replace(use_tf_layers=False)
     self._train_and_eval_local(params)
@@ -677,6 +931,274 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
             data_dir=imagenet_dir, data_name='imagenet', distortions=False)
     self._train_and_eval_local(params, use_test_preprocessor=False)
 
+  def testImagenetPreprocessorVectorizedDistortions(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    params = test_util.get_params(
+        'testImagenetPreprocessorVectorizedDistortions')._replace(
+            data_dir=imagenet_dir, data_name='imagenet',
+            vectorized_distortions=True)
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+
+  def testImagenetPreprocessorRecordInput(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    params = test_util.get_params(
+        'testImagenetPreprocessorRecordInput')._replace(
+            data_dir=imagenet_dir, data_name='imagenet', use_datasets=False)
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+
+  def testRecordInputGraphSizeIndependentOfBatchSize(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    dataset = datasets.create_dataset(imagenet_dir, 'imagenet')
+    num_ops = []
+    for batch_size in [2, 16]:
+      with tf.Graph().as_default() as graph:
+        preprocessor = preprocessing.RecordInputImagePreprocessor(
+            224, 224, batch_size, 2, tf.float32, train=True, distortions=True,
+            resize_method='bilinear')
+        preprocessor.minibatch(dataset, 'train', use_datasets=False,
+                               cache_data=False)
+        num_ops.append(len(graph.get_operations()))
+    self.assertEqual(num_ops[0], num_ops[1])
+
+  def testInputAutotune(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    params = test_util.get_params('testInputAutotune')._replace(
+        data_dir=imagenet_dir, data_name='imagenet', input_autotune=True,
+        datasets_use_prefetch=False)
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+
+  def testInputAutotuneRecordInput(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    params = test_util.get_params('testInputAutotuneRecordInput')._replace(
+        data_dir=imagenet_dir, data_name='imagenet', input_autotune=True,
+        use_datasets=False)
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    self.assertIn(bench.params.record_input_parallelism, (16, 64, 128))
+
+  def testInputAutotuneMemoryBudget(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    # No setting fits in the budget, so the one using the least memory is
+    # chosen without timing any of them.
+    params = test_util.get_params('testInputAutotuneMemoryBudget')._replace(
+        data_dir=imagenet_dir, data_name='imagenet', input_autotune=True,
+        input_autotune_memory_budget_mb=1)
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    self.assertEqual(bench.params.datasets_interleave_cycle_length, 4)
+    self.assertEqual(bench.params.datasets_num_parallel_batches, 2)
+    self.assertEqual(bench.params.datasets_record_prefetch_buffer_size, 4)
+
+  def testImagenetRawPixels(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    raw_dir = os.path.join(self.get_temp_dir(), 'imagenet_raw')
+    convert_to_raw_tfrecords.convert(imagenet_dir, raw_dir,
+                                     ['train', 'validation'], resolution=256)
+    record = next(tf.python_io.tf_record_iterator(
+        os.path.join(raw_dir, 'train-00000-of-00008')))
+    with tf.Graph().as_default():
+      image, label = preprocessing.parse_raw_example_proto(record)
+      with self.test_session() as sess:
+        image_value, label_value = sess.run([image, label])
+    self.assertEqual(image_value.shape, (256, 256, 3))
+    self.assertEqual(label_value.shape, (1,))
+
+    params = test_util.get_params('testImagenetRawPixels')._replace(
+        data_dir=raw_dir, data_name='imagenet_raw')
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+
+  def testShardedCheckpoint(self):
+    params = test_util.get_params('testShardedCheckpoint')._replace(
+        sharded_checkpoint=True, local_parameter_device='gpu')
+    self._train_and_eval_local(params)
+    # With --local_parameter_device=gpu, the variables are spread across the
+    # two GPUs, so each checkpoint has a shard per device.
+    checkpoint_path = tf.train.latest_checkpoint(params.train_dir)
+    shards = tf.gfile.Glob(checkpoint_path + '.data-*')
+    self.assertGreater(len(shards), 1)
+    for shard in shards:
+      self.assertRegexpMatches(shard, r'\.data-\d{5}-of-%05d$' % len(shards))
+
+  def testAsyncCheckpoint(self):
+    params = test_util.get_params('testAsyncCheckpoint')._replace(
+        async_checkpoint=True)
+    # Evaluation reads the checkpoint written in the background.
+    self._train_and_eval_local(params)
+    stats = benchmark_cnn.BenchmarkCNN(params).run()
+    # Only the final checkpoint is saved, since --save_model_secs is 0.
+    self.assertEqual(len(stats['checkpoint_secs']), 1)
+
+  def testAsyncSummaries(self):
+    params = test_util.get_params('testAsyncSummaries')._replace(
+        summary_verbosity=3, save_summaries_steps=5, async_summaries=True,
+        summary_histogram_max_values=4)
+    stats = benchmark_cnn.BenchmarkCNN(params).run()
+    # Summaries are collected every 5 of the 20 measured steps, unless the
+    # previous summary is still being written.
+    self.assertEqual(
+        stats['num_summaries'] + stats['num_skipped_summaries'], 4)
+    self.assertGreaterEqual(stats['summary_write_secs'], 0)
+
+    num_histograms = 0
+    for path in tf.gfile.Glob(os.path.join(params.train_dir, 'events.*')):
+      for event in tf.train.summary_iterator(path):
+        for value in event.summary.value:
+          if value.HasField('histo'):
+            self.assertLessEqual(value.histo.num, 4)
+            num_histograms += 1
+    self.assertGreater(num_histograms, 0)
+
+  def testEvalCache(self):
+    imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
+                                'fake_tf_record_data')
+    eval_cache_dir = os.path.join(self.get_temp_dir(), 'eval_cache')
+    params = test_util.get_params('testEvalCache')._replace(
+        data_dir=imagenet_dir, data_name='imagenet',
+        eval_cache_dir=eval_cache_dir)
+    # The evaluation done by _train_and_eval_local writes the cache.
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+    cache_files = os.listdir(eval_cache_dir)
+    self.assertTrue(cache_files)
+    for cache_file in cache_files:
+      self.assertNotIn('.tmp-', cache_file)
+      self.assertFalse(cache_file.endswith('.lockfile'))
+    # Later evaluations read from the cache, and all give the same results.
+    eval_params = params._replace(eval=True)
+    eval_outputs = [
+        test_util.get_evaluation_outputs_from_logs(
+            self._run_benchmark_cnn(eval_params))
+        for _ in range(2)
+    ]
+    self.assertEqual(eval_outputs[0], eval_outputs[1])
+
+  def testFinalizeIncompleteEvalCache(self):
+    cache_file = os.path.join(self.get_temp_dir(), 'incomplete_eval_cache')
+    temp_file = data_utils.get_eval_cache_temp_file(cache_file)
+    for suffix in ('.lockfile', '.data-00000-of-00001'):
+      with open(temp_file + suffix, 'w'):
+        pass
+    self.assertFalse(data_utils.finalize_eval_cache(cache_file))
+    self.assertFalse([f for f in os.listdir(self.get_temp_dir())
+                      if f.startswith('incomplete_eval_cache')])
+
+  def _run_eval_during_training(self, params):
+    logs = []
+    benchmark_cnn.log_fn = test_util.print_and_add_to_list(logs)
+    stats = benchmark_cnn.BenchmarkCNN(params).run()
+    training_outputs = test_util.get_training_outputs_from_logs(
+        logs, params.print_training_accuracy)
+    self.assertEqual(len(training_outputs), params.num_batches)
+    # 20 steps with an eval every 5 steps give at most 4 evals. An eval is
+    # skipped if the previous one is still running, but the first one never is.
+    self.assertGreaterEqual(stats['num_evals'], 1)
+    self.assertLessEqual(stats['num_evals'], 4)
+    self.assertGreater(stats['eval_images_per_sec'], 0)
+    self.assertGreaterEqual(stats['eval_top_1_accuracy'], 0)
+    self.assertTrue(any('eval images/sec' in log for log in logs))
+
+  def testEvalDuringTraining(self):
+    params = test_util.get_params('testEvalDuringTraining')._replace(
+        eval_during_training_every_n_steps=5, num_eval_batches=2,
+        eval_dir=test_util.get_temp_dir('testEvalDuringTrainingEval'))
+    self._run_eval_during_training(params)
+
+  def testEvalDuringTrainingOnOtherDevices(self):
+    params = test_util.get_params(
+        'testEvalDuringTrainingOnOtherDevices')._replace(
+            variable_update='replicated', eval_during_training_every_n_steps=5,
+            num_eval_batches=2, num_eval_gpus=1, num_eval_intra_threads=1,
+            eval_dir=test_util.get_temp_dir(
+                'testEvalDuringTrainingOnOtherDevicesEval'))
+    self._run_eval_during_training(params)
+
+  def testEvalDuringTrainingSessionConfig(self):
+    params = test_util.get_params(
+        'testEvalDuringTrainingSessionConfig')._replace(
+            eval_during_training_every_n_steps=5, num_eval_batches=2,
+            num_intra_threads=2, num_eval_intra_threads=3)
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    with tf.Graph().as_default():
+      bench._build_model()
+      evaluator = benchmark_cnn.ConcurrentEvaluator(
+          bench._get_eval_during_training_bench(),
+          bench.variable_mgr.savable_variables())
+    config = evaluator.get_session_config()
+    # The thread pools of the training session are shared by default, so the
+    # eval session must have its own for num_eval_intra_threads to be used.
+    self.assertTrue(config.use_per_session_threads)
+    self.assertEqual(config.intra_op_parallelism_threads, 3)
+
+  def _reshard_fake_imagenet_data(self, data_dir):
+    """Reshards the fake ImageNet data, so that it has an exact index."""
+    input_dir = os.path.join(platforms_util.get_test_data_dir(),
+                             'fake_tf_record_data')
+    for subset in ('train', 'validation'):
+      input_paths = sorted(
+          tf.gfile.Glob(os.path.join(input_dir, '%s-*-of-*' % subset)))
+      tfrecord_index.reshard(input_paths, data_dir, subset, 2, seed=1)
+
+  def _get_eval_num_examples(self, logs):
+    accuracy_logs = [log for log in logs if 'Accuracy @ ' in log]
+    self.assertEqual(len(accuracy_logs), 1)
+    return int(re.search(r'\[(\d+) examples\]', accuracy_logs[0]).group(1))
+
+  def testEvalFullPass(self):
+    data_dir = os.path.join(self.get_temp_dir(), 'full_pass_data')
+    self._reshard_fake_imagenet_data(data_dir)
+    # The global batch size of 6 does not divide the 128 validation images, so
+    # the last batch is padded.
+    params = test_util.get_params('testEvalFullPass')._replace(
+        data_dir=data_dir, data_name='imagenet', batch_size=3,
+        eval_full_pass=True)
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+    logs = self._run_benchmark_cnn(params._replace(eval=True))
+    self.assertEqual(self._get_eval_num_examples(logs), 128)
+    self.assertIn('eval mode: full pass, central crop', logs)
+
+  def testEvalMultiCrop(self):
+    data_dir = os.path.join(self.get_temp_dir(), 'multi_crop_data')
+    self._reshard_fake_imagenet_data(data_dir)
+    params = test_util.get_params('testEvalMultiCrop')._replace(
+        data_dir=data_dir, data_name='imagenet', batch_size=3,
+        eval_full_pass=True, eval_crop_mode='ten_crop',
+        eval_crop_scales=['1.15', '1.3'])
+    self._train_and_eval_local(params, use_test_preprocessor=False)
+    for use_datasets in (True, False):
+      logs = self._run_benchmark_cnn(
+          params._replace(eval=True, use_datasets=use_datasets,
+                          eval_full_pass=use_datasets))
+      if use_datasets:
+        self.assertEqual(self._get_eval_num_examples(logs), 128)
+      self.assertTrue(any('total crops/sec' in log for log in logs))
+
+  def testEvalCropsImage(self):
+    image = tf.reshape(tf.range(10 * 16 * 3, dtype=tf.float32), [10, 16, 3])
+    with self.test_session() as sess:
+      crops = sess.run(preprocessing.eval_image_crops(
+          image, 10, 10, 0, 'bilinear', 'ten_crop', [1., 1.5]))
+      self.assertEqual(crops.shape, (20, 10, 10, 3))
+      # At scale 1, the image is not resized since its shorter side is the crop
+      # size, so the crops are slices of the image.
+      image_value = sess.run(image)
+      self.assertAllClose(crops[0], image_value[:, 3:13])
+      self.assertAllClose(crops[1], image_value[:, :10])
+      self.assertAllClose(crops[4], image_value[:, 6:])
+      self.assertAllClose(crops[5], crops[0][:, ::-1])
+
+  def testEvalCropsImageScaleOne(self):
+    # 270 * (224 / 270) is slightly below 224 in fp32, so truncating the
+    # resized height would make it smaller than the crop.
+    image = tf.zeros([270, 400, 3])
+    with self.test_session() as sess:
+      crops = sess.run(preprocessing.eval_image_crops(
+          image, 224, 224, 0, 'bilinear', 'ten_crop', [1.]))
+      self.assertEqual(crops.shape, (10, 224, 224, 3))
+
   def testImagenetPreprocessorVerboseSummary(self):
     imagenet_dir = os.path.join(platforms_util.get_test_data_dir(),
                                 'fake_tf_record_data')
@@ -821,6 +1343,52 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
                   batch_position, resize_method, distortions, summary_verbosity,
                   fuse_decode_and_crop)
 
+  def testDistortImageBatch(self):
+    # Solid black and white images stay (roughly) solid black and white
+    # after being flipped and color distorted.
+    images = np.concatenate([np.zeros((3, 8, 6, 3)),
+                             np.full((3, 8, 6, 3), 255.)]).astype(np.float32)
+    for distortions in [True, False]:
+      for distort_color_in_yiq in [True, False]:
+        new_images = preprocessing.distort_image_batch(
+            tf.constant(images), distortions, distort_color_in_yiq)
+        self.assertEqual(new_images.shape, images.shape)
+        with self.test_session(use_gpu=True) as sess:
+          new_images_value = sess.run(new_images)
+        self.assertAllClose(new_images_value, images, atol=50., rtol=0.)
+
+  def testGetWorkerFiles(self):
+    file_names = ['f%d' % i for i in [3, 0, 4, 2, 1]]
+    self.assertEqual(data_utils.get_worker_files(file_names, 0, 1),
+                     (['f0', 'f1', 'f2', 'f3', 'f4'], False))
+    self.assertEqual(data_utils.get_worker_files(file_names, 0, 2),
+                     (['f0', 'f2', 'f4'], False))
+    self.assertEqual(data_utils.get_worker_files(file_names, 1, 2),
+                     (['f1', 'f3'], False))
+    self.assertEqual(data_utils.get_worker_files(file_names, 3, 8),
+                     (['f0', 'f1', 'f2', 'f3', 'f4'], True))
+
+  def testCreateIteratorShardsFilesAcrossWorkers(self):
+    data_dir = os.path.join(platforms_util.get_test_data_dir(),
+                            'fake_tf_record_data')
+    dataset = datasets.create_dataset(data_dir, 'imagenet')
+    file_names = sorted(tf.gfile.Glob(dataset.tf_record_pattern('train')))
+    num_workers = 2
+    for worker_index in range(num_workers):
+      worker_records = set()
+      for file_name in file_names[worker_index::num_workers]:
+        worker_records.update(tf.python_io.tf_record_iterator(file_name))
+      with tf.Graph().as_default():
+        iterator = data_utils.create_iterator(
+            batch_size=8, num_splits=1, batch_size_per_split=8,
+            preprocess_fn=lambda value, unused_batch_position: value,
+            dataset=dataset, subset='train', train=True, cache_data=False,
+            worker_index=worker_index, num_workers=num_workers)
+        with self.test_session() as sess:
+          records = sess.run(iterator.get_next())
+      for record in records:
+        self.assertIn(record, worker_records)
+
   def _test_learning_rate(self, params, global_step_to_expected_learning_rate):
     bench = benchmark_cnn.BenchmarkCNN(params)
     with tf.Graph().as_default() as graph:
@@ -895,6 +1463,65 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
         100000000: 0.01
     })
 
+  def testGetLearningRateTable(self):
+    params = benchmark_cnn.make_params(init_learning_rate=1.,
+                                       num_learning_rate_warmup_epochs=2)
+    self.assertEqual(
+        benchmark_cnn.get_learning_rate_table(params, 1000, 10),
+        [(0, 0., 0.005, 1., 1), (200, 1., 0., 1., 1)])
+
+    params = benchmark_cnn.make_params(init_learning_rate=1.,
+                                       learning_rate_decay_factor=0.5,
+                                       num_epochs_per_decay=1,
+                                       minimum_learning_rate=0.2)
+    self.assertEqual(
+        benchmark_cnn.get_learning_rate_table(params, 1000, 10),
+        [(0, 1., 0., 0.5, 100), (300, 0.2, 0., 1., 1)])
+
+    # The warmup ends between two decays, which stay at multiples of 100.
+    params = params._replace(num_learning_rate_warmup_epochs=1.5)
+    self.assertEqual(
+        benchmark_cnn.get_learning_rate_table(params, 1000, 10),
+        [(0, 0., 1. / 150, 1., 1), (150, 0.5, 0., 1., 1),
+         (200, 0.25, 0., 0.5, 100), (300, 0.2, 0., 1., 1)])
+
+    # Without a minimum, the decay is a single row however slow it is.
+    params = params._replace(num_learning_rate_warmup_epochs=0,
+                             learning_rate_decay_factor=0.99999,
+                             minimum_learning_rate=0)
+    self.assertEqual(
+        benchmark_cnn.get_learning_rate_table(params, 1000, 10),
+        [(0, 1., 0., 0.99999, 100)])
+
+    params = benchmark_cnn.make_params(
+        piecewise_learning_rate_schedule='1;3;.1;5;.01',
+        num_learning_rate_warmup_epochs=4)
+    self.assertEqual(
+        benchmark_cnn.get_learning_rate_table(params, 1000, 10),
+        [(0, 0., 0.0025, 1., 1), (400, .1, 0., 1., 1), (500, .01, 0., 1., 1)])
+
+    # The schedule is defined by the model.
+    self.assertIsNone(benchmark_cnn.get_learning_rate_table(
+        benchmark_cnn.make_params(), 1000, 10))
+
+    params = benchmark_cnn.make_params(
+        piecewise_learning_rate_schedule='1;5;.1;3;.01')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.get_learning_rate_table(params, 1000, 10)
+
+  def testLearningRateTableFile(self):
+    table_file = os.path.join(self.get_temp_dir(), 'learning_rate_table.txt')
+    params = test_util.get_params('testLearningRateTableFile')._replace(
+        init_learning_rate=0.1, num_learning_rate_warmup_epochs=1,
+        learning_rate_table_file=table_file)
+    self._train_and_eval_local(params)
+    with open(table_file) as f:
+      lines = f.read().splitlines()
+    self.assertEqual(len(lines), 3)
+    self.assertTrue(lines[0].startswith('#'))
+    self.assertEqual(lines[1].split()[:2], ['0', '0'])
+    self.assertEqual(float(lines[2].split()[1]), 0.1)
+
   def testNumBatchesAndEpochs(self):
     params = benchmark_cnn.make_params()
     batches, epochs = benchmark_cnn.get_num_batches_and_epochs(params, 10, 100)
@@ -927,6 +1554,77 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
     with self.assertRaises(ValueError):
       benchmark_cnn.BenchmarkCNN(params)
 
+    params = benchmark_cnn.make_params(eval=True,
+                                       eval_during_training_every_n_steps=5)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(device='cpu',
+                                       eval_during_training_every_n_steps=5,
+                                       num_eval_gpus=1)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(eval=True, eval_full_pass=True,
+                                       use_datasets=False)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(async_checkpoint=True,
+                                       sharded_checkpoint=True)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    test_util.monkey_patch_base_cluster_manager()
+    params = benchmark_cnn.make_params(eval=True, eval_full_pass=True,
+                                       job_name='worker', worker_hosts='w1,w2',
+                                       ps_hosts='p1', task_index=0)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(eval=True, eval_crop_mode='ten_crop')
+    with self.assertRaises(ValueError):
+      # Synthetic data has no crops.
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(eval=True, eval_crop_scales=['0.5'])
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(xla_compile_scope='tower')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(eval=True, graph_cache_dir='/tmp')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(use_fp16=True, compute_dtype='bfloat16')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(shard_optimizer_state=True)
+    with self.assertRaises(ValueError):
+      # Requires --variable_update=replicated.
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(shard_optimizer_state=True,
+                                       variable_update='replicated',
+                                       all_reduce_spec='nccl')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(fused_optimizer=True,
+                                       optimizer='rmsprop')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    params = benchmark_cnn.make_params(fused_optimizer=True,
+                                       shard_optimizer_state=True,
+                                       variable_update='replicated')
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
     # Automatic loss scaling is only supported for 'replicated', 'ps',
     # and 'independent' variable_updates.
     invalid_variable_updates = [
@@ -959,6 +1657,29 @@ class TfCnnBenchmarksTest(tf.test.TestCase):
     with self.assertRaises(ValueError):
       benchmark_cnn.BenchmarkCNN(params)
 
+    # Gradient accumulation is not supported for 'staged_vars'.
+    params = benchmark_cnn.make_params(
+        gradient_accumulation_steps=2,
+        variable_update='parameter_server',
+        staged_vars=True)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+    # The eval cache requires datasets.
+    params = benchmark_cnn.make_params(
+        eval=True, eval_cache_dir=self.get_temp_dir(), use_datasets=False)
+    with self.assertRaises(ValueError):
+      benchmark_cnn.BenchmarkCNN(params)
+
+  def testGetL2LossShards(self):
+    params = [tf.zeros(shape) for shape in
+              [(10,), (3, 3), (100,), (2,), (50, 2), (1,)]]
+    shards = benchmark_cnn.get_l2_loss_shards(params, 2)
+    self.assertEqual(shards, [[0, 2, 5], [1, 3, 4]])
+    shards = benchmark_cnn.get_l2_loss_shards(params, 8)
+    self.assertEqual(sorted(sum(shards, [])), list(range(len(params))))
+    self.assertEqual(shards[6:], [[], []])
+
   def testMakeParams(self):
     default_params = benchmark_cnn.make_params()
     self.assertEqual(default_params.model,
@@ -1094,6 +1815,46 @@ class VariableUpdateTest(tf.test.TestCase):
         single_l2_loss_op=True)
     self._test_variable_updates(params)
 
+  def testFusedOptimizer(self):
+    params = test_util.get_var_update_params()._replace(fused_optimizer=True)
+    self._test_variable_updates(params)
+
+  def testFusedOptimizerMomentum(self):
+    params = test_util.get_var_update_params()._replace(
+        optimizer='momentum', fused_optimizer=True)
+    self._test_variable_updates(params)
+
+  def testShardL2Loss(self):
+    params = test_util.get_var_update_params()._replace(shard_l2_loss=True)
+    self._test_variable_updates(params)
+
+  def testShardOptimizerState(self):
+    params = test_util.get_var_update_params()._replace(
+        optimizer='momentum', shard_optimizer_state=True)
+    self._test_variable_updates(params, var_updates=('replicated',))
+
+  def testShardOptimizerStateSavesAllSlots(self):
+    params = test_util.get_var_update_params()._replace(
+        optimizer='momentum', shard_optimizer_state=True,
+        variable_update='replicated')
+    bench = benchmark_cnn.BenchmarkCNN(params)
+    with tf.Graph().as_default():
+      bench._build_model()
+      saved_var_names = set(
+          v.op.name for v in bench.variable_mgr.savable_variables().values())
+      slots = [v for v in tf.global_variables()
+               if v.op.name.endswith('/Momentum')]
+    # The slots of the variables owned by GPU 1 only exist on GPU 1, and must
+    # be saved too.
+    self.assertTrue(any(v.op.name.startswith('v1/') for v in slots))
+    for v in slots:
+      self.assertIn(v.op.name, saved_var_names)
+
+  def testShardL2LossSingleL2LossOp(self):
+    params = test_util.get_var_update_params()._replace(
+        shard_l2_loss=True, single_l2_loss_op=True)
+    self._test_variable_updates(params)
+
   def testResourceVars(self):
     params = test_util.get_var_update_params()._replace(
         use_resource_vars=True)
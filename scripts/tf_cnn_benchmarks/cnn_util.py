@@ -18,8 +18,11 @@ from __future__ import print_function
 
 import sys
 import threading
+import time
 
 import numpy as np
+import six
+from six.moves import queue
 import tensorflow as tf
 
 
@@ -198,6 +201,297 @@ class ImageProducer(object):
       self.put_barrier.wait()
 
 
+class CheckpointWatcher(object):
+  """Waits for new checkpoints to be written to a directory.
+
+  On Linux, if the optional inotify_simple package is installed and the
+  directory is local, the watcher is woken up by inotify when the checkpoint
+  state file changes. Otherwise, the directory is polled every `poll_secs`.
+
+  Only the latest checkpoint is ever returned: if several checkpoints are
+  written while the caller is busy, the older ones are skipped.
+
+  Example usage:
+  ```
+  watcher = cnn_util.CheckpointWatcher(train_dir, poll_secs=10)
+  while True:
+    checkpoint_path = watcher.wait_for_new_checkpoint()
+    saver.restore(sess, checkpoint_path)
+    ...
+  ```
+  """
+
+  def __init__(self, checkpoint_dir, poll_secs=1.):
+    self.checkpoint_dir = checkpoint_dir
+    self.poll_secs = poll_secs
+    self.last_checkpoint_path = None
+    self._inotify = None
+    try:
+      import inotify_simple  # pylint: disable=g-import-not-at-top
+      inotify = inotify_simple.INotify()
+      inotify.add_watch(checkpoint_dir,
+                        inotify_simple.flags.CLOSE_WRITE |
+                        inotify_simple.flags.MOVED_TO |
+                        inotify_simple.flags.CREATE)
+      self._inotify = inotify
+    except (ImportError, OSError):
+      # inotify is unavailable, or the directory is not local or does not
+      # exist yet.
+      pass
+
+  def _wait(self, secs):
+    """Waits up to `secs` seconds for the directory to change."""
+    if self._inotify:
+      self._inotify.read(timeout=int(secs * 1000))
+    else:
+      time.sleep(min(secs, self.poll_secs))
+
+  def wait_for_new_checkpoint(self, timeout_secs=None):
+    """Returns the path of the latest checkpoint once a new one is written.
+
+    Args:
+      timeout_secs: The maximum number of seconds to wait. If None, waits
+        forever.
+    Returns:
+      The path of the latest checkpoint, or None if no new checkpoint was
+      written within `timeout_secs`.
+    """
+    deadline = None if timeout_secs is None else time.time() + timeout_secs
+    while True:
+      checkpoint_path = tf.train.latest_checkpoint(self.checkpoint_dir)
+      if checkpoint_path and checkpoint_path != self.last_checkpoint_path:
+        self.last_checkpoint_path = checkpoint_path
+        return checkpoint_path
+      if deadline is None:
+        self._wait(self.poll_secs)
+      else:
+        remaining_secs = deadline - time.time()
+        if remaining_secs <= 0:
+          return None
+        self._wait(remaining_secs)
+
+
+class BackgroundWriter(object):
+  """Writes items on a background thread, one at a time.
+
+  Subclasses implement `_write`, and typically call `_put` from a method that
+  takes a snapshot of the training session. Exceptions raised by `_write` are
+  reraised by the next call to `wait` or `close`.
+  """
+
+  def __init__(self):
+    self.items = queue.Queue(maxsize=1)
+    self.write_running = threading.Event()
+    self.exc_info = None
+    # The time each item took to write, in seconds.
+    self.write_times = []
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def busy(self):
+    """Returns True if an item is being written."""
+    return self.write_running.is_set()
+
+  def wait(self):
+    """Waits until no item is being written."""
+    while self.write_running.is_set() and self.thread.is_alive():
+      time.sleep(.01)
+    if self.exc_info is not None:
+      exc_info, self.exc_info = self.exc_info, None
+      six.reraise(*exc_info)
+
+  def close(self):
+    """Waits for the item being written, and stops the thread."""
+    self.wait()
+    self.items.put(None)
+    self.thread.join()
+
+  def _put(self, item):
+    """Starts writing `item`. Must only be called when not busy."""
+    self.write_running.set()
+    self.items.put(item)
+
+  def _write(self, item):
+    raise NotImplementedError('_write must be implemented by subclass')
+
+  def _run(self):
+    while True:
+      item = self.items.get()
+      if item is None:
+        return
+      try:
+        start_time = time.time()
+        self._write(item)
+        self.write_times.append(time.time() - start_time)
+      except Exception:  # pylint: disable=broad-except
+        self.exc_info = sys.exc_info()
+      self.write_running.clear()
+
+
+class AsyncCheckpointSaver(BackgroundWriter):
+  """Saves checkpoints without blocking the training session for long.
+
+  `save` fetches the values of the variables into host memory with a single
+  session run, and returns. A background thread then loads the values into a
+  copy of the variables in a separate graph, and writes them with a
+  tf.train.Saver, so the checkpoints are the same as those of the training
+  session's Saver. At most one checkpoint is written at a time.
+
+  Example usage:
+  ```
+  async_saver = cnn_util.AsyncCheckpointSaver(var_list)
+  ...
+  if not async_saver.busy():
+    async_saver.save(sess, checkpoint_path, global_step)
+  ...
+  async_saver.close()
+  ```
+  """
+
+  def __init__(self, var_list, save_relative_paths=True):
+    """Creates the copy of the variables.
+
+    Args:
+      var_list: A list or dict of variables, as passed to tf.train.Saver.
+      save_relative_paths: Passed to tf.train.Saver.
+    """
+    if isinstance(var_list, dict):
+      names_and_variables = sorted(var_list.items())
+    else:
+      names_and_variables = [(v.op.name, v) for v in var_list]
+    self.variables = [v for _, v in names_and_variables]
+    self.graph = tf.Graph()
+    with self.graph.as_default(), tf.device('/cpu:0'):
+      self.placeholders = []
+      snapshot_variables = {}
+      assign_ops = []
+      for i, (name, v) in enumerate(names_and_variables):
+        dtype = v.dtype.base_dtype
+        placeholder = tf.placeholder(dtype, v.get_shape())
+        snapshot_variable = tf.Variable(
+            tf.zeros(v.get_shape(), dtype), name='snapshot_%d' % i)
+        self.placeholders.append(placeholder)
+        snapshot_variables[name] = snapshot_variable
+        assign_ops.append(snapshot_variable.assign(placeholder))
+      self.assign_op = tf.group(*assign_ops)
+      self.saver = tf.train.Saver(snapshot_variables,
+                                  save_relative_paths=save_relative_paths)
+    # Created by the background thread when the first checkpoint is written.
+    self.sess = None
+    super(AsyncCheckpointSaver, self).__init__()
+
+  def save(self, sess, save_path, global_step):
+    """Snapshots the variables in `sess` and writes them in the background.
+
+    If a checkpoint is being written, waits for it to be written first.
+
+    Args:
+      sess: The session to fetch the variables from.
+      save_path: The prefix of the checkpoint files, as in tf.train.Saver.
+      global_step: The global step Tensor, fetched with the variables to name
+        the checkpoint.
+    Returns:
+      The global step of the checkpoint.
+    """
+    self.wait()
+    values, global_step_value = sess.run([self.variables, global_step])
+    self._put((values, save_path, global_step_value))
+    return global_step_value
+
+  def close(self):
+    """Waits for the checkpoint being written, and stops the thread."""
+    super(AsyncCheckpointSaver, self).close()
+    if self.sess is not None:
+      self.sess.close()
+
+  def _create_session(self):
+    """Returns the session that writes the checkpoints.
+
+    The first session of the process sets process-wide options, such as the
+    GPU allocator options and, by default, the sizes of the thread pools. This
+    session is only created when the first checkpoint is written, after the
+    training session, and has neither GPUs nor shared thread pools, so it does
+    not change the configuration of the training session.
+    """
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            use_per_session_threads=True,
+                            intra_op_parallelism_threads=1,
+                            inter_op_parallelism_threads=1)
+    return tf.Session(graph=self.graph, config=config)
+
+  def _write(self, item):
+    values, save_path, global_step_value = item
+    if self.sess is None:
+      self.sess = self._create_session()
+    self.sess.run(self.assign_op, dict(zip(self.placeholders, values)))
+    self.saver.save(self.sess, save_path, global_step_value)
+
+
+class AsyncSummaryWriter(BackgroundWriter):
+  """Writes summaries without blocking the training step on them.
+
+  Instead of the serialized summaries, the training step fetches
+  `snapshot_fetches`: the global step and the tensors summarized by the summary
+  ops, such as losses or the values of histograms. `write` passes them to a
+  background thread, which runs the summary ops with the tensors fed, so that
+  only the summaries themselves are computed, and writes them. At most one
+  snapshot is written at a time.
+
+  Example usage:
+  ```
+  async_writer = cnn_util.AsyncSummaryWriter(summary_op, global_step,
+                                             summary_writer)
+  ...
+  if not async_writer.busy():
+    _, snapshot = sess.run([train_op, async_writer.snapshot_fetches])
+    async_writer.write(sess, snapshot)
+  ...
+  async_writer.close()
+  ```
+  """
+
+  def __init__(self, summary_op, global_step, summary_writer):
+    """Finds the tensors summarized by `summary_op`.
+
+    Args:
+      summary_op: A summary Tensor, typically merged by tf.summary.merge_all.
+      global_step: The global step Tensor, fetched with the snapshot to write
+        the summaries at.
+      summary_writer: The tf.summary.FileWriter to write the summaries with.
+    """
+    self.summary_op = summary_op
+    self.summary_writer = summary_writer
+    if summary_op.op.type == 'MergeSummary':
+      summaries = list(summary_op.op.inputs)
+    else:
+      summaries = [summary_op]
+    # The inputs of the summary ops, except constants such as their tags.
+    self.summarized_tensors = [t for summary in summaries
+                               for t in summary.op.inputs
+                               if t.op.type != 'Const']
+    self.snapshot_fetches = [global_step, self.summarized_tensors]
+    super(AsyncSummaryWriter, self).__init__()
+
+  def write(self, sess, snapshot):
+    """Computes and writes the summaries of a snapshot in the background.
+
+    If a snapshot is being written, waits for it to be written first.
+
+    Args:
+      sess: The session to run the summary ops in.
+      snapshot: The values of `snapshot_fetches`, fetched from `sess`.
+    """
+    self.wait()
+    self._put((sess, snapshot))
+
+  def _write(self, item):
+    sess, (global_step_value, values) = item
+    summary_str = sess.run(self.summary_op,
+                           dict(zip(self.summarized_tensors, values)))
+    self.summary_writer.add_summary(summary_str, global_step_value)
+
+
 class BaseClusterManager(object):
   """The manager for the cluster of servers running the benchmark."""
 
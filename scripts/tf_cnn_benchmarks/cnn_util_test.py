@@ -19,6 +19,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import threading
 import time
 
@@ -124,5 +125,142 @@ class ImageProducerTest(tf.test.TestCase):
     self._test_image_producer(8, True)
 
 
+class CheckpointWatcherTest(tf.test.TestCase):
+
+  def _save(self, sess, saver, checkpoint_dir, step):
+    return saver.save(sess, os.path.join(checkpoint_dir, 'model.ckpt'),
+                      global_step=step)
+
+  def testCheckpointWatcher(self):
+    checkpoint_dir = os.path.join(self.get_temp_dir(), 'watcher')
+    os.makedirs(checkpoint_dir)
+    watcher = cnn_util.CheckpointWatcher(checkpoint_dir, poll_secs=0.01)
+    self.assertIsNone(watcher.wait_for_new_checkpoint(timeout_secs=0.05))
+
+    tf.Variable(1.)
+    saver = tf.train.Saver()
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      path = self._save(sess, saver, checkpoint_dir, 1)
+      self.assertEqual(watcher.wait_for_new_checkpoint(timeout_secs=1), path)
+      # The same checkpoint is not returned twice.
+      self.assertIsNone(watcher.wait_for_new_checkpoint(timeout_secs=0.05))
+
+      # Stale checkpoints are skipped.
+      self._save(sess, saver, checkpoint_dir, 2)
+      path = self._save(sess, saver, checkpoint_dir, 3)
+      self.assertEqual(watcher.wait_for_new_checkpoint(timeout_secs=1), path)
+
+      # A checkpoint saved while waiting is returned.
+      thread = threading.Timer(
+          0.1, lambda: self._save(sess, saver, checkpoint_dir, 4))
+      thread.start()
+      path = watcher.wait_for_new_checkpoint(timeout_secs=10)
+      thread.join()
+      self.assertEqual(path, os.path.join(checkpoint_dir, 'model.ckpt-4'))
+
+
+class BackgroundWriterTest(tf.test.TestCase):
+
+  def testBackgroundWriter(self):
+
+    class Writer(cnn_util.BackgroundWriter):
+
+      def __init__(self):
+        self.written = []
+        super(Writer, self).__init__()
+
+      def write(self, item):
+        self.wait()
+        self._put(item)
+
+      def _write(self, item):
+        if item == 'error':
+          raise ValueError('Failed to write')
+        self.written.append(item)
+
+    writer = Writer()
+    writer.write(1)
+    writer.write(2)
+    writer.wait()
+    self.assertFalse(writer.busy())
+    self.assertEqual(writer.written, [1, 2])
+    # Errors of the background thread are reraised on the caller's thread.
+    writer.write('error')
+    with self.assertRaises(ValueError):
+      writer.wait()
+    writer.close()
+    self.assertEqual(len(writer.write_times), 2)
+
+
+class AsyncCheckpointSaverTest(tf.test.TestCase):
+
+  def testAsyncCheckpointSaver(self):
+    checkpoint_dir = os.path.join(self.get_temp_dir(), 'async_saver')
+    os.makedirs(checkpoint_dir)
+    checkpoint_path = os.path.join(checkpoint_dir, 'model.ckpt')
+    v = tf.Variable(1., name='v')
+    global_step = tf.train.get_or_create_global_step()
+    increment_op = tf.group(v.assign_add(1.), global_step.assign_add(1))
+    async_saver = cnn_util.AsyncCheckpointSaver([v, global_step])
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      self.assertEqual(
+          async_saver.save(sess, checkpoint_path, global_step), 0)
+      # The checkpoint has the values of the snapshot, even if the variables
+      # change while it is being written.
+      sess.run(increment_op)
+      async_saver.wait()
+      self.assertFalse(async_saver.busy())
+      self.assertEqual(async_saver.save(sess, checkpoint_path, global_step), 1)
+      async_saver.close()
+      self.assertEqual(len(async_saver.write_times), 2)
+
+      self.assertEqual(tf.train.latest_checkpoint(checkpoint_dir),
+                       checkpoint_path + '-1')
+      saver = tf.train.Saver([v, global_step])
+      saver.restore(sess, checkpoint_path + '-0')
+      self.assertEqual(sess.run(v), 1.)
+      saver.restore(sess, checkpoint_path + '-1')
+      self.assertEqual(sess.run(v), 2.)
+      self.assertEqual(sess.run(global_step), 1)
+
+
+class AsyncSummaryWriterTest(tf.test.TestCase):
+
+  def testAsyncSummaryWriter(self):
+    summary_dir = os.path.join(self.get_temp_dir(), 'async_summaries')
+    v = tf.Variable(1., name='v')
+    global_step = tf.train.get_or_create_global_step()
+    tf.summary.scalar('v', v)
+    tf.summary.histogram('v_histogram', v * tf.ones([10]))
+    summary_op = tf.summary.merge_all()
+    increment_op = tf.group(v.assign_add(1.), global_step.assign_add(1))
+    summary_writer = tf.summary.FileWriter(summary_dir)
+    async_writer = cnn_util.AsyncSummaryWriter(summary_op, global_step,
+                                               summary_writer)
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      snapshot = sess.run(async_writer.snapshot_fetches)
+      # The summaries have the values of the snapshot, even if the variables
+      # change before they are computed.
+      sess.run(increment_op)
+      async_writer.write(sess, snapshot)
+      async_writer.close()
+    summary_writer.close()
+    self.assertEqual(len(async_writer.write_times), 1)
+
+    events = [event
+              for path in tf.gfile.Glob(os.path.join(summary_dir, 'events.*'))
+              for event in tf.train.summary_iterator(path)
+              if event.HasField('summary')]
+    self.assertEqual(len(events), 1)
+    self.assertEqual(events[0].step, 0)
+    values = {value.tag: value for value in events[0].summary.value}
+    self.assertEqual(values['v'].simple_value, 1.)
+    self.assertEqual(values['v_histogram'].histo.num, 10)
+    self.assertEqual(values['v_histogram'].histo.max, 1.)
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -0,0 +1,140 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Converts ImageNet TFRecords from JPEG to raw pixels.
+
+Each image is decoded, resized so that its shorter side is --resolution, and
+center cropped to --resolution x --resolution. The pixels are stored as uint8
+in the 'image/raw' feature, which is read by
+preprocessing.RawPixelImagePreprocessor. Decoding JPEGs is the main CPU cost of
+the input pipeline, so training on the converted data needs much less CPU, at
+the cost of more disk space and I/O.
+
+--resolution must be at least the image size of the models that will be run,
+which take random (training) or central (evaluation) crops of the images.
+Training crops have a random area and aspect ratio and are resized to the
+model's image size, like with JPEG input.
+
+Example:
+  python convert_to_raw_tfrecords.py --input_dir=/data/imagenet \
+      --output_dir=/data/imagenet_raw --resolution=256
+  python tf_cnn_benchmarks.py --data_dir=/data/imagenet_raw \
+      --data_name=imagenet_raw ...
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl import app
+from absl import flags as absl_flags
+import tensorflow as tf
+
+from tensorflow.python.platform import gfile
+from cnn_util import log_fn
+
+
+absl_flags.DEFINE_string('input_dir', None,
+                         'Directory containing the <subset>-*-of-* TFRecord '
+                         'files to convert.')
+absl_flags.DEFINE_string('output_dir', None,
+                         'Directory to write the converted files to.')
+absl_flags.DEFINE_list('subsets', ['train', 'validation'],
+                       'Subsets to convert.')
+absl_flags.DEFINE_integer('resolution', 256,
+                          'Height and width of the converted images.')
+
+FLAGS = absl_flags.FLAGS
+
+
+def _int64_feature(value):
+  return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _bytes_feature(value):
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def build_decode_graph(resolution):
+  """Returns (image_buffer, image): a JPEG placeholder and its uint8 pixels."""
+  image_buffer = tf.placeholder(tf.string, [])
+  image = tf.image.decode_jpeg(image_buffer, channels=3)
+  shape = tf.shape(image)
+  scale = float(resolution) / tf.cast(tf.minimum(shape[0], shape[1]),
+                                      tf.float32)
+  new_size = tf.cast(
+      tf.ceil(tf.cast(shape[:2], tf.float32) * scale), tf.int32)
+  image = tf.image.resize_images(image, new_size)
+  image = tf.image.resize_image_with_crop_or_pad(image, resolution,
+                                                 resolution)
+  image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+  return image_buffer, image
+
+
+def convert_example(serialized_example, pixels):
+  """Returns `serialized_example` with its JPEG replaced by `pixels`."""
+  example = tf.train.Example.FromString(serialized_example)
+  features = example.features.feature
+  height, width, channels = pixels.shape
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/raw': _bytes_feature(pixels.tobytes()),
+      'image/height': _int64_feature(height),
+      'image/width': _int64_feature(width),
+      'image/channels': _int64_feature(channels),
+      'image/class/label': features['image/class/label'],
+      'image/class/text': features['image/class/text'],
+  })).SerializeToString()
+
+
+def convert_file(sess, image_buffer, image, input_path, output_path):
+  """Converts one TFRecord file, using the graph from build_decode_graph."""
+  with tf.python_io.TFRecordWriter(output_path) as writer:
+    for serialized_example in tf.python_io.tf_record_iterator(input_path):
+      example = tf.train.Example.FromString(serialized_example)
+      jpeg = example.features.feature['image/encoded'].bytes_list.value[0]
+      pixels = sess.run(image, {image_buffer: jpeg})
+      writer.write(convert_example(serialized_example, pixels))
+
+
+def convert(input_dir, output_dir, subsets, resolution):
+  """Converts the files of `subsets` in `input_dir` to `output_dir`."""
+  gfile.MakeDirs(output_dir)
+  with tf.Graph().as_default():
+    image_buffer, image = build_decode_graph(resolution)
+    with tf.Session() as sess:
+      for subset in subsets:
+        input_paths = sorted(
+            gfile.Glob(os.path.join(input_dir, '%s-*-of-*' % subset)))
+        if not input_paths:
+          raise ValueError('Found no files in %s for subset %s' %
+                           (input_dir, subset))
+        for input_path in input_paths:
+          output_path = os.path.join(output_dir, os.path.basename(input_path))
+          log_fn('Converting %s to %s' % (input_path, output_path))
+          convert_file(sess, image_buffer, image, input_path, output_path)
+
+
+def main(positional_arguments):
+  if len(positional_arguments) > 1:
+    raise ValueError('Received unknown positional arguments: %s'
+                     % positional_arguments[1:])
+  convert(FLAGS.input_dir, FLAGS.output_dir, FLAGS.subsets, FLAGS.resolution)
+
+
+if __name__ == '__main__':
+  absl_flags.mark_flag_as_required('input_dir')
+  absl_flags.mark_flag_as_required('output_dir')
+  app.run(main)
@@ -29,6 +29,13 @@ from tensorflow.python.layers import pooling as pooling_layers
 from tensorflow.python.training import moving_averages
 
 
+# Graph collections of the tensors the top layer of a ConvNetBuilder has been
+# set to, and of the outputs of blocks of layers, in creation order. These are
+# the candidate checkpoints when recomputing activations during backprop.
+LAYER_OUTPUTS_COLLECTION = 'layer_outputs'
+BLOCK_OUTPUTS_COLLECTION = 'block_outputs'
+
+
 class ConvNetBuilder(object):
   """Builder of cnn net."""
 
@@ -55,6 +62,22 @@ class ConvNetBuilder(object):
     self.aux_top_layer = None
     self.aux_top_size = 0
 
+  @property
+  def top_layer(self):
+    return self._top_layer
+
+  @top_layer.setter
+  def top_layer(self, layer):
+    self._top_layer = layer
+    tf.add_to_collection(LAYER_OUTPUTS_COLLECTION, layer)
+
+  def mark_block_output(self):
+    """Marks the top layer as the output of a block, such as a residual block.
+
+    Block outputs are used as checkpoints by --recompute_activations=blocks.
+    """
+    tf.add_to_collection(BLOCK_OUTPUTS_COLLECTION, self.top_layer)
+
   def get_custom_getter(self):
     """Returns a custom getter that this class's methods must be called under.
 
@@ -71,7 +94,9 @@ class ConvNetBuilder(object):
     Currently, this custom getter only does anything if self.use_tf_layers is
     True. In that case, it causes variables to be stored as dtype
     self.variable_type, then casted to the requested dtype, instead of directly
-    storing the variable as the requested dtype.
+    storing the variable as the requested dtype. For example, with float16 or
+    bfloat16 activations and float32 variables, layers request float16 or
+    bfloat16 variables, but get casts of float32 variables.
     """
     def inner_custom_getter(getter, *args, **kwargs):
       """Custom getter that forces variables to have type self.variable_type."""
@@ -362,6 +387,7 @@ class ConvNetBuilder(object):
       catdim = 3 if self.data_format == 'NHWC' else 1
       self.top_layer = tf.concat([layers[-1] for layers in col_layers], catdim)
       self.top_size = sum([sizes[-1] for sizes in col_layer_sizes])
+      self.mark_block_output()
       return self.top_layer
 
   def spatial_mean(self, keep_dims=False):
@@ -439,6 +465,11 @@ class ConvNetBuilder(object):
       self.top_size = None
     name = 'batchnorm' + str(self.counts['batchnorm'])
     self.counts['batchnorm'] += 1
+    # Fused batch norm does not support bfloat16, and computing the batch
+    # statistics in fp32 is more accurate anyway.
+    input_dtype = input_layer.dtype.base_dtype
+    if input_dtype == tf.bfloat16:
+      input_layer = tf.cast(input_layer, tf.float32)
 
     with tf.variable_scope(name) as scope:
       if self.use_tf_layers:
@@ -453,6 +484,7 @@ class ConvNetBuilder(object):
             scope=scope)
       else:
         bn = self._batch_norm_without_layers(input_layer, decay, scale, epsilon)
+    bn = tf.cast(bn, input_dtype)
     self.top_layer = bn
     self.top_size = bn.shape[3] if self.data_format == 'NHWC' else bn.shape[1]
     self.top_size = int(self.top_size)
@@ -16,6 +16,10 @@
 
 Collection of utility methods that make CNN benchmark code use tf.data easier.
 """
+import os
+import socket
+
+import numpy as np
 import tensorflow as tf
 
 from tensorflow.contrib.data.python.ops import batching
@@ -24,12 +28,100 @@ from tensorflow.contrib.data.python.ops import prefetching_ops
 from tensorflow.contrib.data.python.ops import threadpool
 from tensorflow.python.framework import function
 from tensorflow.python.platform import gfile
+import tfrecord_index
+
+_DEFAULT_SHUFFLE_BUFFER_SIZE = 10000
+# The shuffle buffer size used when reading shards written by
+# reshard_tfrecords.py, whose records are already globally shuffled.
+_INDEXED_SHUFFLE_BUFFER_SIZE = 1000
+
+
+class InputPipelineOptions(object):
+  """Settings of the parallel file reading and preprocessing.
+
+  Attributes:
+    interleave_cycle_length: Number of files read in parallel by tf.data.
+    record_prefetch_buffer_size: Number of records prefetched by tf.data
+      before shuffling. If None, the batch size is used.
+    shuffle_buffer_size: Size of the tf.data shuffle buffer. If None, 10000
+      is used, or 1000 if the data_dir was written by reshard_tfrecords.py.
+    num_parallel_batches: Number of batches preprocessed in parallel by
+      tf.data. If None, the number of splits is used.
+    record_input_parallelism: Number of files read in parallel by RecordInput.
+    record_input_buffer_size: Number of records buffered by RecordInput.
+    eval_cache_file: If not None, when evaluating, the first
+      eval_cache_num_batches preprocessed batches are cached in this file by
+      the first pass over them, and read from it afterwards.
+    eval_cache_num_batches: The number of batches to cache.
+    eval_cache_fp16: If True, the cached images are stored as float16.
+    eval_num_examples: If not None, when evaluating, every pass over the
+      validation set reads exactly its first eval_num_examples records, in
+      order, followed by eval_num_padding_examples padding examples. The
+      padding examples have a label of -1.
+    eval_num_padding_examples: The number of padding examples per pass.
+    eval_crop_mode: 'central' to evaluate a central crop of each image, or
+      'ten_crop' to evaluate its four corner crops, its central crop, and their
+      horizontal flips.
+    eval_crop_scales: The scales at which the eval crops are taken. At scale s,
+      the image is resized so that the crops cover 1 / s of its shorter side.
+  """
+
+  def __init__(self,
+               interleave_cycle_length=10,
+               record_prefetch_buffer_size=None,
+               shuffle_buffer_size=None,
+               num_parallel_batches=None,
+               record_input_parallelism=64,
+               record_input_buffer_size=10000,
+               eval_cache_file=None,
+               eval_cache_num_batches=None,
+               eval_cache_fp16=True,
+               eval_num_examples=None,
+               eval_num_padding_examples=0,
+               eval_crop_mode='central',
+               eval_crop_scales=(1.15,)):
+    self.interleave_cycle_length = interleave_cycle_length
+    self.record_prefetch_buffer_size = record_prefetch_buffer_size
+    self.shuffle_buffer_size = shuffle_buffer_size
+    self.num_parallel_batches = num_parallel_batches
+    self.record_input_parallelism = record_input_parallelism
+    self.record_input_buffer_size = record_input_buffer_size
+    self.eval_cache_file = eval_cache_file
+    self.eval_cache_num_batches = eval_cache_num_batches
+    self.eval_cache_fp16 = eval_cache_fp16
+    self.eval_num_examples = eval_num_examples
+    self.eval_num_padding_examples = eval_num_padding_examples
+    self.eval_crop_mode = eval_crop_mode
+    self.eval_crop_scales = tuple(eval_crop_scales)
+
+  @property
+  def num_eval_crops(self):
+    """The number of crops evaluated per image."""
+    num_crops_per_scale = 10 if self.eval_crop_mode == 'ten_crop' else 1
+    return num_crops_per_scale * len(self.eval_crop_scales)
+
+  @classmethod
+  def from_params(cls, params):
+    return cls(
+        interleave_cycle_length=params.datasets_interleave_cycle_length,
+        record_prefetch_buffer_size=params.datasets_record_prefetch_buffer_size,
+        shuffle_buffer_size=params.datasets_shuffle_buffer_size,
+        num_parallel_batches=params.datasets_num_parallel_batches,
+        record_input_parallelism=params.record_input_parallelism,
+        record_input_buffer_size=params.record_input_buffer_size,
+        eval_crop_mode=params.eval_crop_mode,
+        eval_crop_scales=[float(scale) for scale in params.eval_crop_scales])
 
 
 def build_prefetch_image_processing(height, width, batch_size, num_splits,
                                     preprocess_fn, cpu_device, params,
-                                    gpu_devices, dataset):
-  """"Returns FunctionBufferingResources that do image pre(processing)."""
+                                    gpu_devices, dataset,
+                                    batch_preprocess_fn=None, worker_index=0,
+                                    num_workers=1, options=None):
+  """"Returns FunctionBufferingResources that do image pre(processing).
+
+  `options` is an InputPipelineOptions. If None, it is created from `params`.
+  """
   with tf.device(cpu_device):
     if params.eval:
       subset = 'validation'
@@ -47,7 +139,11 @@ def build_prefetch_image_processing(height, width, batch_size, num_splits,
         subset=subset,
         train=(not params.eval),
         cache_data=params.cache_data,
-        num_threads=params.datasets_num_private_threads)
+        num_threads=params.datasets_num_private_threads,
+        batch_preprocess_fn=batch_preprocess_fn,
+        worker_index=worker_index,
+        num_workers=num_workers,
+        options=options or InputPipelineOptions.from_params(params))
     for device_num in range(len(gpu_devices)):
       with tf.device(gpu_devices[device_num]):
         buffer_resource_handle = prefetching_ops.function_buffering_resource(
@@ -60,6 +156,61 @@ def build_prefetch_image_processing(height, width, batch_size, num_splits,
     return function_buffering_resources
 
 
+# The default read buffer size of each file read by tf.data.TFRecordDataset and
+# by RecordInput.
+_FILE_READ_BUFFER_SIZE = 256 * 1024
+
+
+def get_mean_record_size(dataset, subset):
+  """Returns the mean size in bytes of the records of `subset`.
+
+  Uses the index written by reshard_tfrecords.py if there is one. Otherwise,
+  the record headers of the first file are read.
+  """
+  index = dataset.get_index(subset)
+  if index:
+    return float(np.mean(index.lengths))
+  file_names = sorted(gfile.Glob(dataset.tf_record_pattern(subset)))
+  if not file_names:
+    raise ValueError('Found no files in --data_dir matching: {}'
+                     .format(dataset.tf_record_pattern(subset)))
+  _, lengths = tfrecord_index.scan_tfrecord_file(file_names[0])
+  return float(np.mean(lengths))
+
+
+def estimate_input_memory_bytes(options, use_datasets, batch_size, num_splits,
+                                record_size, image_size, indexed=False):
+  """Estimates the host memory used by the buffers of the input pipeline.
+
+  Args:
+    options: An InputPipelineOptions.
+    use_datasets: True for the tf.data input pipeline, False for RecordInput.
+    batch_size: The total batch size of all splits.
+    num_splits: The number of splits.
+    record_size: The mean size of a record in bytes.
+    image_size: The size of a preprocessed image in bytes.
+    indexed: Whether the data_dir was written by reshard_tfrecords.py.
+  Returns:
+    The estimated number of bytes.
+  """
+  if use_datasets:
+    shuffle_buffer_size = options.shuffle_buffer_size or (
+        _INDEXED_SHUFFLE_BUFFER_SIZE if indexed
+        else _DEFAULT_SHUFFLE_BUFFER_SIZE)
+    num_records = (shuffle_buffer_size +
+                   (options.record_prefetch_buffer_size or batch_size))
+    num_open_files = options.interleave_cycle_length
+    # Batches being preprocessed, plus the final prefetch buffer.
+    num_images = (batch_size // num_splits) * (
+        (options.num_parallel_batches or num_splits) + num_splits)
+  else:
+    num_records = options.record_input_buffer_size
+    num_open_files = options.record_input_parallelism
+    num_images = batch_size
+  return int(num_records * record_size + num_open_files * _FILE_READ_BUFFER_SIZE
+             + num_images * image_size)
+
+
 def get_images_and_labels(function_buffering_resource, data_type):
   """Given a FunctionBufferingResource obtains images and labels from it."""
   return prefetching_ops.function_buffering_resource_get_next(
@@ -67,6 +218,125 @@ def get_images_and_labels(function_buffering_resource, data_type):
       output_types=[data_type, tf.int32])
 
 
+def get_worker_files(file_names, worker_index, num_workers):
+  """Returns the files read by a worker, and whether to shard their records.
+
+  If there are at least as many files as workers, each worker reads a disjoint,
+  deterministic subset of the files. Otherwise, every worker reads all the
+  files, and the records themselves must be sharded across workers.
+
+  Args:
+    file_names: The names of all the input files.
+    worker_index: The index of the worker, in [0, num_workers).
+    num_workers: The total number of workers.
+  Returns:
+    A tuple (worker_file_names, shard_records).
+  """
+  file_names = sorted(file_names)
+  if num_workers <= 1:
+    return file_names, False
+  if len(file_names) >= num_workers:
+    return file_names[worker_index::num_workers], False
+  return file_names, True
+
+
+def get_eval_cache_temp_file(cache_file):
+  """Returns the file this process writes the eval cache `cache_file` to."""
+  # The trailing separator ensures that no temporary file of another process
+  # starts with this prefix, since tf.data deletes the files matching
+  # '<prefix>*' when a cache is not written completely.
+  return '%s.tmp-%s-%d_' % (cache_file, socket.gethostname(), os.getpid())
+
+
+def finalize_eval_cache(cache_file):
+  """Moves the eval cache written by this process to `cache_file`.
+
+  Must be called once the session that ran the cache_eval_batches dataset is
+  closed. If the cache was not written completely, e.g. because the first pass
+  was interrupted, its files are deleted instead, so `cache_file` never refers
+  to a partial cache.
+
+  Args:
+    cache_file: The options.eval_cache_file passed to cache_eval_batches.
+  Returns:
+    True if a complete cache was moved to `cache_file`.
+  """
+  temp_file = get_eval_cache_temp_file(cache_file)
+  temp_paths = gfile.Glob(temp_file + '*')
+  complete = (gfile.Exists(temp_file + '.index') and
+              not gfile.Exists(temp_file + '.lockfile'))
+  for path in temp_paths:
+    if complete:
+      gfile.Rename(path, cache_file + path[len(temp_file):], overwrite=True)
+    else:
+      gfile.Remove(path)
+  return complete
+
+
+def cache_eval_batches(ds, options):
+  """Caches the first batches of the eval dataset `ds` in a file.
+
+  Eval preprocessing is deterministic, so the batches are the same on every
+  pass. The first pass writes them to options.eval_cache_file, and later
+  passes, including those of later runs, read them back instead of decoding
+  and resizing the images again. Until finalize_eval_cache is called, the
+  cache is written to a temporary file specific to this process, so that an
+  interrupted pass never leaves a partial cache or a lockfile behind.
+
+  Args:
+    ds: A dataset of (labels, images) batches.
+    options: An InputPipelineOptions with eval_cache_file set.
+  Returns:
+    A dataset repeating the first options.eval_cache_num_batches batches of
+    `ds`.
+  """
+  cache_file = options.eval_cache_file
+  if not gfile.Exists(cache_file + '.index'):
+    cache_file = get_eval_cache_temp_file(cache_file)
+  images_dtype = ds.output_types[1]
+  ds = ds.take(options.eval_cache_num_batches)
+  if options.eval_cache_fp16 and images_dtype != tf.float16:
+    ds = ds.map(lambda labels, images: (labels, tf.cast(images, tf.float16)))
+    ds = ds.cache(cache_file)
+    ds = ds.map(lambda labels, images: (labels, tf.cast(images, images_dtype)))
+  else:
+    ds = ds.cache(cache_file)
+  return ds.repeat()
+
+
+def pad_eval_pass(ds, preprocess_fn, batch_size, options):
+  """Returns a dataset of exact, padded passes over the eval records `ds`.
+
+  Each pass preprocesses the first options.eval_num_examples records of `ds`,
+  and appends options.eval_num_padding_examples examples with a label of -1
+  and an all-zero image, so that the pass is a whole number of batches. The
+  model masks out the examples with a negative label, so every record is
+  counted exactly once per pass.
+
+  Args:
+    ds: A dataset of serialized records, which must contain at least
+      options.eval_num_examples records.
+    preprocess_fn: The function mapping a record and its batch position to a
+      (label, image) pair.
+    batch_size: The total batch size of all splits.
+    options: An InputPipelineOptions with eval_num_examples set.
+  Returns:
+    A dataset repeating the padded pass of (label, image) pairs.
+  """
+  counter = tf.data.Dataset.range(batch_size).repeat()
+  ds = tf.data.Dataset.zip((ds.take(options.eval_num_examples), counter))
+  ds = ds.map(preprocess_fn, num_parallel_calls=batch_size)
+  if options.eval_num_padding_examples:
+    labels_shape, images_shape = ds.output_shapes
+    labels_type, images_type = ds.output_types
+    padding = tf.data.Dataset.from_tensors(
+        (tf.constant(-1, labels_type, shape=labels_shape.as_list()),
+         tf.zeros(images_shape.as_list(), images_type)))
+    ds = ds.concatenate(
+        padding.repeat(options.eval_num_padding_examples))
+  return ds.repeat()
+
+
 def create_iterator(batch_size,
                     num_splits,
                     batch_size_per_split,
@@ -75,31 +345,80 @@ def create_iterator(batch_size,
                     subset,
                     train,
                     cache_data,
-                    num_threads=None):
-  """Creates a dataset iterator for the benchmark."""
-  glob_pattern = dataset.tf_record_pattern(subset)
-  file_names = gfile.Glob(glob_pattern)
-  if not file_names:
-    raise ValueError('Found no files in --data_dir matching: {}'
-                     .format(glob_pattern))
-  ds = tf.data.TFRecordDataset.list_files(file_names)
+                    num_threads=None,
+                    batch_preprocess_fn=None,
+                    worker_index=0,
+                    num_workers=1,
+                    options=None):
+  """Creates a dataset iterator for the benchmark.
+
+  If `batch_preprocess_fn` is not None, it is applied to each batch of images
+  output by `preprocess_fn`.
+
+  The input is sharded across the `num_workers` workers, so that each worker
+  reads different data. See `get_worker_files`. When training, the order of the
+  files is reshuffled every epoch. The shuffles are deterministic given the
+  graph-level seed.
+
+  If the data_dir has an index written by reshard_tfrecords.py, a smaller
+  shuffle buffer is used by default since the records are already shuffled.
+
+  `options` is an InputPipelineOptions. If None, the defaults are used.
+  """
+  options = options or InputPipelineOptions()
+  index = dataset.get_index(subset)
+  if index:
+    file_names = index.shard_paths()
+    shuffle_buffer_size = _INDEXED_SHUFFLE_BUFFER_SIZE
+  else:
+    glob_pattern = dataset.tf_record_pattern(subset)
+    file_names = gfile.Glob(glob_pattern)
+    if not file_names:
+      raise ValueError('Found no files in --data_dir matching: {}'
+                       .format(glob_pattern))
+    shuffle_buffer_size = _DEFAULT_SHUFFLE_BUFFER_SIZE
+  if options.shuffle_buffer_size:
+    shuffle_buffer_size = options.shuffle_buffer_size
+  file_names, shard_records = get_worker_files(file_names, worker_index,
+                                               num_workers)
+  full_eval_pass = not train and options.eval_num_examples
+  ds = tf.data.Dataset.from_tensor_slices(file_names)
+  if train and not shard_records:
+    # The files must be in the same order on all workers when sharding records,
+    # so they are only shuffled when each worker has its own files.
+    ds = ds.shuffle(buffer_size=len(file_names), reshuffle_each_iteration=True)
+  if not full_eval_pass:
+    ds = ds.repeat()
   ds = ds.apply(
       interleave_ops.parallel_interleave(
-          tf.data.TFRecordDataset, cycle_length=10))
-  if cache_data:
-    ds = ds.take(1).cache().repeat()
-  counter = tf.data.Dataset.range(batch_size)
-  counter = counter.repeat()
-  ds = tf.data.Dataset.zip((ds, counter))
-  ds = ds.prefetch(buffer_size=batch_size)
-  if train:
-    ds = ds.shuffle(buffer_size=10000)
-  ds = ds.repeat()
-  ds = ds.apply(
-      batching.map_and_batch(
-          map_func=preprocess_fn,
-          batch_size=batch_size_per_split,
-          num_parallel_batches=num_splits))
+          tf.data.TFRecordDataset,
+          cycle_length=options.interleave_cycle_length))
+  if shard_records:
+    ds = ds.shard(num_workers, worker_index)
+  if full_eval_pass:
+    ds = pad_eval_pass(ds, preprocess_fn, batch_size, options)
+    ds = ds.batch(batch_size_per_split)
+  else:
+    if cache_data:
+      ds = ds.take(1).cache().repeat()
+    counter = tf.data.Dataset.range(batch_size)
+    counter = counter.repeat()
+    ds = tf.data.Dataset.zip((ds, counter))
+    ds = ds.prefetch(
+        buffer_size=options.record_prefetch_buffer_size or batch_size)
+    if train:
+      ds = ds.shuffle(buffer_size=shuffle_buffer_size)
+    ds = ds.repeat()
+    ds = ds.apply(
+        batching.map_and_batch(
+            map_func=preprocess_fn,
+            batch_size=batch_size_per_split,
+            num_parallel_batches=options.num_parallel_batches or num_splits))
+  if batch_preprocess_fn is not None:
+    ds = ds.map(lambda labels, images: (labels, batch_preprocess_fn(images)),
+                num_parallel_calls=num_splits)
+  if options.eval_cache_file and not train:
+    ds = cache_eval_batches(ds, options)
   ds = ds.prefetch(buffer_size=num_splits)
   if num_threads:
     ds = threadpool.override_threadpool(
@@ -115,13 +434,17 @@ def create_iterator(batch_size,
 
 
 def minibatch_fn(height, width, batch_size, num_splits, preprocess_fn, dataset,
-                 subset, train, cache_data, num_threads):
+                 subset, train, cache_data, num_threads,
+                 batch_preprocess_fn=None, worker_index=0, num_workers=1,
+                 options=None):
   """Returns a function and list of args for the fn to create a minibatch."""
+  options = options or InputPipelineOptions()
   batch_size_per_split = batch_size // num_splits
   with tf.name_scope('batch_processing'):
     ds_iterator = create_iterator(batch_size, num_splits, batch_size_per_split,
                                   preprocess_fn, dataset, subset, train,
-                                  cache_data, num_threads)
+                                  cache_data, num_threads, batch_preprocess_fn,
+                                  worker_index, num_workers, options)
     ds_iterator_string_handle = ds_iterator.string_handle()
 
     @function.Defun(tf.string)
@@ -130,8 +453,12 @@ def minibatch_fn(height, width, batch_size, num_splits, preprocess_fn, dataset,
       remote_iterator = tf.data.Iterator.from_string_handle(
           h, ds_iterator.output_types, ds_iterator.output_shapes)
       labels, images = remote_iterator.get_next()
+      # With multi-crop eval, the crops of each image are in the batch
+      # dimension.
+      num_crops = 1 if train else options.num_eval_crops
       images = tf.reshape(
-          images, shape=[batch_size_per_split, height, width, depth])
+          images,
+          shape=[batch_size_per_split * num_crops, height, width, depth])
       labels = tf.reshape(labels, [batch_size_per_split])
       return images, labels
 
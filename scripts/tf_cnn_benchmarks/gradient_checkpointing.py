@@ -0,0 +1,145 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Gradients that recompute activations instead of keeping them alive.
+
+tf.gradients keeps every forward activation alive until its gradient has been
+computed. `gradients` in this module only keeps a set of checkpoint tensors
+alive. During backprop, the forward ops between two consecutive checkpoints are
+recomputed from the earlier checkpoint, right before they are needed. This
+trades an extra forward pass for memory, which allows larger batch sizes.
+"""
+
+from __future__ import print_function
+
+import math
+
+import tensorflow as tf
+
+from tensorflow.contrib import graph_editor as ge
+from tensorflow.python.ops import resource_variable_ops
+
+
+def select_sqrt_checkpoints(tensors):
+  """Returns every ceil(sqrt(N))-th tensor of the N `tensors`.
+
+  With N layers, checkpointing every sqrt(N)-th layer output keeps O(sqrt(N))
+  activations alive at any time, at the cost of one extra forward pass.
+
+  Args:
+    tensors: A list of candidate tensors, in the order they were created.
+  Returns:
+    A sublist of `tensors`.
+  """
+  if not tensors:
+    return []
+  stride = int(math.ceil(math.sqrt(len(tensors))))
+  return tensors[stride - 1::stride]
+
+
+def _to_tensor(x):
+  if resource_variable_ops.is_resource_variable(x):
+    return x.handle
+  return tf.convert_to_tensor(x)
+
+
+def _add_gradients(a, b):
+  if a is None:
+    return b
+  if b is None:
+    return a
+  return tf.add_n([tf.convert_to_tensor(a), tf.convert_to_tensor(b)])
+
+
+def gradients(ys, xs, checkpoints, grad_ys=None, aggregation_method=None):
+  """Like tf.gradients, but recomputes activations between `checkpoints`.
+
+  Args:
+    ys: A tensor or list of tensors to be differentiated.
+    xs: A list of tensors or variables to differentiate with respect to.
+    checkpoints: A list of tensors to keep alive during backprop. Tensors that
+      do not lie between `xs` and `ys` are ignored. If none are left, this is
+      equivalent to tf.gradients.
+    grad_ys: Optional list of tensors, the initial gradients of `ys`.
+    aggregation_method: Passed to tf.gradients.
+  Returns:
+    A list of gradients, one per element of `xs`.
+  """
+  if not isinstance(ys, (list, tuple)):
+    ys = [ys]
+  xs = [_to_tensor(x) for x in xs]
+  xs_ops = set(x.op for x in xs)
+
+  # The ops that can be recomputed are those that depend on xs and that ys
+  # depend on, except for the ops producing xs and stateful ops (e.g. random
+  # ops, which would produce different values if run again).
+  bwd_ops = ge.get_backward_walk_ops([y.op for y in ys], inclusive=True)
+  fwd_ops = ge.get_forward_walk_ops(list(xs_ops), inclusive=True,
+                                    within_ops=bwd_ops)
+  recomputable_ops = set(op for op in fwd_ops
+                         if op not in xs_ops and not op.op_def.is_stateful)
+
+  op_order = {op: i for i, op in enumerate(ys[0].graph.get_operations())}
+  checkpoints = sorted(set(t for t in checkpoints
+                           if t.op in recomputable_ops and t not in ys),
+                       key=lambda t: op_order[t.op])
+  if not checkpoints:
+    return tf.gradients(ys, xs, grad_ys=grad_ys,
+                        aggregation_method=aggregation_method)
+
+  # Copies of the checkpoints that gradients are not backpropagated through.
+  # Recomputed ops read from these instead of from the original checkpoints, so
+  # each call to tf.gradients below stops at the checkpoints.
+  disconnected = {c: tf.stop_gradient(c) for c in checkpoints}
+  disconnected_list = [disconnected[c] for c in checkpoints]
+
+  def backprop_segment(outputs, output_grads):
+    """Backprops from `outputs` to the previous checkpoints and xs."""
+    ops = ge.get_backward_walk_ops([t.op for t in outputs], inclusive=True,
+                                   stop_at_ts=checkpoints)
+    ops = [op for op in ops if op in recomputable_ops]
+    if ops:
+      _, info = ge.copy_with_input_replacements(ge.sgv(ops), disconnected)
+      copied_outputs = [info.transformed(t) if t.op in ops else t
+                        for t in outputs]
+      if output_grads is not None:
+        # Only recompute the segment once its output gradients are available,
+        # so that the recomputed activations are not all alive at once.
+        for op in ops:
+          ge.add_control_inputs(info.transformed(op),
+                                [g.op for g in output_grads])
+    else:
+      copied_outputs = outputs
+    return tf.gradients(copied_outputs, disconnected_list + xs,
+                        grad_ys=output_grads,
+                        aggregation_method=aggregation_method)
+
+  num_checkpoints = len(checkpoints)
+  grads = backprop_segment(ys, grad_ys)
+  checkpoint_grads = dict(zip(checkpoints, grads[:num_checkpoints]))
+  xs_grads = list(grads[num_checkpoints:])
+  # Every consumer of a checkpoint is created after it, so processing the
+  # checkpoints in reverse creation order ensures the gradient of a checkpoint
+  # is complete before it is backpropagated.
+  for c in reversed(checkpoints):
+    c_grad = checkpoint_grads.pop(c)
+    if c_grad is None:
+      continue
+    grads = backprop_segment([c], [tf.convert_to_tensor(c_grad)])
+    for other, grad in zip(checkpoints, grads[:num_checkpoints]):
+      if other in checkpoint_grads:
+        checkpoint_grads[other] = _add_gradients(checkpoint_grads[other], grad)
+    for i, grad in enumerate(grads[num_checkpoints:]):
+      xs_grads[i] = _add_gradients(xs_grads[i], grad)
+  return xs_grads
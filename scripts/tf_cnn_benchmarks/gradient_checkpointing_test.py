@@ -0,0 +1,75 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for tf_cnn_benchmark.gradient_checkpointing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+import gradient_checkpointing
+
+
+class GradientCheckpointingTest(tf.test.TestCase):
+
+  def testSelectSqrtCheckpoints(self):
+    self.assertEqual(gradient_checkpointing.select_sqrt_checkpoints([]), [])
+    self.assertEqual(
+        gradient_checkpointing.select_sqrt_checkpoints(list(range(9))),
+        [2, 5, 8])
+    self.assertEqual(
+        gradient_checkpointing.select_sqrt_checkpoints(list(range(10))),
+        [3, 7])
+
+  def _build_mlp(self):
+    x = tf.constant(np.random.RandomState(0).randn(4, 8), dtype=tf.float32)
+    weights = []
+    layers = []
+    top = x
+    for i in range(6):
+      w = tf.Variable(
+          np.random.RandomState(i + 1).randn(8, 8) * 0.3, dtype=tf.float32)
+      weights.append(w)
+      top = tf.nn.relu(tf.matmul(top, w))
+      layers.append(top)
+    loss = tf.reduce_sum(tf.square(top))
+    return loss, weights, layers
+
+  def testGradientsMatchTfGradients(self):
+    with self.test_session() as sess:
+      loss, weights, layers = self._build_mlp()
+      expected = tf.gradients(loss, weights)
+      checkpoints = gradient_checkpointing.select_sqrt_checkpoints(layers)
+      actual = gradient_checkpointing.gradients(loss, weights, checkpoints)
+      sess.run(tf.global_variables_initializer())
+      expected_vals, actual_vals = sess.run([expected, actual])
+      for expected_val, actual_val in zip(expected_vals, actual_vals):
+        self.assertAllClose(expected_val, actual_val)
+
+  def testNoCheckpoints(self):
+    with self.test_session() as sess:
+      loss, weights, _ = self._build_mlp()
+      expected = tf.gradients(loss, weights)
+      actual = gradient_checkpointing.gradients(loss, weights, [])
+      sess.run(tf.global_variables_initializer())
+      expected_vals, actual_vals = sess.run([expected, actual])
+      for expected_val, actual_val in zip(expected_vals, actual_vals):
+        self.assertAllClose(expected_val, actual_val)
+
+
+if __name__ == '__main__':
+  tf.test.main()
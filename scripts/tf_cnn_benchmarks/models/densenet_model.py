@@ -42,6 +42,7 @@ class DensenetCifar10Model(model_lib.Model):
     channel_index = 3 if cnn.channel_pos == 'channels_last' else 1
     cnn.top_layer = tf.concat([input_layer, c], channel_index)
     cnn.top_size += growth_rate
+    cnn.mark_block_output()
 
   def transition_layer(self, cnn):
     in_size = cnn.top_size
@@ -80,10 +80,20 @@ class Model(object):
 
   def build_network(self, images, phase_train=True, nclass=1001, image_depth=3,
                     data_type=tf.float32, data_format='NCHW',
-                    use_tf_layers=True, fp16_vars=False):
-    """Returns logits and aux_logits from images."""
-    if data_format == 'NCHW':
-      images = tf.transpose(images, [0, 3, 1, 2])
+                    use_tf_layers=True, fp16_vars=False,
+                    input_data_format='NHWC'):
+    """Returns logits and aux_logits from images.
+
+    `input_data_format` is the layout `images` is already in. If it differs
+    from `data_format`, the images are transposed before being fed to the
+    network, so input pipelines that can produce `data_format` directly avoid
+    the transpose.
+    """
+    if input_data_format != data_format:
+      if data_format == 'NCHW':
+        images = tf.transpose(images, [0, 3, 1, 2])
+      else:
+        images = tf.transpose(images, [0, 2, 3, 1])
     var_type = tf.float32
     if data_type == tf.float16 and fp16_vars:
       var_type = tf.float16
@@ -101,7 +111,8 @@ class Model(object):
         with network.switch_to_aux_top_layer():
           aux_logits = network.affine(
               nclass, activation='linear', stddev=0.001)
-    if data_type == tf.float16:
+    if data_type != tf.float32:
+      # The loss is computed in fp32.
       # TODO(reedwm): Determine if we should do this cast here.
       logits = tf.cast(logits, tf.float32)
       if aux_logits is not None:
@@ -14,87 +14,113 @@
 # ==============================================================================
 
 """Model configurations for CNN benchmarks.
+
+The model modules are only imported when a model is created with
+`get_model_config`, since importing all of them, in particular the ones using
+tf.contrib.slim, slows down the startup of every run.
 """
 
-from models import alexnet_model
-from models import densenet_model
-from models import googlenet_model
-from models import inception_model
-from models import lenet_model
-from models import mobilenet_v2
-from models import nasnet_model
-from models import official_resnet_model
-from models import overfeat_model
-from models import resnet_model
-from models import trivial_model
-from models import vgg_model
+import importlib
+
+
+def _lazy_model(module_name, factory_name, *args, **kwargs):
+  """Returns a function creating a model with a factory of a models module.
+
+  Args:
+    module_name: The name of the module in the models package, e.g.
+      'vgg_model'. It is imported the first time the function is called.
+    factory_name: The name of the class or function of the module that creates
+      the model.
+    *args: Positional arguments passed to the factory.
+    **kwargs: Keyword arguments passed to the factory.
+  Returns:
+    A function with no arguments that returns the model.
+  """
+  def model_func():
+    module = importlib.import_module('models.' + module_name)
+    return getattr(module, factory_name)(*args, **kwargs)
+  return model_func
 
 
 _model_name_to_imagenet_model = {
-    'vgg11': vgg_model.Vgg11Model,
-    'vgg16': vgg_model.Vgg16Model,
-    'vgg19': vgg_model.Vgg19Model,
-    'lenet': lenet_model.Lenet5Model,
-    'googlenet': googlenet_model.GooglenetModel,
-    'overfeat': overfeat_model.OverfeatModel,
-    'alexnet': alexnet_model.AlexnetModel,
-    'trivial': trivial_model.TrivialModel,
-    'inception3': inception_model.Inceptionv3Model,
-    'inception4': inception_model.Inceptionv4Model,
+    'vgg11': _lazy_model('vgg_model', 'Vgg11Model'),
+    'vgg16': _lazy_model('vgg_model', 'Vgg16Model'),
+    'vgg19': _lazy_model('vgg_model', 'Vgg19Model'),
+    'lenet': _lazy_model('lenet_model', 'Lenet5Model'),
+    'googlenet': _lazy_model('googlenet_model', 'GooglenetModel'),
+    'overfeat': _lazy_model('overfeat_model', 'OverfeatModel'),
+    'alexnet': _lazy_model('alexnet_model', 'AlexnetModel'),
+    'trivial': _lazy_model('trivial_model', 'TrivialModel'),
+    'inception3': _lazy_model('inception_model', 'Inceptionv3Model'),
+    'inception4': _lazy_model('inception_model', 'Inceptionv4Model'),
     'official_resnet18_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(18),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 18),
     'official_resnet34_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(34),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 34),
     'official_resnet50_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(50),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 50),
     'official_resnet101_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(101),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 101),
     'official_resnet152_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(152),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 152),
     'official_resnet200_v2':
-    lambda: official_resnet_model.ImagenetResnetModel(200),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 200),
     'official_resnet18':
-    lambda: official_resnet_model.ImagenetResnetModel(18, version=1),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 18,
+                version=1),
     'official_resnet34':
-    lambda: official_resnet_model.ImagenetResnetModel(34, version=1),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 34,
+                version=1),
     'official_resnet50':
-    lambda: official_resnet_model.ImagenetResnetModel(50, version=1),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 50,
+                version=1),
     'official_resnet101':
-    lambda: official_resnet_model.ImagenetResnetModel(101, version=1),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 101,
+                version=1),
     'official_resnet152':
-    lambda: official_resnet_model.ImagenetResnetModel(152, version=1),
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 152,
+                version=1),
     'official_resnet200':
-    lambda: official_resnet_model.ImagenetResnetModel(200, version=1),
-    'resnet50': resnet_model.create_resnet50_model,
-    'resnet50_v2': resnet_model.create_resnet50_v2_model,
-    'resnet101': resnet_model.create_resnet101_model,
-    'resnet101_v2': resnet_model.create_resnet101_v2_model,
-    'resnet152': resnet_model.create_resnet152_model,
-    'resnet152_v2': resnet_model.create_resnet152_v2_model,
-    'nasnet': nasnet_model.NasnetModel,
-    'nasnetlarge': nasnet_model.NasnetLargeModel,
-    'mobilenet': mobilenet_v2.MobilenetModel,
+    _lazy_model('official_resnet_model', 'ImagenetResnetModel', 200,
+                version=1),
+    'resnet50': _lazy_model('resnet_model', 'create_resnet50_model'),
+    'resnet50_v2': _lazy_model('resnet_model', 'create_resnet50_v2_model'),
+    'resnet101': _lazy_model('resnet_model', 'create_resnet101_model'),
+    'resnet101_v2': _lazy_model('resnet_model', 'create_resnet101_v2_model'),
+    'resnet152': _lazy_model('resnet_model', 'create_resnet152_model'),
+    'resnet152_v2': _lazy_model('resnet_model', 'create_resnet152_v2_model'),
+    'nasnet': _lazy_model('nasnet_model', 'NasnetModel'),
+    'nasnetlarge': _lazy_model('nasnet_model', 'NasnetLargeModel'),
+    'mobilenet': _lazy_model('mobilenet_v2', 'MobilenetModel'),
 
 }
 
 
 _model_name_to_cifar_model = {
-    'alexnet': alexnet_model.AlexnetCifar10Model,
-    'resnet20': resnet_model.create_resnet20_cifar_model,
-    'resnet20_v2': resnet_model.create_resnet20_v2_cifar_model,
-    'resnet32': resnet_model.create_resnet32_cifar_model,
-    'resnet32_v2': resnet_model.create_resnet32_v2_cifar_model,
-    'resnet44': resnet_model.create_resnet44_cifar_model,
-    'resnet44_v2': resnet_model.create_resnet44_v2_cifar_model,
-    'resnet56': resnet_model.create_resnet56_cifar_model,
-    'resnet56_v2': resnet_model.create_resnet56_v2_cifar_model,
-    'resnet110': resnet_model.create_resnet110_cifar_model,
-    'resnet110_v2': resnet_model.create_resnet110_v2_cifar_model,
-    'trivial': trivial_model.TrivialCifar10Model,
-    'densenet40_k12': densenet_model.create_densenet40_k12_model,
-    'densenet100_k12': densenet_model.create_densenet100_k12_model,
-    'densenet100_k24': densenet_model.create_densenet100_k24_model,
-    'nasnet': nasnet_model.NasnetCifarModel,
+    'alexnet': _lazy_model('alexnet_model', 'AlexnetCifar10Model'),
+    'resnet20': _lazy_model('resnet_model', 'create_resnet20_cifar_model'),
+    'resnet20_v2':
+    _lazy_model('resnet_model', 'create_resnet20_v2_cifar_model'),
+    'resnet32': _lazy_model('resnet_model', 'create_resnet32_cifar_model'),
+    'resnet32_v2':
+    _lazy_model('resnet_model', 'create_resnet32_v2_cifar_model'),
+    'resnet44': _lazy_model('resnet_model', 'create_resnet44_cifar_model'),
+    'resnet44_v2':
+    _lazy_model('resnet_model', 'create_resnet44_v2_cifar_model'),
+    'resnet56': _lazy_model('resnet_model', 'create_resnet56_cifar_model'),
+    'resnet56_v2':
+    _lazy_model('resnet_model', 'create_resnet56_v2_cifar_model'),
+    'resnet110': _lazy_model('resnet_model', 'create_resnet110_cifar_model'),
+    'resnet110_v2':
+    _lazy_model('resnet_model', 'create_resnet110_v2_cifar_model'),
+    'trivial': _lazy_model('trivial_model', 'TrivialCifar10Model'),
+    'densenet40_k12':
+    _lazy_model('densenet_model', 'create_densenet40_k12_model'),
+    'densenet100_k12':
+    _lazy_model('densenet_model', 'create_densenet100_k12_model'),
+    'densenet100_k24':
+    _lazy_model('densenet_model', 'create_densenet100_k24_model'),
+    'nasnet': _lazy_model('nasnet_model', 'NasnetCifarModel'),
 }
 
 
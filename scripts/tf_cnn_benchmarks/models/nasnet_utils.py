@@ -173,7 +173,7 @@ def _stacked_separable_conv(net, stride, operation, filter_size):
   """Takes in an operations and parses it to the correct sep operation."""
   num_layers, kernel_size = _operation_to_info(operation)
   net_type = net.dtype
-  net = tf.cast(net, tf.float32) if net_type == tf.float16 else net
+  net = tf.cast(net, tf.float32) if net_type != tf.float32 else net
 
   for layer_num in range(num_layers - 1):
     net = tf.nn.relu(net)
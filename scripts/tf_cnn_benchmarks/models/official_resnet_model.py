@@ -58,10 +58,14 @@ class ImagenetResnetModel(model_lib.Model):
 
   def build_network(self, images, phase_train=True, nclass=1001, image_depth=3,
                     data_type=tf.float32, data_format='NCHW',
-                    use_tf_layers=True, fp16_vars=False):
+                    use_tf_layers=True, fp16_vars=False,
+                    input_data_format='NHWC'):
     del image_depth
     del data_format
     del use_tf_layers
+    if input_data_format == 'NCHW':
+      # The official model expects NHWC images and transposes them itself.
+      images = tf.transpose(images, [0, 2, 3, 1])
     # pylint: disable=g-import-not-at-top
     try:
       from official.resnet.imagenet_main import ImagenetModel
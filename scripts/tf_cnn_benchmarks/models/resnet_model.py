@@ -76,6 +76,7 @@ def bottleneck_block_v1(cnn, depth, depth_bottleneck, stride):
     output = tf.nn.relu(shortcut + res)
     cnn.top_layer = output
     cnn.top_size = depth
+    cnn.mark_block_output()
 
 
 def bottleneck_block_v2(cnn, depth, depth_bottleneck, stride):
@@ -121,6 +122,7 @@ def bottleneck_block_v2(cnn, depth, depth_bottleneck, stride):
     output = shortcut + res
     cnn.top_layer = output
     cnn.top_size = depth
+    cnn.mark_block_output()
 
 
 def bottleneck_block(cnn, depth, depth_bottleneck, stride, pre_activation):
@@ -182,6 +184,7 @@ def residual_block(cnn, depth, stride, pre_activation):
     output = tf.nn.relu(shortcut + res)
   cnn.top_layer = output
   cnn.top_size = depth
+  cnn.mark_block_output()
 
 
 class ResnetModel(model_lib.Model):
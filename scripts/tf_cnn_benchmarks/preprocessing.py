@@ -97,6 +97,42 @@ def parse_example_proto(example_serialized):
   return features['image/encoded'], label, bbox, features['image/class/text']
 
 
+def parse_raw_example_proto(example_serialized):
+  """Parses an Example proto containing pre-decoded image pixels.
+
+  These Example protos are written by convert_to_raw_tfrecords.py. Instead of
+  'image/encoded', they contain the following fields:
+
+    image/raw: <uint8 pixels in [height, width, channels] order>
+    image/height: 256
+    image/width: 256
+    image/channels: 3
+
+  Args:
+    example_serialized: scalar Tensor tf.string containing a serialized
+      Example protocol buffer.
+
+  Returns:
+    image: 3-D uint8 Tensor of shape [height, width, channels].
+    label: Tensor tf.int32 containing the label.
+  """
+  feature_map = {
+      'image/raw': tf.FixedLenFeature([], dtype=tf.string, default_value=''),
+      'image/height': tf.FixedLenFeature([], dtype=tf.int64),
+      'image/width': tf.FixedLenFeature([], dtype=tf.int64),
+      'image/channels': tf.FixedLenFeature([], dtype=tf.int64),
+      'image/class/label': tf.FixedLenFeature([1], dtype=tf.int64,
+                                              default_value=-1),
+  }
+  features = tf.parse_single_example(example_serialized, feature_map)
+  label = tf.cast(features['image/class/label'], dtype=tf.int32)
+  image = tf.decode_raw(features['image/raw'], tf.uint8)
+  shape = tf.cast(tf.stack([features['image/height'], features['image/width'],
+                            features['image/channels']]), tf.int32)
+  image = tf.reshape(image, shape)
+  return image, label
+
+
 _RESIZE_METHOD_MAP = {
     'nearest': tf.image.ResizeMethod.NEAREST_NEIGHBOR,
     'bilinear': tf.image.ResizeMethod.BILINEAR,
@@ -179,6 +215,44 @@ def normalized_image(images):
   return tf.subtract(images, 1.0)
 
 
+def _resize_for_eval(image, height, width, scale_factor, batch_position,
+                     resize_method):
+  """Resizes an eval image so that crops of size (`height`, `width`) fit.
+
+  Returns:
+    A tuple (resized_image, resize_height, resize_width).
+  """
+  shape = tf.shape(image)
+  image_height = shape[0]
+  image_width = shape[1]
+  image_height_float = tf.cast(image_height, tf.float32)
+  image_width_float = tf.cast(image_width, tf.float32)
+
+  # Compute resize_height and resize_width to be the minimum values such that
+  #   1. The aspect ratio is maintained (i.e. resize_height / resize_width is
+  #      image_height / image_width), and
+  #   2. resize_height >= height * `scale_factor`, and
+  #   3. resize_width >= width * `scale_factor`
+  max_ratio = tf.maximum(height / image_height_float,
+                         width / image_width_float)
+  resize_height = tf.cast(image_height_float * max_ratio * scale_factor,
+                          tf.int32)
+  resize_width = tf.cast(image_width_float * max_ratio * scale_factor,
+                         tf.int32)
+  # Rounding errors can make the product slightly smaller than the crop size
+  # when scale_factor is 1, in which case the cast truncates it below.
+  resize_height = tf.maximum(resize_height, height)
+  resize_width = tf.maximum(resize_width, width)
+
+  # Resize the image to shape (`resize_height`, `resize_width`)
+  image_resize_method = get_image_resize_method(resize_method, batch_position)
+  resized_image = tf.image.resize_images(image,
+                                         [resize_height, resize_width],
+                                         image_resize_method,
+                                         align_corners=False)
+  return resized_image, resize_height, resize_width
+
+
 def eval_image(image,
                height,
                width,
@@ -216,32 +290,8 @@ def eval_image(image,
       tf.summary.image(
           'original_image', tf.expand_dims(image, 0))
 
-    shape = tf.shape(image)
-    image_height = shape[0]
-    image_width = shape[1]
-    image_height_float = tf.cast(image_height, tf.float32)
-    image_width_float = tf.cast(image_width, tf.float32)
-
-    scale_factor = 1.15
-
-    # Compute resize_height and resize_width to be the minimum values such that
-    #   1. The aspect ratio is maintained (i.e. resize_height / resize_width is
-    #      image_height / image_width), and
-    #   2. resize_height >= height * `scale_factor`, and
-    #   3. resize_width >= width * `scale_factor`
-    max_ratio = tf.maximum(height / image_height_float,
-                           width / image_width_float)
-    resize_height = tf.cast(image_height_float * max_ratio * scale_factor,
-                            tf.int32)
-    resize_width = tf.cast(image_width_float * max_ratio * scale_factor,
-                           tf.int32)
-
-    # Resize the image to shape (`resize_height`, `resize_width`)
-    image_resize_method = get_image_resize_method(resize_method, batch_position)
-    distorted_image = tf.image.resize_images(image,
-                                             [resize_height, resize_width],
-                                             image_resize_method,
-                                             align_corners=False)
+    distorted_image, resize_height, resize_width = _resize_for_eval(
+        image, height, width, 1.15, batch_position, resize_method)
 
     # Do a central crop of the image to size (height, width).
     total_crop_height = (resize_height - height)
@@ -259,6 +309,57 @@ def eval_image(image,
   return image
 
 
+def eval_image_crops(image,
+                     height,
+                     width,
+                     batch_position,
+                     resize_method,
+                     crop_mode,
+                     scales):
+  """Get the crops of the image for multi-crop model evaluation.
+
+  For each scale in `scales`, the image is resized like in eval_image, but
+  with a scale factor of `scale` instead of 1.15. With crop_mode 'central', the
+  central crop of the resized image is taken. With crop_mode 'ten_crop', its
+  four corner crops and its central crop are taken, along with their
+  horizontal flips.
+
+  Args:
+    image: 3-D float Tensor representing the image.
+    height: The height of the crops.
+    width: The width of the crops.
+    batch_position: position of the image in a batch, which affects how images
+      are resized. NOTE: this argument can be an integer or a tensor
+    resize_method: one of the strings 'round_robin', 'nearest', 'bilinear',
+      'bicubic', or 'area'.
+    crop_mode: 'central' or 'ten_crop'.
+    scales: A list of scale factors, each at least 1.
+  Returns:
+    A Tensor of shape (num_crops, height, width, 3), where num_crops is
+    len(scales), or 10 * len(scales) with crop_mode 'ten_crop'.
+  """
+  crops = []
+  with tf.name_scope('eval_image_crops'):
+    for scale in scales:
+      resized_image, resize_height, resize_width = _resize_for_eval(
+          image, height, width, scale, batch_position, resize_method)
+      bottom = resize_height - height
+      right = resize_width - width
+      offsets = [(bottom // 2, right // 2)]
+      if crop_mode == 'ten_crop':
+        offsets += [(0, 0), (0, right), (bottom, 0), (bottom, right)]
+      scale_crops = [
+          tf.slice(resized_image, [top, left, 0], [height, width, 3])
+          for top, left in offsets
+      ]
+      if crop_mode == 'ten_crop':
+        scale_crops += [tf.image.flip_left_right(crop) for crop in scale_crops]
+      crops.extend(scale_crops)
+    images = tf.stack(crops)
+  images.set_shape([len(crops), height, width, 3])
+  return images
+
+
 def train_image(image_buffer,
                 height,
                 width,
@@ -269,7 +370,8 @@ def train_image(image_buffer,
                 scope=None,
                 summary_verbosity=0,
                 distort_color_in_yiq=False,
-                fuse_decode_and_crop=False):
+                fuse_decode_and_crop=False,
+                random_flip=True):
   """Distort one image for training a network.
 
   Distorting images provides a useful technique for augmenting the data
@@ -293,6 +395,7 @@ def train_image(image_buffer,
       summaries and checkpoints.
     distort_color_in_yiq: distort color of input images in YIQ space.
     fuse_decode_and_crop: fuse the decode/crop operation.
+    random_flip: If true, randomly flip the image horizontally.
   Returns:
     3-D float Tensor of distorted image used for training.
   """
@@ -337,7 +440,10 @@ def train_image(image_buffer,
                                    dct_method='INTEGER_FAST')
       image = tf.slice(image, bbox_begin, bbox_size)
 
-    distorted_image = tf.image.random_flip_left_right(image)
+    if random_flip:
+      distorted_image = tf.image.random_flip_left_right(image)
+    else:
+      distorted_image = image
 
     # This resizing operation may distort the images because the aspect
     # ratio is not respected.
@@ -425,6 +531,99 @@ def distort_color(image, batch_position=0, distort_color_in_yiq=False,
     return image
 
 
+def _random_per_image(shape, minval, maxval):
+  return tf.random_uniform(shape, minval=minval, maxval=maxval)
+
+
+def _adjust_saturation_and_hue_batch(images, distort_color_in_yiq):
+  """Randomly adjusts the saturation and hue of each image of a batch."""
+  per_image_shape = [tf.shape(images)[0], 1, 1]
+  saturation = _random_per_image(per_image_shape, 0.5, 1.5)
+  if distort_color_in_yiq:
+    # Same as distort_image_ops.random_hsv_in_yiq: in YIQ space, a hue shift is
+    # a rotation of the (I, Q) plane and a saturation change scales it.
+    hue = _random_per_image(per_image_shape, -0.2 * math.pi, 0.2 * math.pi)
+    rgb_to_yiq = tf.constant([[0.299, 0.596, 0.211],
+                              [0.587, -0.274, -0.523],
+                              [0.114, -0.322, 0.312]])
+    yiq_to_rgb = tf.constant([[1., 1., 1.],
+                              [0.956, -0.272, -1.106],
+                              [0.621, -0.647, 1.703]])
+    y, i, q = tf.unstack(tf.tensordot(images, rgb_to_yiq, [[3], [0]]), axis=3)
+    cos = saturation * tf.cos(hue)
+    sin = saturation * tf.sin(hue)
+    yiq = tf.stack([y, i * cos - q * sin, i * sin + q * cos], axis=3)
+    return tf.tensordot(yiq, yiq_to_rgb, [[3], [0]])
+  # Same as tf.image.random_saturation followed by tf.image.random_hue, with a
+  # single conversion to and from HSV.
+  hue = _random_per_image(per_image_shape, -0.2, 0.2)
+  h, s, v = tf.unstack(tf.image.rgb_to_hsv(images), axis=3)
+  h = tf.mod(h + hue, 1.0)
+  s = tf.clip_by_value(s * saturation, 0.0, 1.0)
+  return tf.image.hsv_to_rgb(tf.stack([h, s, v], axis=3))
+
+
+def _distort_color_batch(images, ordering, distort_color_in_yiq):
+  """Distorts the color of each image of a batch with the given ordering."""
+  per_image_shape = [tf.shape(images)[0], 1, 1, 1]
+  images += _random_per_image(per_image_shape, -32. / 255., 32. / 255.)
+
+  def adjust_contrast(images):
+    mean = tf.reduce_mean(images, [1, 2], keepdims=True)
+    return (images - mean) * _random_per_image(per_image_shape, 0.5,
+                                               1.5) + mean
+
+  if ordering == 0:
+    images = _adjust_saturation_and_hue_batch(images, distort_color_in_yiq)
+    images = adjust_contrast(images)
+  else:
+    images = adjust_contrast(images)
+    images = _adjust_saturation_and_hue_batch(images, distort_color_in_yiq)
+  return images
+
+
+def distort_image_batch(images, distortions, distort_color_in_yiq=False,
+                        scope=None):
+  """Randomly flips and distorts the colors of a batch of images.
+
+  This is a vectorized version of the random flip in train_image and of
+  distort_color. The random parameters are drawn per image as tensors, and each
+  distortion is a single op over the whole batch instead of one op per image.
+  Like distort_color, images at even and odd positions of the batch use
+  different orderings of the color ops.
+
+  Args:
+    images: float32 Tensor of shape [batch_size, height, width, 3] with values
+      in [0, 255].
+    distortions: If true, distort the colors of the images as well.
+    distort_color_in_yiq: distort color of input images in YIQ space.
+    scope: Optional scope for op_scope.
+  Returns:
+    float32 Tensor of the same shape as `images`, with values in [0, 255].
+  """
+  with tf.name_scope(scope or 'distort_image_batch'):
+    batch_size = tf.shape(images)[0]
+    flip = tf.random_uniform([batch_size]) < 0.5
+    images = tf.where(flip, tf.reverse(images, [2]), images)
+    if not distortions:
+      return images
+    # Images values are expected to be in [0,1] for color distortion.
+    images_shape = images.get_shape()
+    images /= 255.
+    even_positions = tf.range(0, batch_size, 2)
+    odd_positions = tf.range(1, batch_size, 2)
+    even_images = _distort_color_batch(tf.gather(images, even_positions), 0,
+                                       distort_color_in_yiq)
+    odd_images = _distort_color_batch(tf.gather(images, odd_positions), 1,
+                                      distort_color_in_yiq)
+    images = tf.dynamic_stitch([even_positions, odd_positions],
+                               [even_images, odd_images])
+    images.set_shape(images_shape)
+    # The distortions do not necessarily clamp.
+    images = tf.clip_by_value(images, 0.0, 1.0)
+    return images * 255
+
+
 class BaseImagePreprocess(object):
   """Base class for all image preprocessors."""
 
@@ -441,7 +640,9 @@ class BaseImagePreprocess(object):
                summary_verbosity=0,
                distort_color_in_yiq=True,
                fuse_decode_and_crop=True,
-               depth=3):
+               depth=3,
+               vectorized_distortions=False,
+               input_pipeline_options=None):
     self.height = height
     self.width = width
     self.batch_size = batch_size
@@ -461,49 +662,133 @@ class BaseImagePreprocess(object):
     self.batch_size_per_split = self.batch_size // self.num_splits
     self.summary_verbosity = summary_verbosity
     self.depth = depth
+    self.vectorized_distortions = vectorized_distortions
+    self.input_pipeline_options = (input_pipeline_options or
+                                   data_utils.InputPipelineOptions())
 
   def preprocess(self, image_buffer, bbox, batch_position):
     raise NotImplementedError('Must be implemented by subclass.')
 
   def minibatch(self, dataset, subset, use_datasets, cache_data,
-                shift_ratio):
+                shift_ratio, worker_index=0, num_workers=1):
     raise NotImplementedError('Must be implemented by subclass.')
 
   def supports_datasets(self):
     return False
 
+  def supports_vectorized_distortions(self):
+    return False
+
+  def supports_eval_crops(self):
+    """Whether eval_crop_mode and eval_crop_scales of the options are used."""
+    return False
+
+  def num_crops_per_image(self):
+    """Returns the number of crops in the batch dimension per image."""
+    if self.train or not self.supports_eval_crops():
+      return 1
+    return self.input_pipeline_options.num_eval_crops
+
 
 class RecordInputImagePreprocessor(BaseImagePreprocess):
   """Preprocessor for images with RecordInput format."""
 
   def preprocess(self, image_buffer, bbox, batch_position):
-    """Preprocessing image_buffer as a function of its batch position."""
+    """Preprocessing image_buffer as a function of its batch position.
+
+    If vectorized_distortions is set, only the per-image part of the
+    preprocessing is done, and the result must be passed through
+    preprocess_batch once batched.
+    """
     if self.train:
+      per_image_distortions = (self.distortions and
+                               not self.vectorized_distortions)
       image = train_image(image_buffer, self.height, self.width, bbox,
-                          batch_position, self.resize_method, self.distortions,
-                          None, summary_verbosity=self.summary_verbosity,
+                          batch_position, self.resize_method,
+                          per_image_distortions, None,
+                          summary_verbosity=self.summary_verbosity,
                           distort_color_in_yiq=self.distort_color_in_yiq,
-                          fuse_decode_and_crop=self.fuse_decode_and_crop)
+                          fuse_decode_and_crop=self.fuse_decode_and_crop,
+                          random_flip=not self.vectorized_distortions)
     else:
       image = tf.image.decode_jpeg(
           image_buffer, channels=3, dct_method='INTEGER_FAST')
-      image = eval_image(image, self.height, self.width, batch_position,
-                         self.resize_method,
-                         summary_verbosity=self.summary_verbosity)
+      options = self.input_pipeline_options
+      if (options.eval_crop_mode == 'central' and
+          options.eval_crop_scales == (1.15,)):
+        image = eval_image(image, self.height, self.width, batch_position,
+                           self.resize_method,
+                           summary_verbosity=self.summary_verbosity)
+      else:
+        # The crops are stacked in a new leading dimension, which minibatch
+        # merges into the batch dimension.
+        image = eval_image_crops(image, self.height, self.width,
+                                 batch_position, self.resize_method,
+                                 options.eval_crop_mode,
+                                 options.eval_crop_scales)
     # Note: image is now float32 [height,width,3] with range [0, 255]
 
     # image = tf.cast(image, tf.uint8) # HACK TESTING
 
+    if self.vectorized_distortions:
+      return image
     normalized = normalized_image(image)
     return tf.cast(normalized, self.dtype)
 
+  def preprocess_batch(self, images):
+    """Finishes preprocessing a batch of images output by preprocess.
+
+    Only used if vectorized_distortions is set. The random flip, the color
+    distortions and the normalization are applied to the whole batch at once.
+
+    Args:
+      images: float32 Tensor of shape [batch_size, height, width, 3].
+    Returns:
+      The preprocessed images, of type self.dtype.
+    """
+    if self.train:
+      images = distort_image_batch(images, self.distortions,
+                                   self.distort_color_in_yiq)
+    return tf.cast(normalized_image(images), self.dtype)
+
+  def get_batch_preprocess_fn(self):
+    """Returns the function to apply to batches, or None if there is none."""
+    if self.vectorized_distortions:
+      return self.preprocess_batch
+    return None
+
   def parse_and_preprocess(self, value, batch_position):
     image_buffer, label_index, bbox, _ = parse_example_proto(value)
     image = self.preprocess(image_buffer, bbox, batch_position)
     return (label_index, image)
 
+  def _map_parse_and_preprocess(self, records):
+    """Calls parse_and_preprocess on each record with a single subgraph.
+
+    The size of the graph does not depend on the number of records, since the
+    batch position of each record is passed to parse_and_preprocess as a
+    scalar tensor instead of a Python integer.
+
+    Args:
+      records: A string Tensor of shape [batch_size].
+    Returns:
+      A tuple (labels, images), with labels of shape [batch_size, 1] and images
+      of shape [batch_size, height, width, depth].
+    """
+    if self.vectorized_distortions:
+      image_dtype = tf.float32
+    else:
+      image_dtype = self.dtype
+    positions = tf.range(self.batch_size)
+    return tf.map_fn(
+        lambda elems: self.parse_and_preprocess(*elems),
+        (records, positions),
+        dtype=(tf.int32, image_dtype),
+        parallel_iterations=self.batch_size,
+        back_prop=False)
+
   def minibatch(self, dataset, subset, use_datasets, cache_data,
-                shift_ratio=-1):
+                shift_ratio=-1, worker_index=0, num_workers=1):
     if shift_ratio < 0:
       shift_ratio = self.shift_ratio
     with tf.name_scope('batch_processing'):
@@ -513,37 +798,58 @@ class RecordInputImagePreprocessor(BaseImagePreprocess):
       if use_datasets:
         ds_iterator = data_utils.create_iterator(
             self.batch_size, self.num_splits, self.batch_size_per_split,
-            self.parse_and_preprocess, dataset, subset, self.train, cache_data)
+            self.parse_and_preprocess, dataset, subset, self.train, cache_data,
+            batch_preprocess_fn=self.get_batch_preprocess_fn(),
+            worker_index=worker_index, num_workers=num_workers,
+            options=self.input_pipeline_options)
         for d in xrange(self.num_splits):
           labels[d], images[d] = ds_iterator.get_next()
 
       else:
+        if num_workers > 1:
+          # RecordInput only accepts a file pattern, so the files cannot be
+          # split across workers. Instead, each worker starts reading at a
+          # different position in the (shuffled) list of files.
+          shift_ratio = float(worker_index) / num_workers
         record_input = data_flow_ops.RecordInput(
             file_pattern=dataset.tf_record_pattern(subset),
             seed=301,
-            parallelism=64,
-            buffer_size=10000,
+            parallelism=self.input_pipeline_options.record_input_parallelism,
+            buffer_size=self.input_pipeline_options.record_input_buffer_size,
             batch_size=self.batch_size,
             shift_ratio=shift_ratio,
             name='record_input')
         records = record_input.get_yield_op()
-        records = tf.split(records, self.batch_size, 0)
-        records = [tf.reshape(record, []) for record in records]
-        for idx in xrange(self.batch_size):
-          value = records[idx]
-          (label, image) = self.parse_and_preprocess(value, idx)
-          split_index = idx % self.num_splits
-          labels[split_index].append(label)
-          images[split_index].append(image)
+        if self.summary_verbosity >= 3:
+          # Image summaries cannot be created inside the while loop built by
+          # tf.map_fn, so build one preprocessing subgraph per image instead.
+          records = tf.split(records, self.batch_size, 0)
+          records = [tf.reshape(record, []) for record in records]
+          for idx in xrange(self.batch_size):
+            value = records[idx]
+            (label, image) = self.parse_and_preprocess(value, idx)
+            split_index = idx % self.num_splits
+            labels[split_index].append(label)
+            images[split_index].append(image)
+          for split_index in xrange(self.num_splits):
+            images[split_index] = tf.parallel_stack(images[split_index])
+            labels[split_index] = tf.concat(labels[split_index], 0)
+        else:
+          all_labels, all_images = self._map_parse_and_preprocess(records)
+          for split_index in xrange(self.num_splits):
+            # Image idx goes to split idx % num_splits, as in the unrolled
+            # graph above.
+            images[split_index] = all_images[split_index::self.num_splits]
+            labels[split_index] = all_labels[split_index::self.num_splits]
 
       for split_index in xrange(self.num_splits):
         if not use_datasets:
-          images[split_index] = tf.parallel_stack(images[split_index])
-          labels[split_index] = tf.concat(labels[split_index], 0)
+          if self.vectorized_distortions:
+            images[split_index] = self.preprocess_batch(images[split_index])
         images[split_index] = tf.reshape(
             images[split_index],
-            shape=[self.batch_size_per_split, self.height, self.width,
-                   self.depth])
+            shape=[self.batch_size_per_split * self.num_crops_per_image(),
+                   self.height, self.width, self.depth])
         labels[split_index] = tf.reshape(labels[split_index],
                                          [self.batch_size_per_split])
       return images, labels
@@ -551,9 +857,21 @@ class RecordInputImagePreprocessor(BaseImagePreprocess):
   def supports_datasets(self):
     return True
 
+  def supports_vectorized_distortions(self):
+    return True
+
+  def supports_eval_crops(self):
+    return True
+
 
 class ImagenetPreprocessor(RecordInputImagePreprocessor):
 
+  def supports_vectorized_distortions(self):
+    return False
+
+  def supports_eval_crops(self):
+    return False
+
   def preprocess(self, image_buffer, bbox, batch_position):
     # pylint: disable=g-import-not-at-top
     try:
@@ -572,6 +890,63 @@ class ImagenetPreprocessor(RecordInputImagePreprocessor):
     return tf.cast(image, self.dtype)
 
 
+class RawPixelImagePreprocessor(RecordInputImagePreprocessor):
+  """Preprocessor for TFRecords written by convert_to_raw_tfrecords.py.
+
+  The images are stored as uint8 pixels, so no JPEG decoding is done. When
+  training, like in RecordInputImagePreprocessor, a random crop of random area
+  and aspect ratio is taken and resized to the model's image size, and the
+  image is flipped and its colors optionally distorted. Since the stored images
+  are already center cropped, the crops cover less of the original image than
+  with JPEG input. Otherwise, the central crop is taken. The stored images must
+  be at least as large as the model's image size.
+  """
+
+  def supports_eval_crops(self):
+    return False
+
+  def parse_and_preprocess(self, value, batch_position):
+    image, label_index = parse_raw_example_proto(value)
+    image = self.preprocess(image, None, batch_position)
+    return (label_index, image)
+
+  def preprocess(self, image_buffer, bbox, batch_position):
+    """Preprocesses the uint8 image `image_buffer`, ignoring `bbox`."""
+    del bbox
+    if self.train:
+      # Use the same scale and aspect ratio augmentation as train_image, with
+      # the whole stored image as the bounding box.
+      bbox_begin, bbox_size, _ = tf.image.sample_distorted_bounding_box(
+          tf.shape(image_buffer),
+          bounding_boxes=tf.zeros([1, 0, 4]),
+          min_object_covered=0.1,
+          aspect_ratio_range=[0.75, 1.33],
+          area_range=[0.05, 1.0],
+          max_attempts=100,
+          use_image_if_no_bounding_boxes=True)
+      image = tf.slice(image_buffer, bbox_begin, bbox_size)
+      image = tf.image.resize_images(
+          image, [self.height, self.width],
+          get_image_resize_method(self.resize_method, batch_position),
+          align_corners=False)
+    else:
+      image = tf.image.resize_image_with_crop_or_pad(image_buffer, self.height,
+                                                     self.width)
+    image = tf.cast(image, tf.float32)
+    image.set_shape([self.height, self.width, self.depth])
+    if self.vectorized_distortions:
+      return image
+    if self.train:
+      image = tf.image.random_flip_left_right(image)
+      if self.distortions:
+        # Images values are expected to be in [0,1] for color distortion.
+        image = distort_color(image / 255., batch_position,
+                              distort_color_in_yiq=self.distort_color_in_yiq)
+        image *= 255
+    normalized = normalized_image(image)
+    return tf.cast(normalized, self.dtype)
+
+
 class Cifar10ImagePreprocessor(BaseImagePreprocess):
   """Preprocessor for Cifar10 input images."""
 
@@ -618,9 +993,9 @@ class Cifar10ImagePreprocessor(BaseImagePreprocess):
     return tf.cast(normalized, self.dtype)
 
   def minibatch(self, dataset, subset, use_datasets, cache_data,
-                shift_ratio=-1):
+                shift_ratio=-1, worker_index=0, num_workers=1):
     # TODO(jsimsa): Implement datasets code path
-    del use_datasets, cache_data, shift_ratio
+    del use_datasets, cache_data, shift_ratio, worker_index, num_workers
     with tf.name_scope('batch_processing'):
       all_images, all_labels = dataset.read_data_files(subset)
       all_images = tf.constant(all_images)
@@ -668,15 +1043,19 @@ class SyntheticImagePreprocessor(BaseImagePreprocess):
   """Preprocessor used for images and labels."""
 
   def minibatch(self, dataset, subset, use_datasets, cache_data,
-                shift_ratio=-1):
+                shift_ratio=-1, worker_index=0, num_workers=1):
     """Get synthetic image batches."""
-    del subset, use_datasets, cache_data, shift_ratio
+    del subset, use_datasets, cache_data, shift_ratio, worker_index
+    del num_workers
     input_shape = [self.batch_size, self.height, self.width, self.depth]
+    # Random ops may not support bfloat16, so bfloat16 images are generated in
+    # fp32.
     images = tf.truncated_normal(
         input_shape,
-        dtype=self.dtype,
+        dtype=tf.float32 if self.dtype == tf.bfloat16 else self.dtype,
         stddev=1e-1,
         name='synthetic_images')
+    images = tf.cast(images, self.dtype)
     labels = tf.random_uniform(
         [self.batch_size],
         minval=0,
@@ -719,12 +1098,16 @@ class TestImagePreprocessor(BaseImagePreprocess):
                shift_ratio=0,
                summary_verbosity=0,
                distort_color_in_yiq=False,
-               fuse_decode_and_crop=False):
+               fuse_decode_and_crop=False,
+               vectorized_distortions=False,
+               input_pipeline_options=None):
     super(TestImagePreprocessor, self).__init__(
         height, width, batch_size, num_splits, dtype, train, distortions,
         resize_method, shift_ratio, summary_verbosity=summary_verbosity,
         distort_color_in_yiq=distort_color_in_yiq,
-        fuse_decode_and_crop=fuse_decode_and_crop)
+        fuse_decode_and_crop=fuse_decode_and_crop,
+        vectorized_distortions=vectorized_distortions,
+        input_pipeline_options=input_pipeline_options)
     self.expected_subset = None
 
   def set_fake_data(self, fake_images, fake_labels):
@@ -737,9 +1120,9 @@ class TestImagePreprocessor(BaseImagePreprocess):
     self.fake_labels = fake_labels
 
   def minibatch(self, dataset, subset, use_datasets, cache_data,
-                shift_ratio=0):
+                shift_ratio=0, worker_index=0, num_workers=1):
     """Get test image batches."""
-    del dataset, use_datasets, cache_data
+    del dataset, use_datasets, cache_data, worker_index, num_workers
     if (not hasattr(self, 'fake_images') or
         not hasattr(self, 'fake_labels')):
       raise ValueError('Must call set_fake_data() before calling minibatch '
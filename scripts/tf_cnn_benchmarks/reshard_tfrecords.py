@@ -0,0 +1,77 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Reshards an ImageNet data_dir into pre-shuffled, size-balanced shards.
+
+Example:
+  python reshard_tfrecords.py --input_dir=/data/imagenet \
+      --output_dir=/data/imagenet_resharded --num_shards=1024
+
+The output directory can then be passed to tf_cnn_benchmarks.py with
+--data_dir. See tfrecord_index.py for how the index written next to the
+shards is used.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from absl import app
+from absl import flags as absl_flags
+
+from tensorflow.python.platform import gfile
+import tfrecord_index
+from cnn_util import log_fn
+
+
+absl_flags.DEFINE_string('input_dir', None,
+                         'Directory containing the <subset>-*-of-* TFRecord '
+                         'files to reshard.')
+absl_flags.DEFINE_string('output_dir', None,
+                         'Directory to write the shards and indices to.')
+absl_flags.DEFINE_list('subsets', ['train', 'validation'],
+                       'Subsets to reshard.')
+absl_flags.DEFINE_integer('num_shards', 1024,
+                          'Number of shards to write per subset. Should be a '
+                          'multiple of the number of workers that will read '
+                          'the data.')
+absl_flags.DEFINE_integer('seed', 301, 'Seed of the global shuffle.')
+
+FLAGS = absl_flags.FLAGS
+
+
+def main(positional_arguments):
+  if len(positional_arguments) > 1:
+    raise ValueError('Received unknown positional arguments: %s'
+                     % positional_arguments[1:])
+  for subset in FLAGS.subsets:
+    input_paths = sorted(
+        gfile.Glob(os.path.join(FLAGS.input_dir, '%s-*-of-*' % subset)))
+    if not input_paths:
+      raise ValueError('Found no files in %s for subset %s' %
+                       (FLAGS.input_dir, subset))
+    log_fn('Resharding %d %s files into %d shards' %
+           (len(input_paths), subset, FLAGS.num_shards))
+    index = tfrecord_index.reshard(input_paths, FLAGS.output_dir, subset,
+                                   FLAGS.num_shards, seed=FLAGS.seed)
+    log_fn('Wrote %d %s records to %s' %
+           (index.num_records, subset, FLAGS.output_dir))
+
+
+if __name__ == '__main__':
+  absl_flags.mark_flag_as_required('input_dir')
+  absl_flags.mark_flag_as_required('output_dir')
+  app.run(main)
@@ -29,6 +29,8 @@ import allreduce_test
 import benchmark_cnn_distributed_test
 import benchmark_cnn_test
 import cnn_util_test
+import gradient_checkpointing_test
+import tfrecord_index_test
 import variable_mgr_util_test
 from models import nasnet_test
 
@@ -61,6 +63,8 @@ def main(_):
     suite = unittest.TestSuite([
         loader.loadTestsFromModule(allreduce_test),
         loader.loadTestsFromModule(cnn_util_test),
+        loader.loadTestsFromModule(gradient_checkpointing_test),
+        loader.loadTestsFromModule(tfrecord_index_test),
         loader.loadTestsFromModule(variable_mgr_util_test),
         loader.loadTestsFromModule(benchmark_cnn_test),
         loader.loadTestsFromModule(all_reduce_benchmark_test),
@@ -73,6 +77,8 @@ def main(_):
     suite = unittest.TestSuite([
         loader.loadTestsFromModule(allreduce_test),
         loader.loadTestsFromModule(cnn_util_test),
+        loader.loadTestsFromModule(gradient_checkpointing_test),
+        loader.loadTestsFromModule(tfrecord_index_test),
         loader.loadTestsFromModule(all_reduce_benchmark_test),
         loader.loadTestsFromModule(variable_mgr_util_test),
         loader.loadTestsFromTestCase(benchmark_cnn_test.TestAlexnetModel),
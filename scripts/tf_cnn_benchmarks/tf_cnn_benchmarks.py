@@ -20,6 +20,13 @@ See the README for more information.
 
 from __future__ import print_function
 
+import time
+
+# Measures how long importing TensorFlow and the benchmark modules takes, which
+# is part of the startup time of every run.
+_import_start_time = time.time()
+
+# pylint: disable=g-import-not-at-top
 from absl import app
 from absl import flags as absl_flags
 import tensorflow as tf
@@ -28,6 +35,9 @@ import benchmark_cnn
 import cnn_util
 import flags
 from cnn_util import log_fn
+# pylint: enable=g-import-not-at-top
+
+_import_secs = time.time() - _import_start_time
 
 
 flags.define_flags()
@@ -51,6 +61,7 @@ def main(positional_arguments):
 
   tfversion = cnn_util.tensorflow_version_tuple()
   log_fn('TensorFlow:  %i.%i' % (tfversion[0], tfversion[1]))
+  log_fn('Import time: %.2f sec' % _import_secs)
 
   bench.print_info()
   bench.run()
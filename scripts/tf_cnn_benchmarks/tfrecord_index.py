@@ -0,0 +1,265 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Pre-shuffled, size-balanced TFRecord shards and their sidecar index.
+
+`reshard` reads the TFRecord files of a subset, globally shuffles their records
+and writes them to shards that have roughly the same number of bytes each. It
+also writes an index of the subset, with the shard, byte offset and label of
+every record. The index is stored next to the shards, in
+'<subset>-index.npz'.
+
+When an index exists in the data_dir, the input pipeline uses it to get the
+exact number of examples per epoch and to give each worker a disjoint set of
+shards. Since the records are already shuffled, a small shuffle buffer is
+enough. The index also allows reading any record directly with
+`TFRecordIndex.read_record`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import struct
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+from tensorflow.python.platform import gfile
+
+# A TFRecord is stored as a uint64 length, a uint32 CRC of the length, the data
+# and a uint32 CRC of the data.
+_RECORD_HEADER_SIZE = 12
+_RECORD_FOOTER_SIZE = 4
+_RECORD_OVERHEAD = _RECORD_HEADER_SIZE + _RECORD_FOOTER_SIZE
+
+
+def index_path(data_dir, subset):
+  """Returns the path of the index of `subset` in `data_dir`."""
+  return os.path.join(data_dir, '%s-index.npz' % subset)
+
+
+def shard_name(subset, shard_num, num_shards):
+  """Returns the file name of a shard, matching Dataset.tf_record_pattern."""
+  return '%s-%05d-of-%05d' % (subset, shard_num, num_shards)
+
+
+def scan_tfrecord_file(path):
+  """Returns the byte offsets and data lengths of the records in a file.
+
+  Only the record headers are read, so this is much faster than parsing the
+  records. CRCs are not checked.
+
+  Args:
+    path: The path of an uncompressed TFRecord file.
+  Returns:
+    A tuple (offsets, lengths) of int64 numpy arrays. offsets[i] is the
+    position of the header of record i, and lengths[i] is the length of its
+    data.
+  """
+  offsets = []
+  lengths = []
+  file_size = gfile.Stat(path).length
+  with gfile.GFile(path, 'rb') as f:
+    offset = 0
+    while offset < file_size:
+      f.seek(offset)
+      header = f.read(_RECORD_HEADER_SIZE)
+      if len(header) != _RECORD_HEADER_SIZE:
+        raise ValueError('Truncated record at offset %d of %s' % (offset, path))
+      length, = struct.unpack('<Q', header[:8])
+      offsets.append(offset)
+      lengths.append(length)
+      offset += length + _RECORD_OVERHEAD
+  return (np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64))
+
+
+def read_record_at(f, offset):
+  """Returns the data of the record whose header starts at `offset` in `f`."""
+  f.seek(offset)
+  header = f.read(_RECORD_HEADER_SIZE)
+  length, = struct.unpack('<Q', header[:8])
+  return f.read(length)
+
+
+def get_example_label(serialized_example):
+  """Returns the 'image/class/label' of a serialized tf.train.Example."""
+  example = tf.train.Example.FromString(serialized_example)
+  return example.features.feature['image/class/label'].int64_list.value[0]
+
+
+def split_by_bytes(sizes, num_shards):
+  """Splits a sequence of items into contiguous, byte-balanced shards.
+
+  Args:
+    sizes: A list or numpy array with the size in bytes of each item.
+    num_shards: The number of shards.
+  Returns:
+    A list of num_shards + 1 boundaries. Shard i contains items
+    boundaries[i] to boundaries[i + 1] - 1.
+  """
+  if num_shards < 1:
+    raise ValueError('num_shards must be at least 1, but got %d' % num_shards)
+  if num_shards > len(sizes):
+    raise ValueError('Cannot split %d records into %d shards' %
+                     (len(sizes), num_shards))
+  cumulative_sizes = np.cumsum(sizes)
+  total_size = cumulative_sizes[-1]
+  boundaries = [0]
+  for i in xrange(1, num_shards):
+    boundary = int(np.searchsorted(cumulative_sizes,
+                                   total_size * i / num_shards)) + 1
+    # Every shard has at least one item.
+    boundary = max(boundary, boundaries[-1] + 1)
+    boundary = min(boundary, len(sizes) - (num_shards - i))
+    boundaries.append(boundary)
+  boundaries.append(len(sizes))
+  return boundaries
+
+
+class TFRecordIndex(object):
+  """The shard, offset, length and label of every record of a subset."""
+
+  def __init__(self, data_dir, shard_names, shard_ids, offsets, lengths,
+               labels):
+    self.data_dir = data_dir
+    self.shard_names = list(shard_names)
+    self.shard_ids = np.asarray(shard_ids, dtype=np.int32)
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.lengths = np.asarray(lengths, dtype=np.int64)
+    self.labels = np.asarray(labels, dtype=np.int32)
+    self._open_files = {}
+
+  @property
+  def num_records(self):
+    return len(self.offsets)
+
+  @property
+  def num_shards(self):
+    return len(self.shard_names)
+
+  def shard_paths(self):
+    return [os.path.join(self.data_dir, name) for name in self.shard_names]
+
+  def shard_num_records(self):
+    """Returns the number of records in each shard."""
+    return np.bincount(self.shard_ids, minlength=self.num_shards)
+
+  def read_record(self, i):
+    """Returns the serialized data of record `i`."""
+    shard_id = self.shard_ids[i]
+    f = self._open_files.get(shard_id)
+    if f is None:
+      f = gfile.GFile(
+          os.path.join(self.data_dir, self.shard_names[shard_id]), 'rb')
+      self._open_files[shard_id] = f
+    return read_record_at(f, self.offsets[i])
+
+  def close(self):
+    for f in self._open_files.values():
+      f.close()
+    self._open_files = {}
+
+  def save(self, path):
+    # np.savez needs a seekable file, which gfile does not provide for writing.
+    buf = io.BytesIO()
+    np.savez(buf, shard_names=np.array(self.shard_names),
+             shard_ids=self.shard_ids, offsets=self.offsets,
+             lengths=self.lengths, labels=self.labels)
+    with gfile.GFile(path, 'wb') as f:
+      f.write(buf.getvalue())
+
+  @classmethod
+  def load(cls, path):
+    """Loads an index written by `save`, relative to its directory."""
+    with gfile.GFile(path, 'rb') as f:
+      arrays = np.load(io.BytesIO(f.read()))
+    return cls(os.path.dirname(path),
+               [str(name) for name in arrays['shard_names']],
+               arrays['shard_ids'], arrays['offsets'], arrays['lengths'],
+               arrays['labels'])
+
+
+def load_index(data_dir, subset):
+  """Returns the TFRecordIndex of `subset`, or None if it does not exist."""
+  path = index_path(data_dir, subset)
+  if not gfile.Exists(path):
+    return None
+  return TFRecordIndex.load(path)
+
+
+def reshard(input_paths, output_dir, subset, num_shards, seed=None):
+  """Writes the records of `input_paths` as pre-shuffled, balanced shards.
+
+  Each shard is held in memory while it is written.
+
+  Args:
+    input_paths: The paths of the TFRecord files to read.
+    output_dir: The directory to write the shards and the index to.
+    subset: The subset, e.g. 'train'. Used to name the output files.
+    num_shards: The number of shards to write.
+    seed: The seed of the shuffle. If None, the shuffle is not reproducible.
+  Returns:
+    The TFRecordIndex of the written shards.
+  """
+  input_files = []
+  input_offsets = []
+  input_lengths = []
+  for file_num, path in enumerate(input_paths):
+    offsets, lengths = scan_tfrecord_file(path)
+    input_files.append(np.full(len(offsets), file_num, dtype=np.int32))
+    input_offsets.append(offsets)
+    input_lengths.append(lengths)
+  input_files = np.concatenate(input_files)
+  input_offsets = np.concatenate(input_offsets)
+  input_lengths = np.concatenate(input_lengths)
+
+  permutation = np.random.RandomState(seed).permutation(len(input_offsets))
+  boundaries = split_by_bytes(input_lengths[permutation] + _RECORD_OVERHEAD,
+                              num_shards)
+
+  gfile.MakeDirs(output_dir)
+  shard_names = [shard_name(subset, i, num_shards) for i in xrange(num_shards)]
+  shard_ids = np.zeros(len(permutation), dtype=np.int32)
+  offsets = np.zeros(len(permutation), dtype=np.int64)
+  lengths = input_lengths[permutation]
+  labels = np.zeros(len(permutation), dtype=np.int32)
+  for shard_num in xrange(num_shards):
+    positions = np.arange(boundaries[shard_num], boundaries[shard_num + 1])
+    record_nums = permutation[positions]
+    record_files = input_files[record_nums]
+    # Read the records of the shard one input file at a time, so that only one
+    # input file is open at once, then write them in shuffled order.
+    records = [None] * len(positions)
+    for file_num in np.unique(record_files):
+      with gfile.GFile(input_paths[file_num], 'rb') as f:
+        for j in np.flatnonzero(record_files == file_num):
+          records[j] = read_record_at(f, input_offsets[record_nums[j]])
+    offset = 0
+    with tf.python_io.TFRecordWriter(
+        os.path.join(output_dir, shard_names[shard_num])) as writer:
+      for i, data in zip(positions, records):
+        writer.write(data)
+        shard_ids[i] = shard_num
+        offsets[i] = offset
+        labels[i] = get_example_label(data)
+        offset += len(data) + _RECORD_OVERHEAD
+
+  index = TFRecordIndex(output_dir, shard_names, shard_ids, offsets, lengths,
+                        labels)
+  index.save(index_path(output_dir, subset))
+  return index
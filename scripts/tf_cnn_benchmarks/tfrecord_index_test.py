@@ -0,0 +1,114 @@
+# Copyright 2018 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for tf_cnn_benchmark.tfrecord_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import tensorflow as tf
+import datasets
+import tfrecord_index
+
+
+def _make_example(label, num_bytes):
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/class/label': tf.train.Feature(
+          int64_list=tf.train.Int64List(value=[label])),
+      'image/encoded': tf.train.Feature(
+          bytes_list=tf.train.BytesList(value=[b'x' * num_bytes])),
+  })).SerializeToString()
+
+
+class TFRecordIndexTest(tf.test.TestCase):
+
+  def _write_input_files(self, input_dir, num_files, records_per_file):
+    os.makedirs(input_dir)
+    paths = []
+    label = 0
+    for i in range(num_files):
+      path = os.path.join(input_dir, 'train-%05d-of-%05d' % (i, num_files))
+      with tf.python_io.TFRecordWriter(path) as writer:
+        for _ in range(records_per_file):
+          writer.write(_make_example(label, 10 + 7 * (label % 5)))
+          label += 1
+      paths.append(path)
+    return paths
+
+  def testSplitByBytes(self):
+    self.assertEqual(tfrecord_index.split_by_bytes([1] * 6, 3), [0, 2, 4, 6])
+    self.assertEqual(tfrecord_index.split_by_bytes([10, 1, 1, 1, 1], 2),
+                     [0, 1, 5])
+    self.assertEqual(tfrecord_index.split_by_bytes([1, 1, 10], 3), [0, 1, 2, 3])
+    with self.assertRaises(ValueError):
+      tfrecord_index.split_by_bytes([1, 1], 3)
+
+  def testScanTFRecordFile(self):
+    input_dir = os.path.join(self.get_temp_dir(), 'scan')
+    path, = self._write_input_files(input_dir, 1, 4)
+    offsets, lengths = tfrecord_index.scan_tfrecord_file(path)
+    records = list(tf.python_io.tf_record_iterator(path))
+    self.assertAllEqual(lengths, [len(record) for record in records])
+    with open(path, 'rb') as f:
+      for offset, record in zip(offsets, records):
+        self.assertEqual(tfrecord_index.read_record_at(f, offset), record)
+
+  def testReshard(self):
+    input_dir = os.path.join(self.get_temp_dir(), 'input')
+    output_dir = os.path.join(self.get_temp_dir(), 'output')
+    input_paths = self._write_input_files(input_dir, 3, 20)
+    index = tfrecord_index.reshard(input_paths, output_dir, 'train', 4, seed=1)
+
+    self.assertEqual(index.num_records, 60)
+    self.assertEqual(index.num_shards, 4)
+    self.assertEqual(sum(index.shard_num_records()), 60)
+    self.assertAllEqual(sorted(index.labels), range(60))
+    # The records are shuffled.
+    self.assertNotEqual(list(index.labels), list(range(60)))
+
+    # The shards have about the same size.
+    shard_sizes = [os.path.getsize(path) for path in index.shard_paths()]
+    self.assertLess(max(shard_sizes) - min(shard_sizes),
+                    2 * (max(index.lengths) + 16))
+
+    # The index matches the contents of the shards.
+    i = 0
+    for shard_id, path in enumerate(index.shard_paths()):
+      for record in tf.python_io.tf_record_iterator(path):
+        self.assertEqual(index.shard_ids[i], shard_id)
+        self.assertEqual(index.read_record(i), record)
+        self.assertEqual(tfrecord_index.get_example_label(record),
+                         index.labels[i])
+        i += 1
+    self.assertEqual(i, 60)
+    index.close()
+
+    loaded_index = tfrecord_index.load_index(output_dir, 'train')
+    self.assertEqual(loaded_index.shard_names, index.shard_names)
+    self.assertAllEqual(loaded_index.offsets, index.offsets)
+    self.assertAllEqual(loaded_index.labels, index.labels)
+    self.assertIsNone(tfrecord_index.load_index(output_dir, 'validation'))
+
+    dataset = datasets.create_dataset(output_dir, 'imagenet')
+    self.assertEqual(dataset.num_examples_per_epoch('train'), 60)
+    self.assertEqual(dataset.num_examples_per_epoch('validation'),
+                     datasets.IMAGENET_NUM_VAL_IMAGES)
+
+
+if __name__ == '__main__':
+  tf.test.main()
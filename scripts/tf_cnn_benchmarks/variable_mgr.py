@@ -262,10 +262,15 @@ class VariableMgrLocalReplicated(VariableMgr):
      either a local all-reduce algorithm is applied or a regular
      cross-device aggregation is used to replicate the combined
      gradients to all towers.
+
+     With shard_optimizer_state, each variable is instead owned by a single
+     device. Its gradients are summed on that device, which applies them and
+     then copies the updated variable to the other devices, so the optimizer
+     slots of the variable only exist on that device.
   """
 
   def __init__(self, benchmark_cnn, all_reduce_spec, agg_small_grads_max_bytes,
-               agg_small_grads_max_group):
+               agg_small_grads_max_group, shard_optimizer_state=False):
     super(VariableMgrLocalReplicated, self).__init__(benchmark_cnn)
     if all_reduce_spec:
       spec = allreduce.parse_all_reduce_spec(all_reduce_spec)
@@ -279,6 +284,10 @@ class VariableMgrLocalReplicated(VariableMgr):
     self._agg_small_grads_max_group = agg_small_grads_max_group
     self._warmup_ops = []
     self._gradient_put_ops = None
+    self._shard_optimizer_state = shard_optimizer_state
+    # Maps the name of each variable copy updated by its owning device to the
+    # copies of the variable on the other devices.
+    self._replicas_by_owned_var = {}
 
   def each_tower_has_variables(self):
     return True
@@ -288,15 +297,20 @@ class VariableMgrLocalReplicated(VariableMgr):
                              use_resource=self.use_resource_vars)
 
   def preprocess_device_grads(self, device_grads):
-    compact_grads = (self.benchmark_cnn.params.use_fp16 and
-                     self.benchmark_cnn.params.compact_gradient_transfer)
-    defer_grads = (self.benchmark_cnn.params.variable_consistency == 'relaxed')
+    if self._shard_optimizer_state:
+      return self._reduce_device_grads_to_owners(device_grads)
+    params = self.benchmark_cnn.params
+    compact_grads = ((params.use_fp16 or params.compute_dtype == 'bfloat16')
+                     and params.compact_gradient_transfer)
+    compact_dtype = tf.bfloat16 if params.compute_dtype == 'bfloat16' else (
+        tf.float16)
+    defer_grads = (params.variable_consistency == 'relaxed')
 
     grads_to_reduce = [[g for g, _ in grad_vars] for grad_vars in device_grads]
-    algorithm = batch_allreduce.algorithm_from_params(self.benchmark_cnn.params)
+    algorithm = batch_allreduce.algorithm_from_params(params)
     reduced_grads, self._warmup_ops = algorithm.batch_all_reduce(
-        grads_to_reduce, self.benchmark_cnn.params.gradient_repacking,
-        compact_grads, defer_grads)
+        grads_to_reduce, params.gradient_repacking, compact_grads, defer_grads,
+        compact_dtype)
     if self.benchmark_cnn.enable_auto_loss_scale:
       # Check for infs or nans
       is_finite_list = []
@@ -312,10 +326,86 @@ class VariableMgrLocalReplicated(VariableMgr):
     ] for grads, grad_vars in zip(reduced_grads, device_grads)]
     return self.benchmark_cnn.devices, reduced_device_grads
 
+  def _reduce_device_grads_to_owners(self, device_grads):
+    """Sums each gradient on the device owning its variable.
+
+    Args:
+      device_grads: List of lists of (gradient, variable) tuples, as passed to
+        preprocess_device_grads.
+
+    Returns:
+      A tuple (apply_gradients_devices, owned_device_grads), where
+      owned_device_grads[d] is the list of (summed gradient, variable) tuples
+      of the variables owned by device d.
+    """
+    params = self.benchmark_cnn.params
+    compact_grads = ((params.use_fp16 or params.compute_dtype == 'bfloat16')
+                     and params.compact_gradient_transfer)
+    compact_dtype = tf.bfloat16 if params.compute_dtype == 'bfloat16' else (
+        tf.float16)
+    check_inf_nan = self.benchmark_cnn.enable_auto_loss_scale
+
+    variable_sizes = [v.shape.num_elements() * v.dtype.base_dtype.size
+                      for _, v in device_grads[0]]
+    owners = variable_mgr_util.get_variable_owners(variable_sizes,
+                                                   len(device_grads))
+    owned_device_grads = [[] for _ in device_grads]
+    has_inf_nan_list = []
+    for i, single_grads in enumerate(zip(*device_grads)):
+      owner = owners[i]
+      _, var = single_grads[owner]
+      grad_dtype = single_grads[owner][0].dtype
+      if compact_grads:
+        # Cast on the devices computing the gradients, so that only the
+        # compact gradients are copied to the owning device.
+        compacted_grads = []
+        for g, v in single_grads:
+          with tf.colocate_with(g):
+            compacted_grads.append((tf.cast(g, compact_dtype), v))
+        single_grads = compacted_grads
+      with tf.device(var.device):
+        (grad, _), has_inf_nan = (
+            variable_mgr_util.aggregate_single_gradient_using_copy(
+                single_grads, use_mean=False, check_inf_nan=check_inf_nan))
+        grad = tf.cast(grad, grad_dtype)
+      owned_device_grads[owner].append((grad, var))
+      has_inf_nan_list.append(has_inf_nan)
+      self._replicas_by_owned_var[var.name] = [
+          v for d, (_, v) in enumerate(single_grads) if d != owner]
+    if check_inf_nan:
+      self.grad_has_inf_nan = tf.reduce_any(has_inf_nan_list)
+    return self.benchmark_cnn.devices, owned_device_grads
+
   def get_gradients_to_apply(self, device_num, gradient_state):
     device_grads = gradient_state
     return device_grads[device_num]
 
+  def append_apply_gradients_ops(self, gradient_state, opt, grads, training_ops,
+                                 loss_scale_params):
+    if not self._shard_optimizer_state:
+      super(VariableMgrLocalReplicated, self).append_apply_gradients_ops(
+          gradient_state, opt, grads, training_ops, loss_scale_params)
+      return
+
+    def get_apply_gradients_ops_func():
+      """Returns the apply_gradients op and the copies of its variables."""
+      if not grads:
+        # There are more devices than variables, and this one owns none. The
+        # loss scale must still be updated if this is the first device.
+        return []
+      apply_op = opt.apply_gradients(grads)
+      copy_ops = []
+      with tf.control_dependencies([apply_op]):
+        for _, var in grads:
+          value = var.read_value()
+          for replica in self._replicas_by_owned_var[var.name]:
+            copy_ops.append(replica.assign(value))
+      return [apply_op] + copy_ops
+
+    variable_mgr_util.append_gradients_with_loss_scale(
+        training_ops, get_apply_gradients_ops_func, loss_scale_params,
+        self.grad_has_inf_nan)
+
   def get_post_init_ops(self):
     # Copy initialized values for variables on GPU 0 to other GPUs.
     global_vars = tf.global_variables()
@@ -327,13 +417,20 @@ class VariableMgrLocalReplicated(VariableMgr):
       if split_name[0] == 'v0' or not v.name.startswith('v'):
         continue
       split_name[0] = 'v0'
-      copy_from = var_by_name['/'.join(split_name)]
+      copy_from = var_by_name.get('/'.join(split_name))
+      if copy_from is None:
+        # With shard_optimizer_state, the optimizer slots of the variables
+        # owned by this device have no copy on GPU 0.
+        assert self._shard_optimizer_state, v.name
+        continue
       post_init_ops.append(v.assign(copy_from.read_value()))
     post_init_ops += self._warmup_ops
     return post_init_ops
 
   def savable_variables(self):
     """Return the set of variables used for saving/loading the model."""
+    if self._shard_optimizer_state:
+      return self._sharded_savable_variables()
     params = []
     for v in tf.global_variables():
       split_name = v.name.split('/')
@@ -341,6 +438,36 @@ class VariableMgrLocalReplicated(VariableMgr):
         params.append(v)
     return params
 
+  def _sharded_savable_variables(self):
+    """Returns a dict of savable variables for shard_optimizer_state.
+
+    The optimizer slots of the variables owned by a device other than GPU 0 are
+    saved under the name they would have on GPU 0, so that checkpoints do not
+    depend on how the variables are split across the devices.
+
+    Raises:
+      ValueError: If a variable of another device has the name of a variable of
+        GPU 0 with a different shape, so it is not a copy of that variable and
+        would not be saved.
+    """
+    global_vars = tf.global_variables()
+    var_by_name = dict((v.op.name, v) for v in global_vars)
+    params = {}
+    for v in global_vars:
+      split_name = v.op.name.split('/')
+      if split_name[0] == 'v0' or not v.name.startswith('v'):
+        params[v.op.name] = v
+        continue
+      split_name[0] = 'v0'
+      name = '/'.join(split_name)
+      if name not in var_by_name:
+        params[name] = v
+      elif not v.shape.is_compatible_with(var_by_name[name].shape):
+        raise ValueError('%s is not a copy of %s, since their shapes %s and %s '
+                         'differ' % (v.op.name, name, v.shape,
+                                     var_by_name[name].shape))
+    return params
+
   def get_devices(self):
     return self.benchmark_cnn.raw_devices
 
@@ -23,6 +23,7 @@ import tensorflow as tf
 
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import data_flow_ops
+import batch_allreduce
 
 
 PS_SHADOW_VAR_PREFIX = 'ps_var'
@@ -44,22 +45,36 @@ AutoLossScaleParams = pycoll.namedtuple(
         # for better performance.
         # TODO(tanmingxing): remove this if loss_scale is updated in ps.
         'is_chief',
+        # If not None, a tf.Variable counting the steps whose gradients were
+        # discarded because they had infs or nans.
+        'loss_scale_skipped_steps',
+        # The loss scale is multiplied by this every `inc_loss_scale_every_n`
+        # steps without infs or nans.
+        'inc_loss_scale_factor',
+        # The loss scale is divided by this when infs or nans occur.
+        'dec_loss_scale_factor',
+        # If true, the loss scale and the step counters are updated along with
+        # the gradients. When the gradients are applied on several devices,
+        # only one of them must update these, so that they change once per
+        # step.
+        'update_loss_scale',
     ])
+AutoLossScaleParams.__new__.__defaults__ = (None, 2, 2., True)
 
 
 def get_loss_scale_update_op(loss_scale, loss_scale_normal_steps,
-                             inc_loss_scale_every_n):
+                             inc_loss_scale_every_n, inc_loss_scale_factor=2):
   """Returns the update op for loss scaling variables.
 
   We maintain the counter `loss_scale_normal_steps` to count the number of steps
   we have been using the current `loss_scale`. In most cases, this function
   increments `loss_scale_normal_steps`. However, if `loss_scale_normal_steps` is
-  greater than the threshold `inc_loss_scale_every_n`, we double `loss_scale`
-  and reset `loss_scale_normal_steps` to zero.
+  greater than the threshold `inc_loss_scale_every_n`, we multiply `loss_scale`
+  by `inc_loss_scale_factor` and reset `loss_scale_normal_steps` to zero.
 
   This op is only called if the gradients don't have any infs or nans. Instead,
-  if infs or nans occur in the gradients, we immeditately halve `loss_scale` and
-  reset `loss_scale_normal_steps` to zero.
+  if infs or nans occur in the gradients, we immeditately decrease `loss_scale`
+  and reset `loss_scale_normal_steps` to zero.
 
   Args:
     loss_scale: a tf.Variable represneting the loss_scale value.
@@ -68,6 +83,8 @@ def get_loss_scale_update_op(loss_scale, loss_scale_normal_steps,
     inc_loss_scale_every_n: a Python integer threshold. `loss_scale` is
       increased every `inc_loss_scale_every_n` steps, unless the gradients have
       infs or nans.
+    inc_loss_scale_factor: a Python number. `loss_scale` is multiplied by this
+      when it is increased.
 
   Returns:
     An op for updating `loss_scale` and `loss_scale_normal_steps`.
@@ -79,7 +96,7 @@ def get_loss_scale_update_op(loss_scale, loss_scale_normal_steps,
   def increase_loss_scale_func():
     return tf.group(
         tf.assign(loss_scale_normal_steps, 0),
-        tf.assign(loss_scale, loss_scale * 2))
+        tf.assign(loss_scale, loss_scale * inc_loss_scale_factor))
 
   # true_fn and false_fn must have the same type.
   return tf.cond(loss_scale_normal_steps < inc_loss_scale_every_n,
@@ -106,25 +123,37 @@ def append_gradients_with_loss_scale(training_ops, get_apply_gradients_ops_func,
   loss_scale_normal_steps = loss_scale_params.loss_scale_normal_steps
   inc_loss_scale_every_n = loss_scale_params.inc_loss_scale_every_n
   enable_auto_loss_scale = loss_scale_params.enable_auto_loss_scale
+  loss_scale_skipped_steps = loss_scale_params.loss_scale_skipped_steps
 
   if loss_scale is None or not enable_auto_loss_scale or not is_chief:
     training_ops.extend(get_apply_gradients_ops_func())
   else:
     # If nans/infs occurred, skip applying gradients and instead update
-    # loss_scale (halve loss_scale and reset loss_scale_normal_steps to zero).
+    # loss_scale (decrease loss_scale and reset loss_scale_normal_steps to
+    # zero).
     def update_op_if_nan_or_inf():
       """Update loss_scale and discard gradients if nans/infs occurred."""
-      return tf.group(
-          tf.assign(loss_scale, loss_scale / 2.),
-          tf.assign(loss_scale_normal_steps, 0))
+      if not loss_scale_params.update_loss_scale:
+        return tf.no_op()
+      update_ops = [
+          tf.assign(loss_scale,
+                    loss_scale / loss_scale_params.dec_loss_scale_factor),
+          tf.assign(loss_scale_normal_steps, 0)
+      ]
+      if loss_scale_skipped_steps is not None:
+        update_ops.append(tf.assign_add(loss_scale_skipped_steps, 1))
+      return tf.group(*update_ops)
 
     # Otherwise, apply gradients, and update loss_scale and
     # loss_scale_normal_steps.
     def update_op_if_no_nan_or_inf():
       """Apply gradients, and update loss scaling."""
+      if not loss_scale_params.update_loss_scale:
+        return tf.group(*get_apply_gradients_ops_func())
       return tf.group(
           get_loss_scale_update_op(loss_scale, loss_scale_normal_steps,
-                                   inc_loss_scale_every_n),
+                                   inc_loss_scale_every_n,
+                                   loss_scale_params.inc_loss_scale_factor),
           *get_apply_gradients_ops_func())
 
     # TODO(tanmingxing): Add support for independent and distributed all_reduce.
@@ -137,6 +166,96 @@ def append_gradients_with_loss_scale(training_ops, get_apply_gradients_ops_func,
     training_ops.append(update_op)
 
 
+class FusedMomentumOptimizer(tf.train.Optimizer):
+  """Momentum or SGD optimizer that updates many variables with a few ops.
+
+  tf.train.MomentumOptimizer and tf.train.GradientDescentOptimizer add an update
+  op per variable, and a momentum accumulator per variable. This optimizer
+  groups the variables by device and dtype. For each group, the gradients are
+  concatenated into a flat buffer, the momentum accumulators of the group are
+  kept in a single flat variable, and the update is computed with a handful of
+  ops on the flat buffers. The flat update is split back into the variable
+  shapes with a single op, and only the final subtraction is done per variable,
+  since TF variables cannot be slices of a shared buffer.
+  """
+
+  def __init__(self, learning_rate, momentum=0., use_nesterov=False,
+               name='FusedMomentum'):
+    """Constructs a FusedMomentumOptimizer.
+
+    Args:
+      learning_rate: A float or scalar tensor.
+      momentum: A Python float. If 0, this is plain SGD and no accumulators are
+        created.
+      use_nesterov: If True, use Nesterov momentum, like
+        tf.train.MomentumOptimizer.
+      name: The name of the optimizer, used in op and variable names.
+    """
+    super(FusedMomentumOptimizer, self).__init__(False, name)
+    self._learning_rate = learning_rate
+    self._momentum = momentum
+    self._use_nesterov = use_nesterov
+
+  def _create_flat_accumulator(self, variables, dtype):
+    """Creates a zero-initialized flat accumulator for `variables`."""
+    size = sum(v.shape.num_elements() for v in variables)
+    # Name the accumulator after the outer variable scope of the variables, so
+    # that replicated modes treat it like the per-tower variables.
+    prefix = variables[0].op.name.split('/')[0]
+    with ops.init_scope(), tf.get_default_graph().name_scope(None):
+      with tf.colocate_with(variables[0]):
+        return tf.Variable(
+            tf.zeros([size], dtype=dtype), trainable=False,
+            name='%s/%s_%s' % (prefix, self._name, dtype.name))
+
+  def _get_flat_update(self, flat_grad, variables):
+    """Returns the flat update of `variables` for the packed `flat_grad`."""
+    dtype = flat_grad.dtype
+    learning_rate = tf.cast(self._learning_rate, dtype)
+    if not self._momentum:
+      return learning_rate * flat_grad
+    accumulator = self._create_flat_accumulator(variables, dtype)
+    momentum = tf.cast(self._momentum, dtype)
+    new_accumulator = tf.assign(accumulator, accumulator * momentum + flat_grad)
+    if self._use_nesterov:
+      return learning_rate * (flat_grad + momentum * new_accumulator)
+    return learning_rate * new_accumulator
+
+  def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    groups = pycoll.OrderedDict()
+    for g, v in grads_and_vars:
+      key = (v.device, v.dtype.base_dtype)
+      groups.setdefault(key, []).append((tf.convert_to_tensor(g), v))
+    group_vars = [[v for _, v in group] for group in groups.values()]
+    group_grads = [[g for g, _ in group] for group in groups.values()]
+
+    update_ops = []
+    with tf.name_scope(name, self._name):
+      # Each group is packed like the tensors of a device in the batch
+      # all-reduce: one concat before the update, and one split after it. With
+      # a single split, split_all_device_tensors() and
+      # undo_split_all_device_tensors() forward the flat tensors unchanged.
+      packer = batch_allreduce._TensorPacker(1)  # pylint: disable=protected-access
+      flat_grads = packer.concat_all_device_tensors(group_grads)
+      flat_updates = []
+      for [flat_grad], variables in zip(flat_grads, group_vars):
+        with tf.colocate_with(variables[0]):
+          flat_updates.append([self._get_flat_update(flat_grad, variables)])
+      flat_updates = packer.undo_split_all_device_tensors(
+          packer.split_all_device_tensors(flat_updates))
+      group_updates = packer.undo_concat_all_device_tensors(flat_updates)
+      for variables, updates in zip(group_vars, group_updates):
+        for v, update in zip(variables, updates):
+          with tf.colocate_with(v):
+            update_ops.append(tf.assign_sub(v, update))
+      if global_step is None:
+        return tf.group(*update_ops)
+      with tf.control_dependencies(update_ops):
+        with tf.colocate_with(global_step):
+          return tf.assign_add(global_step, 1).op
+
+
 # To be used with custom_getter on tf.get_variable.
 class OverrideCachingDevice(object):
   """Variable getter which caches variables on the least loaded device.
@@ -379,6 +498,28 @@ class StagedVariableGetter(object):
     return params
 
 
+def get_variable_owners(variable_sizes, num_devices):
+  """Assigns each variable to a device, balancing the bytes per device.
+
+  Variables are assigned from the largest to the smallest, each to the device
+  with the fewest bytes so far.
+
+  Args:
+    variable_sizes: A list with the size in bytes of each variable.
+    num_devices: The number of devices.
+
+  Returns:
+    A list with the index of the device owning each variable.
+  """
+  owners = [None] * len(variable_sizes)
+  device_sizes = [0] * num_devices
+  for i in sorted(range(len(variable_sizes)), key=lambda i: -variable_sizes[i]):
+    owner = device_sizes.index(min(device_sizes))
+    owners[i] = owner
+    device_sizes[owner] += variable_sizes[i]
+  return owners
+
+
 def aggregate_gradients_using_copy_with_device_selection(
     benchmark_cnn, tower_grads, use_mean, check_inf_nan):
   """Aggregate gradients, controlling device for the aggregation.
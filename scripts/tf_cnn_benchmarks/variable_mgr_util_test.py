@@ -24,6 +24,37 @@ import variable_mgr_util
 
 class VariableMgrUtilTest(tf.test.TestCase):
 
+  def _testFusedMomentumOptimizer(self, momentum, use_nesterov):
+    initial_values = [[[1., 2.], [3., 4.]], [5., 6., 7.], [8.]]
+    fused_vars = [tf.Variable(v) for v in initial_values]
+    vars_ = [tf.Variable(v) for v in initial_values]
+    grads = [tf.constant(v) * 0.1 for v in initial_values]
+    fused_opt = variable_mgr_util.FusedMomentumOptimizer(
+        0.5, momentum, use_nesterov=use_nesterov)
+    fused_update = fused_opt.apply_gradients(list(zip(grads, fused_vars)))
+    if momentum:
+      opt = tf.train.MomentumOptimizer(0.5, momentum,
+                                       use_nesterov=use_nesterov)
+    else:
+      opt = tf.train.GradientDescentOptimizer(0.5)
+    update = opt.apply_gradients(list(zip(grads, vars_)))
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      for _ in range(3):
+        sess.run([fused_update, update])
+      for fused_value, value in zip(sess.run(fused_vars), sess.run(vars_)):
+        self.assertAllClose(fused_value, value)
+
+  def testFusedMomentumOptimizer(self):
+    self._testFusedMomentumOptimizer(0.9, use_nesterov=False)
+
+  def testFusedMomentumOptimizerNesterov(self):
+    self._testFusedMomentumOptimizer(0.9, use_nesterov=True)
+
+  def testFusedMomentumOptimizerSgd(self):
+    self._testFusedMomentumOptimizer(0., use_nesterov=False)
+
   def testGetLossScaleUpdateOpTruePath(self):
     loss_scale = tf.Variable(4)
     # loss_scale_normal_steps >= inc_loss_scale_every_n
@@ -147,6 +178,75 @@ class VariableMgrUtilTest(tf.test.TestCase):
       self.assertEqual(sess.run(loss_scale_params.loss_scale), 2)
       self.assertEqual(sess.run(loss_scale_params.loss_scale_normal_steps), 0)
 
+  def testAppendGradientsWithLossScaleFactors(self):
+    v = tf.Variable(0)
+    grad_has_inf_nan = tf.placeholder(tf.bool, [])
+    training_ops = []
+    get_apply_gradients_ops_func = lambda: [tf.assign(v, v + 1)]
+    loss_scale_params = variable_mgr_util.AutoLossScaleParams(
+        enable_auto_loss_scale=True,
+        loss_scale=tf.Variable(64, dtype=tf.float32),
+        loss_scale_normal_steps=tf.Variable(0),
+        inc_loss_scale_every_n=1,
+        is_chief=True,
+        loss_scale_skipped_steps=tf.Variable(0),
+        inc_loss_scale_factor=1.5,
+        dec_loss_scale_factor=4.)
+    variable_mgr_util.append_gradients_with_loss_scale(
+        training_ops,
+        get_apply_gradients_ops_func,
+        loss_scale_params,
+        grad_has_inf_nan=grad_has_inf_nan)
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(training_ops, {grad_has_inf_nan: True})
+      self.assertEqual(sess.run(loss_scale_params.loss_scale), 16)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale_skipped_steps), 1)
+      sess.run(training_ops, {grad_has_inf_nan: False})
+      sess.run(training_ops, {grad_has_inf_nan: False})
+      self.assertEqual(sess.run(v), 2)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale), 24)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale_skipped_steps), 1)
+
+  def testAppendGradientsWithLossScaleMultiDevice(self):
+    device_vars = [tf.Variable(0), tf.Variable(0)]
+    grad_has_inf_nan = tf.placeholder(tf.bool, [])
+    training_ops = []
+    loss_scale_params = variable_mgr_util.AutoLossScaleParams(
+        enable_auto_loss_scale=True,
+        loss_scale=tf.Variable(64, dtype=tf.float32),
+        loss_scale_normal_steps=tf.Variable(0),
+        inc_loss_scale_every_n=1,
+        is_chief=True,
+        loss_scale_skipped_steps=tf.Variable(0))
+    for d, v in enumerate(device_vars):
+      variable_mgr_util.append_gradients_with_loss_scale(
+          training_ops,
+          lambda v=v: [tf.assign(v, v + 1)],
+          loss_scale_params._replace(update_loss_scale=d == 0),
+          grad_has_inf_nan=grad_has_inf_nan)
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(training_ops, {grad_has_inf_nan: True})
+      self.assertEqual(sess.run(loss_scale_params.loss_scale), 32)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale_skipped_steps), 1)
+      sess.run(training_ops, {grad_has_inf_nan: False})
+      self.assertEqual(sess.run(device_vars), [1, 1])
+      self.assertEqual(sess.run(loss_scale_params.loss_scale), 32)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale_normal_steps), 1)
+      self.assertEqual(sess.run(loss_scale_params.loss_scale_skipped_steps), 1)
+
+  def testGetVariableOwners(self):
+    self.assertEqual(
+        variable_mgr_util.get_variable_owners([4, 16, 8, 4, 4], 2),
+        [1, 0, 1, 1, 0])
+    # Every device owns a variable when there are enough of them.
+    self.assertEqual(variable_mgr_util.get_variable_owners([1, 1, 1], 3),
+                     [0, 1, 2])
+    self.assertEqual(variable_mgr_util.get_variable_owners([1], 2), [0])
+
 
 if __name__ == '__main__':
   tf.test.main()